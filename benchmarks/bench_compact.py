@@ -0,0 +1,73 @@
+"""
+Memory footprint and reconstruction-loss accuracy of the compact storage dtypes.
+
+Run from the repository parent directory, e.g.:
+    python -m code_iclr.benchmarks.bench_compact --model /path/to/pretrained_model.pt
+Without --model a freshly initialized TransformerAutoEncoder is used on
+synthetic normalized windows of the pretraining input shape.
+"""
+
+import argparse
+
+import torch
+
+from ..configs import config_pretrain as config
+from ..data.compact import COMPACT_DTYPES, CompactCodec, compare_reconstruction_loss
+from ..data.prepare_data import compute_num_patches_3d
+from ..models.ag_vit import TransformerAutoEncoder
+
+
+def build_model(input_shape, patch_mask=None):
+    return TransformerAutoEncoder(
+        input_size=input_shape,
+        patch_size=config.PATCH_SIZE,
+        embedding_dim=config.EMBEDDING_DIM,
+        num_heads=config.NUM_HEADS,
+        num_layers=config.NUM_LAYERS,
+        output_dims={},
+        num_of_spatial_patches=compute_num_patches_3d(input_shape[:-1], config.PATCH_SIZE),
+        num_cls_tokens=config.NUM_CLS_TOKENS,
+        reduced_patches_factor_percent=config.REDUCED_PATCHES_FACTOR_PERCENT,
+        reduce_time_factor_percent=config.REDUCE_TIME_FACTOR_PERCENT,
+        p_dropout=config.P_DROPOUT,
+        custom_decoder=config.CUSTOM_RECON_BOOL,
+        merge_patches=config.MERGE_PATCHES,
+        use_patch_merger=config.USE_PATCH_MERGER,
+        patch_mask=patch_mask,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--model", default=None)
+    parser.add_argument("--samples", type=int, default=32)
+    parser.add_argument("--shape", type=int, nargs=4, default=[32, 38, 32, config.WINDOW_SIZE])
+    parser.add_argument("--device", default="cpu")
+    args = parser.parse_args()
+
+    torch.manual_seed(config.SEED)
+    data = torch.randn(args.samples, *args.shape)
+    custom_recon = torch.randn(args.samples, 200, args.shape[-1])
+
+    if args.model:
+        model = torch.load(args.model, map_location=args.device, weights_only=False)
+    else:
+        model = build_model(tuple(args.shape)).to(args.device)
+        with torch.no_grad():
+            model(data[:1].to(args.device))  # materialize lazy layers
+
+    print(f"{'dtype':<10}{'MB/sample':>11}{'rel. input err':>16}{'loss':>12}{'Δloss (rel)':>14}")
+    mb = data[0].numel() * data.element_size() / 2**20
+    for dtype in COMPACT_DTYPES:
+        stats = compare_reconstruction_loss(model, data, custom_recon, dtype, device=args.device)
+        if dtype == next(iter(COMPACT_DTYPES)):
+            print(f"{'float32':<10}{mb:>11.2f}{0.0:>16.2e}{stats['float32_loss']:>12.5f}{0.0:>14.2e}")
+        size = CompactCodec(dtype).fit(data[:1]).encode(data[:1]).element_size() * data[0].numel() / 2**20
+        print(
+            f"{dtype:<10}{size:>11.2f}{stats['input_relative_error']:>16.2e}"
+            f"{stats[f'{dtype}_loss']:>12.5f}{stats['relative_loss_change']:>14.2e}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""
+Spatial patches and training-step time with and without the brain crop
+and background-patch pruning.
+
+Run from the repository parent directory, e.g.:
+    python -m code_iclr.benchmarks.bench_crop --mask /path/to/brain_mask.nii.gz --device cuda
+The mask is given on the stored (pre-resize) grid; without --mask an
+ellipsoid brain filling most of a 46x55x46 grid is used.
+"""
+
+import argparse
+import time
+
+import torch
+import torch.nn.functional as F
+
+from ..configs import config_pretrain as config
+from ..data.crop import BrainCrop, load_mask, patch_mask, resize_mask
+from ..data.transforms import Resize3D
+from .bench_compact import build_model
+
+
+def ellipsoid_mask(shape, radii=(0.7, 0.8, 0.65)):
+    grid = torch.meshgrid(*[torch.linspace(-1, 1, n) for n in shape], indexing="ij")
+    return sum((g / r) ** 2 for g, r in zip(grid, radii)) < 1
+
+
+def step_time(input_shape, batch_size, device, repeats, patches=None):
+    """Mean forward + backward + optimizer step time of the pretraining model."""
+    model = build_model(input_shape, patch_mask=patches).to(device)
+    x = torch.randn(batch_size, *input_shape, device=device)
+    target = torch.randn(batch_size, 200, input_shape[-1], device=device)
+    with torch.no_grad():
+        model(x[:1])  # materialize lazy layers
+    optimizer = torch.optim.AdamW(model.parameters(), lr=config.LR)
+
+    def step():
+        optimizer.zero_grad()
+        F.mse_loss(model(x)["Reconstruction"], target).backward()
+        optimizer.step()
+
+    step()
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+    t0 = time.perf_counter()
+    for _ in range(repeats):
+        step()
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+    return (time.perf_counter() - t0) / repeats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--mask", default=None)
+    parser.add_argument("--shape", type=int, nargs=3, default=[46, 55, 46])
+    parser.add_argument("--batch-size", type=int, default=config.BATCH_SIZE)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--device", default="cpu")
+    args = parser.parse_args()
+
+    torch.manual_seed(config.SEED)
+    mask = load_mask(args.mask) if args.mask else ellipsoid_mask(args.shape)
+    resized = resize_mask(mask, Resize3D(scale_factor=config.RESIZE_FACTOR))
+    crop = BrainCrop.from_mask(resized, config.PATCH_SIZE)
+    print(crop.summary())
+
+    variants = []
+    for name, grid_mask in (("full", resized), ("cropped", crop.crop_mask(resized))):
+        patches = patch_mask(grid_mask, config.PATCH_SIZE)
+        variants.append((name, grid_mask.shape, None, patches.numel()))
+        variants.append((f"{name}+pruned", grid_mask.shape, patches, int(patches.sum())))
+
+    baseline = None
+    for name, spatial, patches, n_patches in variants:
+        t = step_time(tuple(spatial) + (config.WINDOW_SIZE,), args.batch_size, args.device, args.repeats, patches)
+        baseline = baseline or t
+        print(
+            f"{name:<15} input {tuple(spatial)}, {n_patches:>4} spatial patches: "
+            f"{t * 1e3:8.1f} ms / training step ({baseline / t:.2f}x)"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""
+Peak RSS and wall time of the streaming downsample against the in-memory path.
+
+Run from the repository parent directory, e.g.:
+    python -m code_iclr.benchmarks.bench_downsample --path /path/to/rfMRI_REST1_LR.nii.gz
+Without --path a synthetic 91x109x91xT scan is written to a temporary directory.
+"""
+
+import argparse
+import multiprocessing as mp
+import os
+import resource
+import shutil
+import tempfile
+import time
+
+import nibabel as nib
+import numpy as np
+
+from ..data.import_hcp_data import downsample_subject
+
+
+def downsample_in_memory(path):
+    """The previous implementation: materialize the full volume, then slice."""
+    img = nib.load(path)
+    data = img.get_fdata(dtype=np.float32)
+    affine = img.affine.copy()
+    data_downsampled = data[::2, ::2, ::2, :]
+    affine[:3, :3] *= 2
+    nib.save(nib.Nifti1Image(data_downsampled, affine, img.header), path)
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process, in MB."""
+    # VmHWM is reset on exec, unlike ru_maxrss which inherits the parent's peak
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _run(method, path, chunk_size, queue):
+    t0 = time.perf_counter()
+    if method == "in_memory":
+        downsample_in_memory(path)
+    else:
+        downsample_subject(path, chunk_size=chunk_size)
+    wall = time.perf_counter() - t0
+    peak_mb = peak_rss_mb()
+    queue.put((wall, peak_mb))
+
+
+def measure(method, src, workdir, chunk_size):
+    path = os.path.join(workdir, f"{method}.nii.gz")
+    shutil.copy(src, path)
+    queue = mp.get_context("spawn").Queue()
+    proc = mp.get_context("spawn").Process(
+        target=_run, args=(method, path, chunk_size, queue)
+    )
+    proc.start()
+    wall, peak_mb = queue.get()
+    proc.join()
+    return wall, peak_mb
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--path", default=None)
+    parser.add_argument("--time-points", type=int, default=300)
+    parser.add_argument("--chunk-sizes", type=int, nargs="+", default=[25, 100])
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    try:
+        src = args.path
+        if src is None:
+            src = os.path.join(workdir, "synthetic.nii.gz")
+            data = np.random.rand(91, 109, 91, args.time_points).astype(np.float32)
+            nib.save(nib.Nifti1Image(data, np.eye(4)), src)
+            del data
+
+        print(f"Input: {src} {nib.load(src).shape}")
+        print(f"{'method':<22}{'wall (s)':>10}{'peak RSS (MB)':>16}")
+        wall, peak = measure("in_memory", src, workdir, None)
+        print(f"{'in_memory':<22}{wall:>10.2f}{peak:>16.1f}")
+        for chunk_size in args.chunk_sizes:
+            wall, peak = measure("streaming", src, workdir, chunk_size)
+            print(f"{f'streaming (chunk={chunk_size})':<22}{wall:>10.2f}{peak:>16.1f}")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""
+Throughput of phase 1 ingestion: serial `create_batches` versus the
+process-parallel `create_batches_parallel`, swept over the number of
+subjects and of workers, with the peak scratch disk use of the parallel path.
+
+Run from the repository parent directory, e.g.:
+    python -m code_iclr.benchmarks.bench_ingest --subjects 8 32 --workers 1 2 4 8
+Subjects are hard links to one synthetic .nii.gz scan (every subject is still
+decompressed and projected on its own), and a synthetic label volume stands in
+for the Schaefer atlas, so nothing is downloaded. Scaling with --workers needs
+that many free cores; subjects/hour should stay flat along --subjects.
+"""
+
+import argparse
+import multiprocessing as mp
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import nibabel as nib
+import numpy as np
+import torch
+
+from ..data.atlas import AtlasProjector
+from ..data.helpers_da import create_tensors_data as ctd
+from ..data.ingest_manifest import SCAN_RELPATH, default_manifest_path
+
+
+def make_subjects(base_dir, n_subjects, shape, n_rois):
+    affine = np.diag([4.0, 4.0, 4.0, 1.0])
+    rng = np.random.default_rng(0)
+    scan = os.path.join(base_dir, "scan.nii.gz")
+    nib.save(nib.Nifti1Image(rng.standard_normal(shape).astype(np.float32), affine), scan)
+    for i in range(n_subjects):
+        path = os.path.join(base_dir, f"subject_{100000 + i}", SCAN_RELPATH)
+        os.makedirs(os.path.dirname(path))
+        os.link(scan, path)
+    labels = rng.integers(0, n_rois + 1, size=shape[:3])
+    return AtlasProjector(labels, affine=affine)
+
+
+def configure(base_dir, shape, n_rois, batch_size, projector):
+    ctd.base_dir = base_dir
+    ctd.output_dir = os.path.join(base_dir, "data")
+    shutil.rmtree(ctd.output_dir, ignore_errors=True)
+    os.makedirs(ctd.output_dir)
+    ctd.manifest_path = default_manifest_path(ctd.output_dir)
+    ctd.EXPECTED_SHAPE = tuple(shape)
+    ctd.N_ROIS = n_rois
+    ctd.BATCH_SIZE = batch_size
+    ctd.load_projector = lambda subjects: projector
+
+
+def peak_scratch_bytes(run):
+    """Run `run()` while sampling the size of the scratch files; (seconds, peak bytes)."""
+    peak, done = [0], threading.Event()
+
+    def sample():
+        while not done.is_set():
+            total = 0
+            for f in os.listdir(ctd.output_dir):
+                if f.startswith(".scratch_"):
+                    try:
+                        total += os.path.getsize(os.path.join(ctd.output_dir, f))
+                    except FileNotFoundError:
+                        pass
+            peak[0] = max(peak[0], total)
+            time.sleep(0.01)
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    t0 = time.perf_counter()
+    run()
+    elapsed = time.perf_counter() - t0
+    done.set()
+    sampler.join()
+    return elapsed, peak[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--subjects", type=int, nargs="+", default=[8, 32])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--shape", type=int, nargs=4, default=[46, 55, 46, 100])
+    parser.add_argument("--rois", type=int, default=200)
+    parser.add_argument("--batch-size", type=int, default=8)
+    args = parser.parse_args()
+
+    # Workers must inherit the synthetic configuration set on the module
+    mp.set_start_method("fork", force=True)
+    batch_gb = args.batch_size * np.prod(args.shape) * 4 / 1e9
+    print(f"{'subjects':>8}{'mode':>10}{'workers':>8}{'subjects/h':>12}{'speedup':>9}{'peak scratch':>14}")
+    for n_subjects in args.subjects:
+        with tempfile.TemporaryDirectory() as tmp:
+            projector = make_subjects(tmp, n_subjects, args.shape, args.rois)
+
+            configure(tmp, args.shape, args.rois, args.batch_size, projector)
+            serial_s, _ = peak_scratch_bytes(ctd.create_batches)
+            first_batch = os.path.join(ctd.output_dir, "batch_4d_1.pt")
+            reference = torch.load(first_batch).numpy()
+            print(f"{n_subjects:>8}{'serial':>10}{1:>8}{n_subjects / serial_s * 3600:>12.0f}{1:>8.2f}x{'-':>14}")
+
+            for workers in args.workers:
+                configure(tmp, args.shape, args.rois, args.batch_size, projector)
+                parallel_s, scratch = peak_scratch_bytes(lambda: ctd.create_batches_parallel(workers))
+                assert np.array_equal(torch.load(first_batch).numpy(), reference), "parallel batches differ from the serial ones"
+                print(
+                    f"{n_subjects:>8}{'parallel':>10}{workers:>8}{n_subjects / parallel_s * 3600:>12.0f}"
+                    f"{serial_s / parallel_s:>8.2f}x{scratch / 1e9:>8.2f} GB"
+                )
+    print(f"(one batch of scratch = {batch_gb:.2f} GB)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+"""
+DataLoader throughput (samples/sec) of WindowedScanDataset: per-sample
+`__getitem__` + `collate_fn_corr` versus batched `__getitems__`, and with
+worker processes attached to shared-memory / memory-mapped dataset tensors.
+
+Run from the repository parent directory, e.g.:
+    python -m code_iclr.benchmarks.bench_loader --mmap --workers 0 2 4 --step-ms 50
+Scans are synthetic, of the stored (pre-resize) grid; --mmap serves them
+from a memory-mapped .npy file as the preprocessing cache does. --step-ms
+stands in for a training step that leaves the CPU idle (as an accelerator
+step does), --model runs the pretraining model on --device instead; the
+"data wait" column is the share of time the consumer waits for batches.
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch.utils.data import DataLoader
+
+from ..configs import config_pretrain as config
+from ..data.dataset import WindowedScanDataset
+from ..data.shared import load_npy
+from .bench_compact import build_model
+
+
+def make_dataset(scans, regions, window_size, storage_dtype=None, batched=True):
+    info = {i: {"image_id": str(i)} for i in range(len(scans))}
+    dataset = WindowedScanDataset(
+        scans, info, {}, window_size=window_size, custom_recon=regions, storage_dtype=storage_dtype
+    )
+    if not batched:
+        dataset.__getitems__ = None  # DataLoader then fetches sample by sample
+    return dataset
+
+
+def model_step(input_shape, device):
+    """One forward + backward + optimizer step of the pretraining model per batch."""
+    model = build_model(input_shape).to(device)
+    with torch.no_grad():
+        model(torch.zeros((1,) + input_shape, device=device))  # materialize lazy layers
+    optimizer = torch.optim.AdamW(model.parameters(), lr=config.LR)
+
+    def step(data, recon):
+        data, recon = data.to(device, non_blocking=True), recon.to(device, non_blocking=True)
+        optimizer.zero_grad()
+        F.mse_loss(model(data)["Reconstruction"], recon).backward()
+        optimizer.step()
+        if device.startswith("cuda"):
+            torch.cuda.synchronize()
+
+    return step
+
+
+def measure(dataset, batch_size, epochs, step=None, **loader_args):
+    """(samples/s, fraction of the time spent waiting for batches)."""
+    if loader_args.get("num_workers", 0) > 0:
+        dataset.share_memory()
+    loader = DataLoader(dataset, batch_size=batch_size, shuffle=True, collate_fn=dataset.collate_fn, **loader_args)
+    next(iter(loader))  # warm up (and start workers)
+    n, wait, t0 = 0, 0.0, time.perf_counter()
+    for _ in range(epochs):
+        batches = iter(loader)
+        while True:
+            t = time.perf_counter()
+            batch = next(batches, None)
+            wait += time.perf_counter() - t
+            if batch is None:
+                break
+            if step is not None:
+                step(batch[0], batch[2])
+            n += len(batch[0])
+    total = time.perf_counter() - t0
+    return n / total, wait / total
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--scans", type=int, default=16)
+    parser.add_argument("--shape", type=int, nargs=4, default=[46, 55, 46, 200])
+    parser.add_argument("--regions", type=int, default=200)
+    parser.add_argument("--batch-size", type=int, default=config.BATCH_SIZE)
+    parser.add_argument("--epochs", type=int, default=1)
+    parser.add_argument("--storage-dtype", default=None)
+    parser.add_argument("--mmap", action="store_true")
+    parser.add_argument("--workers", type=int, nargs="+", default=[0])
+    parser.add_argument("--prefetch-factor", type=int, default=config.PREFETCH_FACTOR)
+    parser.add_argument("--pin-memory", action="store_true")
+    parser.add_argument("--start-method", default=None, choices=["fork", "spawn", "forkserver"])
+    parser.add_argument("--step-ms", type=float, default=0.0)
+    parser.add_argument("--model", action="store_true")
+    parser.add_argument("--device", default="cpu")
+    args = parser.parse_args()
+
+    torch.manual_seed(config.SEED)
+    scans = torch.randn(args.scans, *args.shape)
+    regions = torch.randn(args.scans, args.regions, args.shape[-1])
+    step = None
+    if args.model:
+        step = model_step(tuple(args.shape[:-1]) + (config.WINDOW_SIZE,), args.device)
+    elif args.step_ms > 0:
+        step = lambda data, recon: time.sleep(args.step_ms / 1e3)  # noqa: E731
+
+    with tempfile.TemporaryDirectory() as tmp:
+        if args.mmap:
+            path = os.path.join(tmp, "scans.npy")
+            np.save(path, scans.numpy())
+            scans = load_npy(path)
+
+        print(f"{'fetch':<14}{'workers':>8}{'samples/s':>12}{'speedup':>9}{'data wait':>11}")
+        baseline = None
+        for workers in args.workers:
+            for name, batched in (("__getitem__", False), ("__getitems__", True)):
+                loader_args = {"num_workers": workers, "pin_memory": args.pin_memory}
+                if workers > 0:
+                    loader_args.update(
+                        prefetch_factor=args.prefetch_factor,
+                        persistent_workers=True,  # worker start-up is not part of the measurement
+                        multiprocessing_context=args.start_method,
+                    )
+                dataset = make_dataset(scans, regions, config.WINDOW_SIZE, args.storage_dtype, batched)
+                rate, wait = measure(dataset, args.batch_size, args.epochs, step, **loader_args)
+                baseline = baseline or rate
+                print(f"{name:<14}{workers:>8}{rate:>12.1f}{rate / baseline:>8.2f}x{wait:>11.0%}")
+
+
+if __name__ == "__main__":
+    main()
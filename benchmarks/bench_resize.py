@@ -0,0 +1,61 @@
+"""
+Wall time and accuracy of the separable Resize3D engine against F.interpolate.
+
+Run from the repository parent directory, e.g.:
+    python -m code_iclr.benchmarks.bench_resize --device cuda
+Both paths resize synthetic [N, H, W, D, T] batches; errors are measured
+against the float64 F.interpolate result.
+"""
+
+import argparse
+import time
+
+import torch
+
+from ..configs import config_pretrain as config
+from ..data.transforms import Resize3D
+
+
+def time_call(fn, x, repeats):
+    fn(x)  # warm-up (and engine construction for the separable path)
+    if x.is_cuda:
+        torch.cuda.synchronize()
+    t0 = time.perf_counter()
+    for _ in range(repeats):
+        fn(x)
+    if x.is_cuda:
+        torch.cuda.synchronize()
+    return (time.perf_counter() - t0) / repeats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--shape", type=int, nargs=4, default=[46, 55, 46, config.WINDOW_SIZE])
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 16, 64])
+    parser.add_argument("--scale", type=float, default=getattr(config, "RESIZE_FACTOR", 0.7))
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--device", default="cpu")
+    args = parser.parse_args()
+
+    torch.manual_seed(config.SEED)
+    interpolate = Resize3D(scale_factor=args.scale, separable=False)
+    separable = Resize3D(scale_factor=args.scale, separable=True)
+    out_shape = separable.output_size(args.shape[:3])
+    print(f"{tuple(args.shape[:3])} -> {out_shape}, T={args.shape[3]}, device={args.device}")
+    print(f"{'batch':>6}{'interpolate ms':>16}{'separable ms':>14}{'speedup':>9}{'err interp':>12}{'err sep':>10}")
+
+    for n in args.batch_sizes:
+        x = torch.randn(n, *args.shape, device=args.device)
+        reference = interpolate(x.double())
+        t_interp = time_call(interpolate, x, args.repeats)
+        t_sep = time_call(separable, x, args.repeats)
+        err_interp = (interpolate(x).double() - reference).abs().max().item()
+        err_sep = (separable(x).double() - reference).abs().max().item()
+        print(
+            f"{n:>6}{t_interp * 1e3:>16.2f}{t_sep * 1e3:>14.2f}{t_interp / t_sep:>8.2f}x"
+            f"{err_interp:>12.1e}{err_sep:>10.1e}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -7,6 +7,8 @@ BASE_RESULTS_PATH = "results/"
 # Path to the best checkpoint from the pretraining run
 PRETRAINED_CHECKPOINT_PATH = "results/pretraining_runs/your_pretrain_run_id/model.pt"
 FINETUNE_MODEL_DIR = "results/finetuning_runs/"
+# Same as pretraining, so matching data settings reuse its processed splits
+PREPROCESS_CACHE_DIR = "path/to/your/data/cache/preprocessed"
 
 
 # --- Data Settings ---
@@ -15,6 +17,9 @@ VAL_SPLIT = 0.1
 TEST_SPLIT = 0.2
 SEED = 44
 WINDOW_SIZE = 10
+# Set both as in pretraining when the pretrained model was trained on brain-cropped scans
+BRAIN_CROP = False
+PATCH_SIZE = (6, 6, 6)
 
 # --- Fine-tuning Task Configuration ---
 # Example: Predicting cognitive decline at 1-year horizon
@@ -34,6 +39,13 @@ HEAD_P_DROPOUT = 0.2
 LR = 3e-6  #
 NUM_EPOCHS = 2
 BATCH_SIZE = 4
+# DataLoader workers; with NUM_WORKERS > 0 the dataset tensors are shared with
+# (not copied into) the workers, see WindowedScanDataset.share_memory
+NUM_WORKERS = 0
+PREFETCH_FACTOR = 2  # Batches loaded ahead per worker
+PIN_MEMORY = False  # Page-locked batches for faster host-to-GPU copies (CUDA only)
+PERSISTENT_WORKERS = False  # Keep workers alive between epochs
+PREFETCH_TO_DEVICE = True  # Copy batch N+1 to DEVICE while batch N is processed
 OPTIMIZER_WEIGHT_DECAY = 1e-5
 
 # --- Runtime and Logging ---
@@ -7,6 +7,28 @@ BASE_DATA_PATH = os.path.join(USER_ROOT_DIR,"hcp_data_iclr")
 BASE_RESULTS_PATH = os.path.join(USER_ROOT_DIR,"results_hcp/")
 PRETRAINED_MODEL_DIR = os.path.join(USER_ROOT_DIR, "tracker_hcp", "pretraining_runs")
 print("Data path is", BASE_DATA_PATH)
+# Per-subject shard store written by create_tensors_data (OUTPUT_FORMAT = "shards").
+# When its manifest exists it replaces the monolithic all_4d_downsampled tensor;
+# scans are read from the shards on demand unless SHARDS_IN_MEMORY loads them into RAM
+SHARDS_DIR = os.path.join(BASE_DATA_PATH, "data", "shards")
+SHARDS_IN_MEMORY = False
+# Stream training windows from the shards (constant memory, splits larger than RAM);
+# needs a deferred DET_TRANSFORM_MODE. SHUFFLE_BUFFER windows are shuffled per worker
+STREAM_SHARDS = False
+SHUFFLE_BUFFER = 256
+# Low-rank store written by `python -m code_iclr.data.lowrank`; when set (with a deferred
+# DET_TRANSFORM_MODE) windows are decoded from the factors on the fly
+LOWRANK_DIR = None
+# Train straight from the original .nii.gz files under this HCP_data directory
+# (subject_*/MNINonLinear/...), with a deferred DET_TRANSFORM_MODE. New or changed files
+# are read once for their atlas series, QC and normalizer statistics, cached with their gzip
+# indices in NIFTI_INDEX_DIR (None: next to each file); windows are read through those
+# indices, NIFTI_BLOCK_SIZE frames at a time
+NIFTI_DIR = None
+NIFTI_INDEX_DIR = None
+NIFTI_BLOCK_SIZE = 100
+# Processed splits keyed by a hash of the data settings and input files; None disables
+PREPROCESS_CACHE_DIR = os.path.join(BASE_DATA_PATH, "cache", "preprocessed")
 ATLAS = "schaefer200"
 
 # --- Data Settings ---
@@ -14,7 +36,28 @@ VAL_SPLIT = 0.1
 TEST_SPLIT = 0.2
 SEED = 44
 WINDOW_SIZE = 10
+WINDOW_STRIDE = None  # None: non-overlapping windows; < WINDOW_SIZE: overlapping
+RANDOM_TEMPORAL_CROP = False  # Train windows start at random offsets each epoch
 REMOVE_TOP_K_STD = 1
+# Temporal cleaning before normalization (None to skip), e.g.
+# {"tr": 0.72, "detrend_order": 2, "band": (0.01, 0.1), "global_signal": True}.
+# On shards it runs chunk by chunk into a store of cleaned shards under SHARDS_DIR/denoised/
+DENOISE = None
+RESIZE_FACTOR = 0.7  # Spatial scale factor of the deterministic resize
+# Where scan normalization + resize run: "precompute" (whole splits up front),
+# "batch" (per collated batch in the DataLoader) or "device" (per batch on DEVICE)
+DET_TRANSFORM_MODE = "precompute"
+# Crop the resized scans to the brain bounding box, aligned to PATCH_SIZE. The box
+# comes from BRAIN_MASK_PATH (.npy or NIfTI on the stored grid) or, if None, the nonzero voxels
+BRAIN_CROP = False
+BRAIN_MASK_PATH = None
+# Only patches holding brain voxels (same mask) become tokens; the mask is stored in the model
+PRUNE_BACKGROUND_PATCHES = False
+# Ingest-time QC statistic used to drop the REMOVE_TOP_K_STD outlier scans
+# ("std", "mean", "max_abs", "tsnr", "dvars" or "dvars_max")
+QC_METRIC = "std"
+# Compact storage of the transformed scans: None (float32), "float16", "bfloat16" or "int16"
+STORAGE_DTYPE = None
 
 # --- Model Architecture ---
 PATCH_SIZE = (6, 6, 6)
@@ -38,6 +81,13 @@ CHOSEN_LABELS = ["Reconstruction"]
 LR = 5e-4
 NUM_EPOCHS = 55
 BATCH_SIZE = 8
+# DataLoader workers; with NUM_WORKERS > 0 the dataset tensors are shared with
+# (not copied into) the workers, see WindowedScanDataset.share_memory
+NUM_WORKERS = 0
+PREFETCH_FACTOR = 2  # Batches loaded ahead per worker
+PIN_MEMORY = False  # Page-locked batches for faster host-to-GPU copies (CUDA only)
+PERSISTENT_WORKERS = False  # Keep workers alive between epochs
+PREFETCH_TO_DEVICE = True  # Copy batch N+1 to DEVICE while batch N is processed
 OPTIMIZER_WEIGHT_DECAY = 0.0005
 MAX_NORM = 1.0
 WARMUP_STEPS_PERCENT = 0.1
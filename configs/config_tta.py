@@ -6,11 +6,16 @@ BASE_DATA_PATH = "path/to/your/data"
 PRETRAINED_CHECKPOINT_PATH = "results/pretraining_runs/your_pretrain_run_id/model.pt"
 # Path to the fine-tuned prediction head
 FINETUNED_HEAD_PATH = "results/finetuning_runs/your_finetune_run_id/model.pt"
+# Same as pretraining, so matching data settings reuse its processed splits
+PREPROCESS_CACHE_DIR = "path/to/your/data/cache/preprocessed"
 
 # --- Data Settings ---
 TEST_SPLIT = 0.2  # Should match previous configs
 SEED = 44
 WINDOW_SIZE = 10
+# Set both as in pretraining when the pretrained model was trained on brain-cropped scans
+BRAIN_CROP = False
+PATCH_SIZE = (6, 6, 6)
 
 # --- TTA Task Configuration ---
 # Must match the task the head was fine-tuned on
@@ -24,6 +29,13 @@ TTA_STEPS = 50
 TTA_LR = 5e-4 * 0.1
 # Use a batch size of 1 for sample-by-sample adaptation
 BATCH_SIZE = 1
+# DataLoader workers; with NUM_WORKERS > 0 the dataset tensors are shared with
+# (not copied into) the workers, see WindowedScanDataset.share_memory
+NUM_WORKERS = 0
+PREFETCH_FACTOR = 2  # Batches loaded ahead per worker
+PIN_MEMORY = False  # Page-locked batches for faster host-to-GPU copies (CUDA only)
+PERSISTENT_WORKERS = False  # Keep workers alive between epochs
+PREFETCH_TO_DEVICE = True  # Copy batch N+1 to DEVICE while batch N is processed
 
 # --- Runtime and Logging ---
 DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
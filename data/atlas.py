@@ -0,0 +1,110 @@
+import hashlib
+
+import numpy as np
+import scipy.sparse as sp
+import torch
+
+
+class AtlasProjector:
+    """
+    Region-mean time series extraction with a precomputed sparse averaging matrix.
+
+    Equivalent to nilearn's ``NiftiLabelsMasker(strategy="mean", standardize=False)``
+    for scans on a fixed grid: the labels are resampled to the grid once, and
+    extraction for a whole batch of 4D volumes is a single sparse matmul.
+    """
+
+    def __init__(self, labels, affine=None, background_label=0):
+        """
+        Args:
+            labels: Integer label volume of shape [H, W, D] on the scan grid.
+            affine: Affine of that grid, used to validate incoming scans. Optional.
+            background_label: Label value ignored as background.
+        """
+        labels = np.asarray(labels).astype(np.int64)
+        self.grid_shape = labels.shape
+        self.affine = affine
+        flat = labels.reshape(-1)
+
+        self.region_labels = np.array(
+            [lab for lab in np.unique(flat) if lab != background_label]
+        )
+        self.n_regions = len(self.region_labels)
+
+        # Only the voxels that belong to a region take part in the matmul
+        self.voxel_index = np.flatnonzero(flat != background_label)
+        region_of_voxel = np.searchsorted(self.region_labels, flat[self.voxel_index])
+        counts = np.bincount(region_of_voxel, minlength=self.n_regions)
+        self.matrix = sp.csr_matrix(
+            (
+                1.0 / counts[region_of_voxel],
+                (region_of_voxel, np.arange(len(self.voxel_index))),
+            ),
+            shape=(self.n_regions, len(self.voxel_index)),
+            dtype=np.float32,
+        )
+        self._torch_matrices = {}
+
+    @classmethod
+    def from_atlas_img(cls, labels_img, target_img):
+        """Resample an atlas labels image onto the grid of `target_img` (nearest neighbour)."""
+        import nibabel as nib
+        from nilearn.image import resample_to_img
+
+        if isinstance(target_img, str):
+            target_img = nib.load(target_img)
+        resampled = resample_to_img(labels_img, target_img, interpolation="nearest")
+        return cls(np.asarray(resampled.dataobj), affine=target_img.affine)
+
+    def fingerprint(self):
+        """Hash of the grid and the averaging matrix, to key results extracted with this atlas."""
+        digest = hashlib.sha1(repr(self.grid_shape).encode())
+        for array in (self.voxel_index, self.matrix.indptr, self.matrix.indices, self.matrix.data):
+            digest.update(np.ascontiguousarray(array).tobytes())
+        return digest.hexdigest()[:16]
+
+    def _torch_matrix(self, device):
+        key = str(device)
+        if key not in self._torch_matrices:
+            coo = self.matrix.tocoo()
+            self._torch_matrices[key] = torch.sparse_coo_tensor(
+                np.vstack([coo.row, coo.col]),
+                coo.data,
+                size=coo.shape,
+                dtype=torch.float32,
+                device=device,
+            ).coalesce()
+        return self._torch_matrices[key]
+
+    def transform(self, volumes):
+        """
+        Extract region time series.
+
+        Args:
+            volumes: Array or tensor of shape [H, W, D, T] or [B, H, W, D, T].
+        Returns:
+            Region time series of shape [T, n_regions] or [B, T, n_regions],
+            of the same type (NumPy or torch) as the input.
+        """
+        single = volumes.ndim == 4
+        if single:
+            volumes = volumes[None]
+        b, t = volumes.shape[0], volumes.shape[-1]
+        if tuple(volumes.shape[1:4]) != self.grid_shape:
+            raise ValueError(
+                f"Scan grid {tuple(volumes.shape[1:4])} does not match atlas grid {self.grid_shape}."
+            )
+
+        if isinstance(volumes, torch.Tensor):
+            index = torch.as_tensor(self.voxel_index, device=volumes.device)
+            x = volumes.reshape(b, -1, t).index_select(1, index).float()
+            x = x.permute(1, 0, 2).reshape(len(self.voxel_index), b * t)
+            out = torch.sparse.mm(self._torch_matrix(volumes.device), x)
+            out = out.reshape(self.n_regions, b, t).permute(1, 2, 0)
+        else:
+            x = np.asarray(volumes).reshape(b, -1, t)[:, self.voxel_index, :]
+            x = x.astype(np.float32, copy=False).transpose(1, 0, 2).reshape(-1, b * t)
+            out = np.asarray(self.matrix @ x)
+            out = out.reshape(self.n_regions, b, t).transpose(1, 2, 0)
+
+        return out[0] if single else out
@@ -0,0 +1,283 @@
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+import torch
+from torchvision import transforms
+
+from .crop import BrainCrop, load_mask, nonzero_mask, resize_mask
+from .nifti_window import NiftiScans
+from .preprocessing import iter_chunks, load_and_process_data
+from .shards import MANIFEST_NAME
+from .shared import load_npy
+from .transforms import NormalizeByRegion, NormalizeResize3D, Resize3D, apply_in_chunks
+
+CACHE_VERSION = 1
+SPLITS = ("train", "val", "test")
+# Config fields that change the processed splits (missing ones hash as None)
+KEY_FIELDS = (
+    "BASE_DATA_PATH",
+    "SHARDS_DIR",
+    "SEED",
+    "VAL_SPLIT",
+    "TEST_SPLIT",
+    "WINDOW_SIZE",
+    "REMOVE_TOP_K_STD",
+    "QC_METRIC",
+    "RESIZE_FACTOR",
+    "DET_TRANSFORM_MODE",
+    "BRAIN_CROP",
+    "BRAIN_MASK_PATH",
+    "PRUNE_BACKGROUND_PATCHES",
+    "DENOISE",
+)
+DET_TRANSFORM_MODES = ("precompute", "batch", "device")
+SMALL_FILE_BYTES = 16 * 1024 * 1024
+
+
+def _file_fingerprint(path):
+    """Content hash for small files (manifests, JSON), size and mtime for large tensors."""
+    if not os.path.exists(path):
+        return None
+    st = os.stat(path)
+    if st.st_size > SMALL_FILE_BYTES:
+        return [st.st_size, st.st_mtime_ns]
+    with open(path, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def input_fingerprint(config):
+    """Fingerprints of every input file `load_and_process_data` may read."""
+    base = config.BASE_DATA_PATH
+    paths = [
+        f"{base}/index_to_name.json",
+        f"{base}/imageID_to_labels.json",
+        f"{base}/data/all_4d_downsampled.npy",
+        f"{base}/data/all_4d_downsampled.pt",
+        f"{base}/data/all_4d_downsampled.json",
+        f"{base}/data/time_regions_tensor_not_normalized_schaefer.npy",
+        f"{base}/data/time_regions_tensor_not_normalized_schaefer.pt",
+    ]
+    shards_dir = getattr(config, "SHARDS_DIR", None)
+    if shards_dir:
+        paths.append(os.path.join(shards_dir, MANIFEST_NAME))
+    return {p: _file_fingerprint(p) for p in paths}
+
+
+def key_config(config):
+    """The config values a cache entry depends on."""
+    values = {name: getattr(config, name, None) for name in KEY_FIELDS}
+    if values["BRAIN_CROP"]:
+        # The crop is aligned to the patch grid
+        values["PATCH_SIZE"] = list(config.PATCH_SIZE)
+    return values
+
+
+def cache_key(config):
+    """Hash of the preprocessing-relevant config fields and of the input manifest/tensors."""
+    payload = {
+        "version": CACHE_VERSION,
+        "config": key_config(config),
+        "inputs": input_fingerprint(config),
+    }
+    return hashlib.sha1(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+
+def det_transform_mode(config):
+    """
+    Where the deterministic scan transform runs.
+
+    "precompute" applies it to the whole splits up front; "batch" defers it to
+    each collated batch in the DataLoader; "device" defers it to each batch
+    after it was moved to the training device.
+    """
+    mode = getattr(config, "DET_TRANSFORM_MODE", "precompute")
+    if mode not in DET_TRANSFORM_MODES:
+        raise ValueError(f"Unknown DET_TRANSFORM_MODE {mode!r}, must be one of {DET_TRANSFORM_MODES}")
+    return mode
+
+
+def _resize(config):
+    return Resize3D(scale_factor=getattr(config, "RESIZE_FACTOR", 0.7), align_corners=False)
+
+
+def batch_det_transform(config, scan_norm, crop=None):
+    """Scan normalization, resize and brain crop as one batched operation, for the deferred modes."""
+    return NormalizeResize3D(scan_norm, _resize(config), crop=crop)
+
+
+def brain_crop(config, all_data_4d):
+    """
+    `BrainCrop` of the resized grid and brain mask of the model input grid.
+
+    The brain mask is read from ``config.BRAIN_MASK_PATH`` (on the stored grid)
+    when set, and otherwise taken as the voxels that are nonzero in any scan.
+
+    Returns:
+        tuple: (crop, mask), where crop is None unless ``config.BRAIN_CROP`` and
+        mask ([H', W', D'] bool, resized and cropped) is None unless
+        ``config.PRUNE_BACKGROUND_PATCHES``.
+    """
+    use_crop = getattr(config, "BRAIN_CROP", False)
+    prune = getattr(config, "PRUNE_BACKGROUND_PATCHES", False)
+    if not (use_crop or prune):
+        return None, None
+    mask_path = getattr(config, "BRAIN_MASK_PATH", None)
+    if mask_path:
+        mask = load_mask(mask_path)
+    elif isinstance(all_data_4d, NiftiScans):
+        mask = all_data_4d.nonzero_mask()  # cached per file
+    else:
+        mask = nonzero_mask(iter_chunks(all_data_4d))
+    mask = resize_mask(mask, _resize(config))
+    crop = None
+    if use_crop:
+        crop = BrainCrop.from_mask(mask, config.PATCH_SIZE)
+        print(crop.summary())
+        mask = crop.crop_mask(mask)
+    return crop, (mask if prune else None)
+
+
+class PreprocessCache:
+    """
+    On-disk processed splits for one cache key.
+
+    Layout of ``<root>/<key>/``: ``{split}_scans.npy`` (normalized and resized
+    scans, or raw ones when the scan transform is deferred), ``{split}_regions.npy`` (normalized atlas series), ``{split}_info.json``,
+    ``imageID_to_labels.json``, ``scan_norm.pt`` / ``region_norm.pt``,
+    ``crop.json`` (with ``BRAIN_CROP``, also recorded in ``meta.json``, so
+    outputs can be mapped back with `BrainCrop.uncrop`), ``brain_mask.npy``
+    (with ``PRUNE_BACKGROUND_PATCHES``) and ``meta.json``. Entries are built in a temporary directory and renamed into
+    place, so a partially written cache is never picked up.
+    """
+
+    def __init__(self, root, key):
+        self.root = root
+        self.key = key
+        self.path = os.path.join(root, key)
+        self.build_path = self.path + ".tmp"
+
+    def complete(self):
+        return os.path.exists(os.path.join(self.path, "meta.json"))
+
+    def begin(self):
+        shutil.rmtree(self.build_path, ignore_errors=True)
+        os.makedirs(self.build_path)
+        return self.build_path
+
+    def commit(self, infos, imageID_to_labels, scan_norm, region_norm, meta, crop=None, brain_mask=None):
+        for name, info in infos.items():
+            with open(os.path.join(self.build_path, f"{name}_info.json"), "w") as f:
+                json.dump(info, f)
+        with open(os.path.join(self.build_path, "imageID_to_labels.json"), "w") as f:
+            json.dump(imageID_to_labels, f)
+        scan_norm.save(os.path.join(self.build_path, "scan_norm.pt"))
+        region_norm.save(os.path.join(self.build_path, "region_norm.pt"))
+        if crop is not None:
+            crop.save(os.path.join(self.build_path, "crop.json"))
+        if brain_mask is not None:
+            np.save(os.path.join(self.build_path, "brain_mask.npy"), brain_mask.numpy())
+        with open(os.path.join(self.build_path, "meta.json"), "w") as f:
+            json.dump(meta, f, indent=1, default=str)
+        shutil.rmtree(self.path, ignore_errors=True)
+        os.replace(self.build_path, self.path)
+
+    def load(self):
+        """Memory-mapped splits, labels, normalizers and crop, as returned by `load_processed_splits`."""
+        splits = {}
+        for name in SPLITS:
+            scans = load_npy(os.path.join(self.path, f"{name}_scans.npy"))
+            regions = load_npy(os.path.join(self.path, f"{name}_regions.npy"))
+            with open(os.path.join(self.path, f"{name}_info.json")) as f:
+                info = {int(k): v for k, v in json.load(f).items()}
+            splits[name] = (scans, regions, info)
+        with open(os.path.join(self.path, "imageID_to_labels.json")) as f:
+            imageID_to_labels = json.load(f)
+        scan_norm = NormalizeByRegion.load(os.path.join(self.path, "scan_norm.pt"))
+        region_norm = NormalizeByRegion.load(os.path.join(self.path, "region_norm.pt"))
+        crop_path = os.path.join(self.path, "crop.json")
+        crop = BrainCrop.load(crop_path) if os.path.exists(crop_path) else None
+        mask_path = os.path.join(self.path, "brain_mask.npy")
+        brain_mask = torch.from_numpy(np.load(mask_path)) if os.path.exists(mask_path) else None
+        return splits, imageID_to_labels, (scan_norm, region_norm), (crop, brain_mask)
+
+
+def load_processed_splits(config):
+    """
+    Per-scan splits with the deterministic transforms already applied.
+
+    When ``config.DET_TRANSFORM_MODE`` defers the scan transform (see
+    `det_transform_mode`), scans are returned untransformed, without a copy
+    unless they are written to the cache; the atlas series are still normalized.
+    With ``config.LOWRANK_DIR`` the scans are lazy `LowRankScans`, with
+    ``config.STREAM_SHARDS`` lazy `ShardScans` and with ``config.NIFTI_DIR``
+    lazy `NiftiScans`; nothing is cached then.
+    With ``config.PREPROCESS_CACHE_DIR`` set, a cache entry matching `cache_key`
+    is opened memory-mapped and the whole of `load_and_process_data` is skipped;
+    otherwise the splits are processed once and written there as they are transformed.
+
+    Returns:
+        tuple: ({split: (scans [N, H', W', D', T], regions [N, R, T], index_to_info)},
+        imageID_to_labels, (scan_norm, region_norm), (crop, brain_mask)), where
+        crop is the `BrainCrop` included in the scan transform and brain_mask the
+        mask of the transformed grid (see `brain_crop`).
+    """
+    root = getattr(config, "PREPROCESS_CACHE_DIR", None)
+    lazy = [name for name in ("LOWRANK_DIR", "STREAM_SHARDS", "NIFTI_DIR") if getattr(config, name, None)]
+    if lazy:
+        # Factorized, streamed or NIfTI scans are read per window, never materialized (or cached) densely
+        if det_transform_mode(config) == "precompute":
+            raise ValueError(f"{lazy[0]} needs DET_TRANSFORM_MODE 'batch' or 'device'.")
+        root = None
+    cache = PreprocessCache(root, cache_key(config)) if root else None
+    if cache is not None and cache.complete():
+        print(f"Using preprocessed splits from {cache.path}")
+        return cache.load()
+
+    train_set, val_set, test_set, imageID_to_labels, (all_data_4d, _), (scan_norm, region_norm) = (
+        load_and_process_data(config)
+    )
+    crop, brain_mask = brain_crop(config, all_data_4d)
+    del all_data_4d
+    det_transform = None
+    if det_transform_mode(config) == "precompute":
+        det_transform = transforms.Compose(
+            [scan_norm, _resize(config)] + ([crop] if crop is not None else [])
+        )
+    recon_transform = transforms.Compose([region_norm])
+
+    build_dir = cache.begin() if cache is not None else None
+    splits = {}
+    for name, (scans, regions, info) in zip(SPLITS, (train_set, val_set, test_set)):
+        if det_transform is not None or build_dir is not None:
+            scans = apply_in_chunks(
+                det_transform or (lambda chunk: chunk), scans,
+                out_path=os.path.join(build_dir, f"{name}_scans.npy") if build_dir else None,
+            )
+        splits[name] = (
+            scans,
+            apply_in_chunks(
+                recon_transform, regions,
+                out_path=os.path.join(build_dir, f"{name}_regions.npy") if build_dir else None,
+            ),
+            info,
+        )
+
+    if cache is None:
+        return splits, imageID_to_labels, (scan_norm, region_norm), (crop, brain_mask)
+
+    meta = {
+        "key": cache.key,
+        "config": key_config(config),
+        "inputs": input_fingerprint(config),
+        "crop": crop.to_dict() if crop is not None else None,
+    }
+    del splits  # release the build-directory mappings before the rename
+    cache.commit(
+        {name: info for name, (_, _, info) in zip(SPLITS, (train_set, val_set, test_set))},
+        imageID_to_labels, scan_norm, region_norm, meta, crop, brain_mask,
+    )
+    print(f"Wrote preprocessed splits to {cache.path}")
+    return cache.load()
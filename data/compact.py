@@ -0,0 +1,132 @@
+import numpy as np
+import torch
+import torch.nn as nn
+
+COMPACT_DTYPES = {
+    "float16": torch.float16,
+    "bfloat16": torch.bfloat16,
+    "int16": torch.int16,
+}
+INT16_MAX = 32767
+
+
+class CompactCodec:
+    """
+    Encodes float32 scans into a compact storage dtype and back.
+
+    float16 / bfloat16 are plain casts. int16 uses one scale and offset per
+    region (every spatial position), shared across samples and time, so the
+    overhead is a single [spatial...] pair of tensors for the whole dataset.
+    """
+
+    def __init__(self, dtype):
+        if dtype not in COMPACT_DTYPES:
+            raise ValueError(
+                f"Unknown storage dtype {dtype}. Must be one of {list(COMPACT_DTYPES)}"
+            )
+        self.dtype = dtype
+        self.scale = None
+        self.offset = None
+
+    def fit(self, tensor):
+        """
+        Fit the int16 range on the full dataset tensor.
+
+        Args:
+            tensor: Dataset tensor of shape [samples, spatial_1, ..., spatial_k, time]
+        """
+        if self.dtype == "int16":
+            lo = tensor.amin(dim=(0, -1)).float()
+            hi = tensor.amax(dim=(0, -1)).float()
+            self.offset = (hi + lo) / 2
+            self.scale = torch.clamp((hi - lo) / (2 * INT16_MAX), min=1e-12)
+        return self
+
+    def encode(self, tensor):
+        if self.dtype != "int16":
+            return tensor.to(COMPACT_DTYPES[self.dtype])
+        if self.scale is None:
+            raise RuntimeError("CompactCodec(int16) must be fit before encoding.")
+        scale, offset = self.scale.unsqueeze(-1), self.offset.unsqueeze(-1)
+        q = torch.round((tensor.float() - offset) / scale)
+        return q.clamp_(-INT16_MAX, INT16_MAX).to(torch.int16)
+
+    def decode(self, tensor):
+        """Dequantize a sample or batch [..., spatial_1, ..., spatial_k, time] to float32."""
+        if self.dtype != "int16":
+            return tensor.float()
+        scale = self.scale.to(tensor.device).unsqueeze(-1)
+        offset = self.offset.to(tensor.device).unsqueeze(-1)
+        return tensor.float() * scale + offset
+
+    def relative_error(self, tensor):
+        """Relative L2 error of an encode/decode round trip."""
+        decoded = self.decode(self.encode(tensor))
+        return (torch.linalg.vector_norm(decoded - tensor) / torch.linalg.vector_norm(tensor)).item()
+
+
+def encode_array(array, dtype):
+    """
+    Per-scan on-disk encoding of a [H, W, D, T] array.
+
+    Returns the payload (NumPy, bfloat16 stored as its raw uint16 bits) and,
+    for int16, the per-voxel scale and offset over time.
+    """
+    if dtype == "float16":
+        return array.astype(np.float16), None, None
+    if dtype == "bfloat16":
+        bits = torch.from_numpy(np.ascontiguousarray(array, dtype=np.float32)).to(torch.bfloat16)
+        return bits.view(torch.int16).numpy().view(np.uint16), None, None
+    if dtype == "int16":
+        codec = CompactCodec("int16").fit(torch.from_numpy(np.asarray(array, dtype=np.float32))[None])
+        payload = codec.encode(torch.from_numpy(np.asarray(array, dtype=np.float32)))
+        return payload.numpy(), codec.scale.numpy(), codec.offset.numpy()
+    raise ValueError(f"Unknown storage dtype {dtype}")
+
+
+def decode_array(payload, dtype, scale=None, offset=None):
+    """Inverse of `encode_array`, returning float32."""
+    if dtype == "float16":
+        return np.asarray(payload, dtype=np.float32)
+    if dtype == "bfloat16":
+        bits = torch.from_numpy(np.ascontiguousarray(payload).view(np.int16))
+        return bits.view(torch.bfloat16).float().numpy()
+    if dtype == "int16":
+        return np.asarray(payload, dtype=np.float32) * scale[..., None] + offset[..., None]
+    return np.asarray(payload, dtype=np.float32)
+
+
+def compare_reconstruction_loss(model, data, custom_recon, dtype, device="cpu", batch_size=8):
+    """
+    Accuracy check of compact storage against the float32 baseline.
+
+    Runs the model on float32 inputs and on encode/decode round-tripped inputs
+    and compares the atlas reconstruction loss.
+
+    Args:
+        model (torch.nn.Module): Trained TransformerAutoEncoder.
+        data (torch.Tensor): Transformed input windows [N, H, W, D, T].
+        custom_recon (torch.Tensor): Normalized atlas targets [N, regions, T].
+        dtype (str): One of COMPACT_DTYPES.
+    Returns:
+        dict: float32 loss, compact loss, their relative difference and the input round-trip error.
+    """
+    codec = CompactCodec(dtype).fit(data)
+    loss_fn = nn.MSELoss(reduction="sum")
+    model.eval()
+    totals = {"float32": 0.0, dtype: 0.0}
+    with torch.no_grad():
+        for start in range(0, len(data), batch_size):
+            x = data[start : start + batch_size]
+            target = custom_recon[start : start + batch_size].to(device)
+            for name, inputs in (("float32", x), (dtype, codec.decode(codec.encode(x)))):
+                recon = model(inputs.to(device))["Reconstruction"]
+                totals[name] += loss_fn(recon, target).item()
+    n = custom_recon.numel()
+    baseline, compact = totals["float32"] / n, totals[dtype] / n
+    return {
+        "float32_loss": baseline,
+        f"{dtype}_loss": compact,
+        "relative_loss_change": (compact - baseline) / baseline,
+        "input_relative_error": codec.relative_error(data),
+    }
@@ -1,47 +1,98 @@
+"""
+Convert the HCP scans into batched tensors, incrementally.
+
+Uses package-relative imports, so run it as a module from the repository parent:
+    python -m code_iclr.data.convert_hcp_into_tensors
+"""
 import nibabel as nib
 import torch
-import glob
 import os
 import gc
 
+from .ingest_manifest import IngestManifest, default_manifest_path
+
 BATCH_SIZE = 70
 HCP_DIR = "/sci/labs/arieljaffe/dan.abergel1/HCP_data"
 OUT_DIR = "/sci/labs/arieljaffe/dan.abergel1/HCP_tensors/"
+def load_scan(file_path):
+    """Load a NIfTI scan as a float32 tensor, releasing the image data."""
+    nii_image = nib.load(file_path)
+    image_tensor = torch.tensor(nii_image.get_fdata(), dtype=torch.float32)
+    nii_image.uncache()
+    del nii_image
+    gc.collect()
+    return image_tensor
+
+def rewrite_rows(batch_filename, rows):
+    """
+    Overwrite rows of an existing batch file with the current scans of their subjects.
+
+    The batch is memory-mapped copy-on-write, so only the replaced rows are held in
+    RAM; it is saved to a temporary file that then replaces the original.
+
+    Args:
+        batch_filename (str): Path of the batched_tensor_{k}.pt file.
+        rows (list): (row, file_path) pairs to replace.
+    """
+    batch_tensor = torch.load(batch_filename, map_location="cpu", mmap=True)
+    for row, file_path in rows:
+        image_tensor = load_scan(file_path)
+        if image_tensor.shape != batch_tensor.shape[1:]:
+            raise ValueError(
+                f"{file_path} has shape {tuple(image_tensor.shape)}, "
+                f"but {batch_filename} holds scans of shape {tuple(batch_tensor.shape[1:])}."
+            )
+        batch_tensor[row] = image_tensor
+        del image_tensor
+    torch.save(batch_tensor, batch_filename + ".tmp")
+    del batch_tensor
+    os.replace(batch_filename + ".tmp", batch_filename)
+
 def convert_hcp_into_tensors(dir_path):
     # Ensure the provided directory path exists
     assert os.path.exists(dir_path) , f"The path {dir_path} does not exist."
 
     print(f"Starting conversion process in directory: {dir_path}")
 
-    # Find all .nii.gz files in the nested directory structure matching the pattern
-    nii_files_pathes = glob.glob(f"{dir_path}/subject*/*/*/*/*.nii.gz")
-    print(f"Number of .nii.gz files found: {len(nii_files_pathes)}")
+    # Register every subject scan; only new or changed ones still need converting
+    manifest = IngestManifest(default_manifest_path(dir_path))
+    manifest.register_all(dir_path)
+    pending = manifest.pending("raw_tensor")
+
+    # A changed subject is rewritten in the row it already has, so concatenating the
+    # batches never yields a stale copy of it; only new subjects go to new batches
+    converted = manifest.artifacts("raw_tensor")
+    stale = {}
+    for s in list(pending):
+        location, row = converted.get(s["subject_id"], (None, None))
+        if location is not None and os.path.exists(os.path.join(OUT_DIR, location)):
+            stale.setdefault(location, []).append((s, row))
+            pending.remove(s)
+    for location, entries in stale.items():
+        print(f"Rewriting {len(entries)} changed scans in {location}")
+        rewrite_rows(os.path.join(OUT_DIR, location), [(row, s["path"]) for s, row in entries])
+        for s, row in entries:
+            manifest.record(s["subject_id"], "raw_tensor", location=location, row=row)
+
+    nii_files_pathes = [s["path"] for s in pending]
+    print(f"Number of .nii.gz files to convert: {len(nii_files_pathes)}")
 
     tensor_batch = []  # List to hold tensors for batching
-    batch_idx = 0      # Index to keep track of batch files saved
-
-    # Iterate over all found files
+    batch_subjects = []  # Subject ids of the tensors in the current batch
+    # New batches are appended after the ones written by previous runs
+    existing = [
+        int(f[len("batched_tensor_"):-len(".pt")])
+        for f in os.listdir(OUT_DIR) if f.startswith("batched_tensor_") and f.endswith(".pt")
+    ]
+    batch_idx = max(existing, default=-1) + 1
+
+    # Iterate over all pending files
     for i, file_path in enumerate(nii_files_pathes):
         print(f"Processing file {i+1}/{len(nii_files_pathes)}: {file_path}")
 
-        # Load the NIfTI image
-        nii_image = nib.load(file_path)
-
-        # Convert the image data to a PyTorch tensor of type float32
-        image_tensor = torch.tensor(nii_image.get_fdata(), dtype=torch.float32)
-
-        # Free up memory by deleting the loaded image object
-        nii_image.uncache()
-        del nii_image
-
-        # Append the tensor to the current batch list
-        tensor_batch.append(image_tensor)
-
-        # Delete the tensor variable to free memory (optional cleanup)
-        del image_tensor
-
-        # Call to garbage collector to cleanup the disk
-        gc.collect()
+        # Load the NIfTI image as a float32 tensor and append it to the current batch list
+        tensor_batch.append(load_scan(file_path))
+        batch_subjects.append(pending[i]["subject_id"])
 
         # Check if the batch has reached the specified size or if this is the last file
         if len(tensor_batch) == BATCH_SIZE or i == len(nii_files_pathes) - 1:
@@ -49,10 +100,12 @@ def convert_hcp_into_tensors(dir_path):
             batch_tensor = torch.stack(tensor_batch)
 
             # Define the filename for saving the batch tensor
-            batch_filename = f'batched_tensor_{batch_idx}.pt'
+            batch_filename = os.path.join(OUT_DIR, f'batched_tensor_{batch_idx}.pt')
 
             # Save the tensor batch to disk
             torch.save(batch_tensor, batch_filename)
+            for row, subject_id in enumerate(batch_subjects):
+                manifest.record(subject_id, "raw_tensor", location=os.path.basename(batch_filename), row=row)
 
             print(f"Saved batch {batch_idx} with {len(tensor_batch)} tensors to {batch_filename}")
 
@@ -61,7 +114,9 @@ def convert_hcp_into_tensors(dir_path):
 
             # Clear the batch list for the next batch of tensors
             tensor_batch = []
+            batch_subjects = []
 
+    manifest.close()
     print("Conversion process completed.")
 
 if __name__ == "__main__":
@@ -0,0 +1,154 @@
+import json
+import math
+
+import numpy as np
+import torch
+
+
+def nonzero_mask(chunks):
+    """
+    Voxels that are nonzero in any scan at any time point.
+
+    Args:
+        chunks: Iterable of [n, H, W, D, T] tensors (e.g. `preprocessing.iter_chunks`).
+    Returns:
+        torch.Tensor: Boolean mask of shape [H, W, D].
+    """
+    mask = None
+    for chunk in chunks:
+        chunk_mask = (chunk != 0).any(dim=-1).any(dim=0)
+        mask = chunk_mask if mask is None else mask | chunk_mask
+    if mask is None:
+        raise ValueError("nonzero_mask received no chunks.")
+    return mask
+
+
+def load_mask(path):
+    """Boolean [H, W, D] brain mask from a .npy or NIfTI file."""
+    if path.endswith(".npy"):
+        mask = np.load(path)
+    else:
+        import nibabel as nib
+
+        mask = np.asanyarray(nib.load(path).dataobj)
+    return torch.from_numpy(np.asarray(mask) != 0)
+
+
+def resize_mask(mask, resize):
+    """Map a mask through `Resize3D`: output voxels that draw on any masked input voxel."""
+    return resize(mask.float()[None, ..., None])[0, ..., 0] > 0
+
+
+def patch_mask(mask, patch_size):
+    """
+    Patches of the `TransformerAutoEncoder.patchify` grid that contain any brain voxel.
+
+    Args:
+        mask: Boolean [H, W, D] brain mask on the model input grid.
+        patch_size (tuple): Spatial patch size.
+    Returns:
+        torch.Tensor: Boolean mask over the (padded) patch grid, flattened in
+        `patchify` order, of length `compute_num_patches_3d(mask.shape, patch_size)`.
+    """
+    pads = [(p - s % p) % p for s, p in zip(mask.shape, patch_size)]
+    mask = torch.nn.functional.pad(mask.float(), (0, pads[2], 0, pads[1], 0, pads[0]))
+    for axis, p in enumerate(patch_size):
+        mask = mask.unfold(axis, p, p)
+    return mask.flatten(start_dim=3).amax(dim=-1).flatten() > 0
+
+
+class BrainCrop:
+    """
+    Fixed spatial crop of [..., H, W, D, T] tensors to the brain bounding box.
+
+    The box is widened to whole multiples of the patch size (centered and kept
+    inside the volume where possible), so `TransformerAutoEncoder.patchify`
+    needs little or no padding and no patch is spent on background alone.
+    `uncrop` maps cropped outputs back onto the full grid.
+    """
+
+    def __init__(self, full_shape, start, stop, patch_size=None):
+        self.full_shape = tuple(int(s) for s in full_shape)
+        self.start = tuple(int(s) for s in start)
+        self.stop = tuple(int(s) for s in stop)
+        self.patch_size = tuple(patch_size) if patch_size is not None else None
+
+    @classmethod
+    def from_mask(cls, mask, patch_size):
+        """
+        Args:
+            mask: Boolean [H, W, D] brain mask on the grid the crop applies to.
+            patch_size (tuple): Spatial patch size the box is aligned to.
+        """
+        full_shape = tuple(mask.shape)
+        if not mask.any():
+            return cls(full_shape, (0, 0, 0), full_shape, patch_size)
+        start, stop = [], []
+        for axis, (size, patch) in enumerate(zip(full_shape, patch_size)):
+            other = tuple(a for a in range(3) if a != axis)
+            occupied = torch.nonzero(mask.any(dim=other[1]).any(dim=other[0])).flatten()
+            lo, hi = int(occupied[0]), int(occupied[-1]) + 1
+            extent = math.ceil((hi - lo) / patch) * patch
+            lo = min(max(lo - (extent - (hi - lo)) // 2, 0), max(size - extent, 0))
+            start.append(lo)
+            stop.append(min(lo + extent, size))
+        return cls(full_shape, start, stop, patch_size)
+
+    @property
+    def shape(self):
+        return tuple(b - a for a, b in zip(self.start, self.stop))
+
+    def output_shape(self, shape):
+        """Shape of a cropped [..., H, W, D, T] tensor."""
+        shape = tuple(shape)
+        return shape[:-4] + self.shape + shape[-1:]
+
+    def num_patches(self, cropped=True):
+        """Spatial patches `patchify` makes of the cropped (or full) grid, padding included."""
+        shape = self.shape if cropped else self.full_shape
+        return int(np.prod([math.ceil(s / p) for s, p in zip(shape, self.patch_size)]))
+
+    def summary(self):
+        before, after = self.num_patches(cropped=False), self.num_patches()
+        return (
+            f"Brain crop {self.full_shape} -> {self.shape} voxels, "
+            f"spatial patches {before} -> {after} ({1 - after / before:.0%} fewer)"
+        )
+
+    def crop_mask(self, mask):
+        """Crop an [H, W, D] mask of the full grid."""
+        return self(mask[..., None])[..., 0]
+
+    def __call__(self, tensor):
+        # Assumes shape [..., H, W, D, T]; returns a view
+        (h0, w0, d0), (h1, w1, d1) = self.start, self.stop
+        return tensor[..., h0:h1, w0:w1, d0:d1, :]
+
+    def uncrop(self, tensor, fill=0.0):
+        """Place a cropped [..., H', W', D', T] tensor back into the full grid."""
+        out = tensor.new_full(tensor.shape[:-4] + self.full_shape + tensor.shape[-1:], fill)
+        self(out).copy_(tensor)
+        return out
+
+    def to_dict(self):
+        return {
+            "full_shape": list(self.full_shape),
+            "start": list(self.start),
+            "stop": list(self.stop),
+            "patch_size": list(self.patch_size) if self.patch_size is not None else None,
+            "num_patches_full": self.num_patches(cropped=False) if self.patch_size else None,
+            "num_patches": self.num_patches() if self.patch_size else None,
+        }
+
+    @classmethod
+    def from_dict(cls, state):
+        return cls(state["full_shape"], state["start"], state["stop"], state.get("patch_size"))
+
+    def save(self, path):
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=1)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls.from_dict(json.load(f))
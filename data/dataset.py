@@ -1,6 +1,11 @@
 import torch
 from torch.utils.data import Dataset
 
+from .compact import CompactCodec
+from .label_table import LabelTable
+from .shared import MappedRows, pack, share, unpack
+from .transforms import apply_in_chunks
+
 
 class fmri_corr_dataset(Dataset):
     def __init__(
@@ -13,11 +18,21 @@ class fmri_corr_dataset(Dataset):
         custom_recon=None,
         recon_transform=None,
         aug_probability=0.0,
+        storage_dtype=None,
+        batch_transform=None,
     ):
         self.det_transform = det_transform
         self.data = self.det_transform(data) if self.det_transform else data
+        # Deterministic transform deferred to each collated batch (see `collate_fn`)
+        self.batch_transform = batch_transform
+        # Optional compact in-memory storage, dequantized in `collate_fn`
+        self.codec = None
+        if storage_dtype is not None:
+            self.codec = CompactCodec(storage_dtype).fit(self.data)
+            self.data = self.codec.encode(self.data)
         self.index_to_info = index_to_info
         self.imageID_to_labels = imageID_to_labels
+        self.labels = compile_labels(imageID_to_labels, index_to_info)
         self.rnd_transform = rnd_transform
         self.custom_recon = (
             recon_transform(custom_recon)
@@ -29,21 +44,258 @@ class fmri_corr_dataset(Dataset):
     def __len__(self):
         return len(self.data)
 
+    # Large tensors handed to DataLoader workers through shared memory or their .npy map
+    _shared_fields = ("data", "custom_recon")
+
+    def share_memory(self):
+        """
+        Prepare for multi-worker loading: in-memory tensors move to shared
+        memory once, so workers attach to them instead of each getting a copy;
+        memory-mapped ones (`shared.load_npy`) are reopened by path.
+        """
+        for name in self._shared_fields:
+            share(getattr(self, name))
+        if self.codec is not None and self.codec.scale is not None:
+            share(self.codec.scale)
+            share(self.codec.offset)
+        return self
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for name in self._shared_fields:
+            state[name] = pack(state[name])
+        return state
+
+    def __setstate__(self, state):
+        for name in self._shared_fields:
+            state[name] = unpack(state[name])
+        self.__dict__.update(state)
+
     def __getitem__(self, idx):
         sample_x = self.data[idx]
-        if self.rnd_transform and torch.rand(1).item() < self.aug_probability:
-            sample_x = self.rnd_transform(sample_x)
+        if (
+            not self._augment_batches
+            and self.rnd_transform
+            and torch.rand(1).item() < self.aug_probability
+        ):
+            sample_x = self.rnd_transform(sample_x[None])[0]
+
+        recon = self.custom_recon[idx] if self.custom_recon is not None else None
 
-        image_id = self.index_to_info[idx]["image_id"]
-        labels_dict = self.imageID_to_labels.get(image_id, {})
-        labels_dict["scan_id"] = image_id
+        # Labels are looked up per batch from `self.labels` (see `collate_fn`)
+        return sample_x, idx, recon
 
+    def _gather(self, indices):
+        """(data [B, ...], label rows [B], recon [B, ...] or None) of `indices`, one gather each."""
+        idx = torch.as_tensor(indices, dtype=torch.int64)
         recon = self.custom_recon[idx] if self.custom_recon is not None else None
+        return self.data[idx], idx, recon
+
+    def __getitems__(self, indices):
+        """
+        Whole batch of `indices` at once, as `collate_fn` returns it.
+
+        `DataLoader` calls this instead of `__getitem__` per sample, so the
+        samples are gathered in one indexing op and `collate_fn` passes the
+        result through.
+        """
+        data_batch, rows, custom_recon_batch = self._gather(indices)
+        return self._finish_batch(data_batch, self.labels.batch(rows), custom_recon_batch, augment=True)
+
+    @property
+    def _augment_batches(self):
+        # Random augmentation must follow decoding and the deferred deterministic transform
+        return self.codec is not None or self.batch_transform is not None
+
+    def _finish_batch(self, data_batch, batched_labels, custom_recon_batch, augment):
+        # Dequantize, apply `batch_transform` to the whole batch and, if `augment`,
+        # the random augmentation to the samples drawn by a per-sample mask
+        if self.codec is not None:
+            data_batch = self.codec.decode(data_batch)
+        if self.batch_transform is not None:
+            data_batch = self.batch_transform(data_batch)
+        if augment and self.rnd_transform and self.aug_probability > 0:
+            mask = torch.rand(len(data_batch)) < self.aug_probability
+            if mask.any():
+                data_batch[mask] = self.rnd_transform(data_batch[mask])
+        return data_batch, batched_labels, custom_recon_batch
+
+    def collate_fn(self, batch):
+        """
+        Pass through batches built by `__getitems__`. Per-sample items are
+        collated (labels by row from `self.labels`), then dequantized,
+        transformed and augmented as in `__getitems__`.
+        """
+        if isinstance(batch, tuple):
+            return batch
+        return self._finish_batch(*collate_fn_corr(batch, self.labels), augment=self._augment_batches)
+
 
-        return sample_x, labels_dict, recon
+class WindowedScanDataset(fmri_corr_dataset):
+    """
+    Time windows of whole scans, indexed lazily as (scan, window_offset).
 
+    Windows are slices of the per-scan tensor (which may be memory-mapped), so
+    memory stays at one copy of the data whatever the stride: no windowed
+    tensor and no per-window info dicts are built. `det_transform` is applied
+    once to the scans, in chunks of `transform_chunk_size` scans; it must act
+    on each time point independently (as the normalizers and Resize3D do).
+    Alternatively `batch_transform` applies it to every collated batch of
+    windows instead, so the scans are only held once, untransformed.
+    """
 
-def collate_fn_corr(batch):
+    def __init__(
+        self,
+        data,
+        index_to_info,
+        imageID_to_labels,
+        window_size,
+        stride=None,
+        random_crop=False,
+        det_transform=None,
+        rnd_transform=None,
+        custom_recon=None,
+        recon_transform=None,
+        aug_probability=0.0,
+        storage_dtype=None,
+        transform_chunk_size=16,
+        batch_transform=None,
+    ):
+        """
+        Args:
+            data: Scans of shape [N, H, W, D, T].
+            index_to_info (dict): Per-scan info, keyed by scan index.
+            imageID_to_labels (dict or LabelTable): Labels per image_id, or a
+                table already aligned to the scans.
+            window_size (int): Time points per window.
+            stride (int, optional): Step between window offsets; smaller than
+                `window_size` gives overlapping windows. Defaults to `window_size`.
+            random_crop (bool): Draw a random offset for every item instead of
+                the fixed grid (same number of items per epoch).
+            rnd_transform (callable, optional): Random augmentation, called on a
+                batch of windows [B, H, W, D, window_size] (the drawn ones).
+            custom_recon: Atlas time series of shape [N, regions, T].
+            batch_transform (callable, optional): Applied in `collate_fn` to each
+                [B, H, W, D, window_size] batch, e.g. `NormalizeResize3D`.
+        """
+        self.det_transform = det_transform
+        self.batch_transform = batch_transform
+        self.data = (
+            apply_in_chunks(det_transform, data, transform_chunk_size)
+            if det_transform is not None
+            else data
+        )
+        self.codec = None
+        if storage_dtype is not None:
+            if not isinstance(self.data, torch.Tensor):
+                # Compact storage is resident: read lazy scans in once, a chunk at a time
+                self.data = apply_in_chunks(lambda chunk: chunk, self.data, transform_chunk_size)
+            self.codec = CompactCodec(storage_dtype).fit(self.data)
+            self.data = self.codec.encode(self.data)
+        self.index_to_info = index_to_info
+        self.imageID_to_labels = imageID_to_labels
+        self.labels = compile_labels(imageID_to_labels, index_to_info)
+        self.rnd_transform = rnd_transform
+        self.custom_recon = (
+            apply_in_chunks(recon_transform, custom_recon, transform_chunk_size)
+            if recon_transform is not None and custom_recon is not None
+            else custom_recon
+        )
+        self.aug_probability = aug_probability
+
+        self.window_size = window_size
+        self.stride = stride or window_size
+        self.random_crop = random_crop
+        self.n_time = data.shape[-1]
+        if self.n_time < window_size:
+            raise ValueError(
+                f"Time dimension ({self.n_time}) is shorter than the window size ({window_size})."
+            )
+        self.windows_per_scan = (self.n_time - window_size) // self.stride + 1
+
+    def __len__(self):
+        return len(self.data) * self.windows_per_scan
+
+    def locate(self, idx):
+        """(scan index, window index, first time point) of item `idx`."""
+        scan, window = divmod(idx, self.windows_per_scan)
+        if self.random_crop:
+            t_start = int(torch.randint(0, self.n_time - self.window_size + 1, (1,)))
+        else:
+            t_start = window * self.stride
+        return scan, window, t_start
+
+    def locate_batch(self, indices):
+        """`locate` for a batch: (scan indices, window indices, first time points) tensors."""
+        idx = torch.as_tensor(indices, dtype=torch.int64)
+        scans, windows = idx // self.windows_per_scan, idx % self.windows_per_scan
+        if self.random_crop:
+            t_start = torch.randint(0, self.n_time - self.window_size + 1, (len(idx),))
+        else:
+            t_start = windows * self.stride
+        return scans, windows, t_start
+
+    def _windows(self, tensor, scans, t_start):
+        """Windows [B, ..., window_size] of `tensor` [N, ..., T] at (scans, t_start)."""
+        if isinstance(tensor, MappedRows):
+            tensor, scans = tensor.tensor, tensor.rows(scans)
+        if isinstance(tensor, torch.Tensor):
+            # [N, offsets, ..., window_size] view of every window: one advanced index
+            # (over its first two dims) gathers the batch
+            windows = tensor.unfold(-1, self.window_size, 1).movedim(-2, 1)
+            return windows[scans, t_start]
+        # Lazy views (shards, low-rank factors, NIfTI files) are read window by window
+        spans = zip(scans.tolist(), t_start.tolist())
+        return torch.stack([tensor[s, ..., t : t + self.window_size] for s, t in spans])
+
+    def _gather(self, indices):
+        scans, _, t_start = self.locate_batch(indices)
+        data = self._windows(self.data, scans, t_start)
+        recon = None
+        if self.custom_recon is not None:
+            recon = self._windows(self.custom_recon, scans, t_start)
+        return data, scans, recon
+
+    def window_info(self, idx):
+        """Info dict of item `idx`, as `TimeWindowSplitter.update_info_dict` would have built it."""
+        scan, window, _ = self.locate(idx)
+        info = dict(self.index_to_info[scan])
+        info["window_index"] = window
+        return info
+
+    def __getitem__(self, idx):
+        scan, _, t_start = self.locate(idx)
+        t_end = t_start + self.window_size
+        sample_x = self.data[scan, ..., t_start:t_end]
+        if (
+            not self._augment_batches
+            and self.rnd_transform
+            and torch.rand(1).item() < self.aug_probability
+        ):
+            sample_x = self.rnd_transform(sample_x[None])[0]
+
+        recon = (
+            self.custom_recon[scan, :, t_start:t_end]
+            if self.custom_recon is not None
+            else None
+        )
+
+        return sample_x, scan, recon
+
+
+def compile_labels(imageID_to_labels, index_to_info):
+    """`LabelTable` of the scans in `index_to_info` (a given table is used as is)."""
+    if isinstance(imageID_to_labels, LabelTable):
+        return imageID_to_labels
+    return LabelTable.from_infos(imageID_to_labels or {}, index_to_info)
+
+
+def collate_fn_corr(batch, labels=None):
+    """
+    Stack (sample, labels, recon) items. With a `LabelTable`, the second item
+    field is its row and labels are gathered once for the whole batch;
+    otherwise it is a per-sample labels dict.
+    """
     data_samples = [item[0] for item in batch]
     labels_dicts = [item[1] for item in batch]
     custom_recons = [item[2] for item in batch]
@@ -53,6 +305,9 @@ def collate_fn_corr(batch):
         torch.stack(custom_recons) if custom_recons[0] is not None else None
     )
 
+    if labels is not None:
+        return data_batch, labels.batch(labels_dicts), custom_recon_batch
+
     batched_labels = {}
     if labels_dicts:
         for key in labels_dicts[0].keys():
@@ -1,6 +1,18 @@
+"""
+Write index_to_name.json / imageID_to_labels.json from the ingestion manifest.
+
+Indices are the manifest's stable subject indices, so adding subjects appends
+new entries without shifting existing ones. They are not tensor rows (rejected
+subjects leave gaps): preprocessing matches entries to rows by subject_id
+through the row sidecar of the merged tensor or the shard manifest.
+Run as a module from the repository parent:
+    python -m code_iclr.data.helpers_da.create_json_metadata
+"""
 import os
 import json
 
+from ..ingest_manifest import IngestManifest, default_manifest_path
+
 # === Paths setup ===
 base_dir = "/sci/labs/arieljaffe/dan.abergel1/HCP_data"
 output_dir = os.path.join(base_dir, "model_input")
@@ -9,21 +21,21 @@ os.makedirs(output_dir, exist_ok=True)
 index_to_name_path = os.path.join(output_dir, "index_to_name.json")
 imageID_to_labels_path = os.path.join(output_dir, "imageID_to_labels.json")
 
-# === Initialize structures ===
+# === Initialize structures (labels already filled in are kept) ===
 index_to_name = {}
 imageID_to_labels = {}
-index = 0
+if os.path.exists(imageID_to_labels_path):
+    with open(imageID_to_labels_path, "r") as f:
+        imageID_to_labels = json.load(f)
 
-# === Loop over subjects ===
-for subject_dir in sorted(os.listdir(base_dir)):
-    subject_path = os.path.join(base_dir, subject_dir)
-    if not os.path.isdir(subject_path) or not subject_dir.startswith("subject_"):
-        continue
+manifest = IngestManifest(default_manifest_path(base_dir))
+manifest.register_all(base_dir)
+new_subjects = {s["subject_id"] for s in manifest.pending("metadata")}
 
-    subject_id = subject_dir.replace("subject_", "")
-    nii_path = os.path.join(
-        subject_path, "MNINonLinear", "Results", "rfMRI_REST1_LR", "rfMRI_REST1_LR.nii.gz"
-    )
+# === Loop over subjects, in stable-index order ===
+for subject in manifest.subjects():
+    subject_id = subject["subject_id"]
+    nii_path = subject["path"]
 
     if os.path.exists(nii_path):
         # Clean up filename (remove .nii or .nii.gz)
@@ -39,12 +51,13 @@ for subject_dir in sorted(os.listdir(base_dir)):
             "date": "N/A",
             "image_id": subject_id
         }
-        index_to_name[str(index)] = entry
+        index_to_name[str(subject["index"])] = entry
 
-        # Add empty label dictionary for this image_id
-        imageID_to_labels[subject_id] = {}
+        # Add empty label dictionary for a new image_id
+        imageID_to_labels.setdefault(subject_id, {})
 
-        index += 1
+        if subject_id in new_subjects:
+            manifest.record(subject_id, "metadata")
     else:
         print(f"⚠️ Missing file for {subject_id}")
 
@@ -59,4 +72,5 @@ with open(imageID_to_labels_path, "w") as f:
 # === Logs ===
 print(f"✅ index_to_name.json created at: {index_to_name_path}")
 print(f"✅ imageID_to_labels.json created at: {imageID_to_labels_path}")
-print(f"Total subjects indexed: {index}")
\ No newline at end of file
+print(f"Total subjects indexed: {len(index_to_name)} ({len(new_subjects)} new or changed)")
+manifest.close()
\ No newline at end of file
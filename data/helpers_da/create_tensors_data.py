@@ -1,8 +1,19 @@
-import os, gc, time, psutil, torch, nibabel as nib, numpy as np, shutil
+"""
+Build the 4D and Schaefer tensors from HCP_data.
+
+Uses package-relative imports, so run it as a module from the repository parent:
+    python -m code_iclr.data.helpers_da.create_tensors_data
+"""
+import os, gc, io, json, time, psutil, torch, nibabel as nib, numpy as np, shutil
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 from tqdm import tqdm
 from datetime import datetime
 from nilearn import datasets
-from nilearn.maskers import NiftiLabelsMasker
+
+from ..atlas import AtlasProjector
+from ..ingest_manifest import IngestManifest, default_manifest_path
+from ..qc import scan_qc
+from ..shards import ShardStore, write_shard
 
 # ==============================================================
 # CONFIGURATION
@@ -14,9 +25,17 @@ os.makedirs(output_dir, exist_ok=True)
 BATCH_SIZE = 100
 standardize = False
 EXPECTED_SHAPE = (46, 55, 46, 1200)
+N_ROIS = 200
+NUM_WORKERS = os.cpu_count() or 1   # > 1 enables process-parallel ingestion
+OUTPUT_FORMAT = "batches"   # "batches": merged all_4d tensors | "shards": one file per subject + manifest
+shards_dir = os.path.join(output_dir, "shards")
+manifest_path = default_manifest_path(base_dir)   # incremental state: only new/changed subjects are ingested
+SHARD_STORAGE_DTYPE = None   # None (float32) | "float16" | "bfloat16" | "int16" (per-voxel scale/offset)
+COPY_CHUNK_SIZE = 100   # time points per copy when compacting a finished batch
 
-final_4d_path = os.path.join(output_dir, "all_4d_downsampled.pt")
-final_schaefer_path = os.path.join(output_dir, "time_regions_tensor_not_normalized_schaefer.pt")
+# Final outputs are .npy so training can open them zero-copy with np.load(mmap_mode=...)
+final_4d_path = os.path.join(output_dir, "all_4d_downsampled.npy")
+final_schaefer_path = os.path.join(output_dir, "time_regions_tensor_not_normalized_schaefer.npy")
 
 # ==============================================================
 # HELPERS
@@ -28,62 +47,122 @@ def ram():
     m = psutil.virtual_memory()
     log(f"[RAM] used {m.used/1e9:.1f} GB / total {m.total/1e9:.1f} GB")
 
-def extract_schaefer(fmri, atlas):
-    masker = NiftiLabelsMasker(labels_img=atlas.maps, standardize=standardize, memory="nilearn_cache")
-    return masker.fit_transform(fmri)
+def build_projector(atlas_maps, subjects):
+    """Resample the atlas once onto the grid of the first available scan."""
+    for subj in subjects:
+        if os.path.exists(nii_path_for(subj)):
+            return AtlasProjector.from_atlas_img(atlas_maps, nii_path_for(subj))
+    raise FileNotFoundError(f"No scan found under {base_dir} to define the atlas grid.")
+
+def load_projector(subjects):
+    log(f"📚 Loading Schaefer atlas ({N_ROIS} ROIs)...")
+    atlas = datasets.fetch_atlas_schaefer_2018(n_rois=N_ROIS)
+    log("✅ Atlas loaded successfully.")
+    return build_projector(atlas.maps, subjects)
+
+def extract_schaefer(data, projector):
+    ts = projector.transform(data)
+    if standardize:
+        ts = (ts - ts.mean(axis=0)) / np.maximum(ts.std(axis=0), np.finfo(np.float32).eps)
+    return ts
+
+def save_batch(tensor, path, subject_ids=None, qc=None):
+    """Save a batch tensor plus a small JSON sidecar with its shape, dtype, row subjects and QC stats."""
+    torch.save(tensor, path)
+    meta = {"shape": list(tensor.shape), "dtype": str(tensor.dtype).replace("torch.", "")}
+    if subject_ids is not None:
+        meta["subject_ids"] = list(subject_ids)
+    if qc is not None:
+        meta["qc"] = list(qc)
+    with open(path[:-len(".pt")] + ".json", "w") as f:
+        json.dump(meta, f)
+
+def read_batch_meta(path):
+    """Sidecar of a batch file (shape, dtype and, if recorded, subject_ids / qc); older batches get a mmap'd load."""
+    sidecar = path[:-len(".pt")] + ".json"
+    if os.path.exists(sidecar):
+        with open(sidecar) as f:
+            return json.load(f)
+    t = torch.load(path, map_location="cpu", mmap=True)
+    return {"shape": list(t.shape), "dtype": str(t.dtype).replace("torch.", "")}
+
+def nii_path_for(subj):
+    return os.path.join(base_dir, subj, "MNINonLinear", "Results", "rfMRI_REST1_LR", "rfMRI_REST1_LR.nii.gz")
+
+def pending_subjects(manifest, kind):
+    """Register the scans under base_dir; return the subject dirs whose `kind` artifact is missing or stale."""
+    manifest.register_all(base_dir)
+    todo = ["subject_" + s["subject_id"] for s in manifest.pending(kind)]
+    log(f"✅ {len(manifest.subjects())} subjects in manifest, {len(todo)} new or changed ({kind})")
+    return todo
+
+def next_batch_num():
+    """Batches of new subjects are appended after the existing batch files."""
+    nums = [
+        int(f[len("batch_4d_"):-len(".pt")])
+        for f in os.listdir(output_dir) if f.startswith("batch_4d_") and f.endswith(".pt")
+    ]
+    return max(nums, default=0) + 1
 
 # ==============================================================
 # PHASE 1 — CREATE BATCHES
 # ==============================================================
 def create_batches():
-    log("📚 Loading Schaefer atlas (200 ROIs)...")
-    atlas = datasets.fetch_atlas_schaefer_2018(n_rois=200)
-    log("✅ Atlas loaded successfully.")
+    manifest = IngestManifest(manifest_path)
+    subjects = pending_subjects(manifest, "batch")
+    if not subjects:
+        log("✅ No new subjects, nothing to ingest.")
+        return
 
-    subjects = sorted([d for d in os.listdir(base_dir) if d.startswith("subject_")])
-    log(f"✅ Found {len(subjects)} subjects in {base_dir}")
+    projector = load_projector(subjects)
     ram()
 
     bad = []
     t0 = time.time()
+    first_batch = next_batch_num()
 
     for i in range(0, len(subjects), BATCH_SIZE):
         batch_subjects = subjects[i:i + BATCH_SIZE]
-        batch_num = i // BATCH_SIZE + 1
+        batch_num = first_batch + i // BATCH_SIZE
         log(f"\n🧠 Batch {batch_num} — subjects {i}-{i + len(batch_subjects) - 1}")
-        batch_4d, batch_schaefer = [], []
+        batch_4d, batch_schaefer, batch_sids, batch_qc = [], [], [], []
 
         for subj in tqdm(batch_subjects, desc=f"Loading batch {batch_num}", ncols=100):
             sid = subj.replace("subject_", "")
             subj_path = os.path.join(base_dir, subj)
-            nii_path = os.path.join(subj_path, "MNINonLinear", "Results", "rfMRI_REST1_LR", "rfMRI_REST1_LR.nii.gz")
+            nii_path = nii_path_for(subj)
 
             if not os.path.exists(nii_path):
                 log(f"⚠️ Subject {sid}: missing file, skipping.")
                 bad.append((sid, "missing"))
+                manifest.record(sid, "batch", error="missing")
                 continue
 
             try:
                 nii = nib.load(nii_path)
-                data = nii.get_fdata().astype(np.float32)
+                data = nii.get_fdata(dtype=np.float32)
 
                 if data.shape != EXPECTED_SHAPE:
                     log(f"⚠️ Subject {sid} has invalid shape {data.shape} — deleted from HCP_data.")
                     shutil.rmtree(subj_path, ignore_errors=True)
                     bad.append((sid, f"invalid shape {data.shape}"))
+                    manifest.record(sid, "batch", error=f"invalid shape {data.shape}")
                     continue
 
                 tensor = torch.from_numpy(data)
-                ts = extract_schaefer(nii, atlas)
+                ts = extract_schaefer(data, projector)
                 batch_4d.append(tensor)
                 batch_schaefer.append(torch.tensor(ts, dtype=torch.float32))
+                batch_sids.append(sid)
+                batch_qc.append(scan_qc(data))
+                manifest.record_qc(sid, batch_qc[-1])
 
                 del nii, data, ts, tensor
-                gc.collect()
 
             except Exception as e:
                 log(f"❌ Error loading {sid}: {e}")
                 bad.append((sid, str(e)))
+                manifest.record(sid, "batch", error=str(e))
                 continue
 
         ram()
@@ -96,8 +175,10 @@ def create_batches():
         b4_path = os.path.join(output_dir, f"batch_4d_{batch_num}.pt")
         bs_path = os.path.join(output_dir, f"batch_schaefer_{batch_num}.pt")
 
-        torch.save(torch.stack(batch_4d), b4_path)
-        torch.save(torch.stack(batch_schaefer), bs_path)
+        save_batch(torch.stack(batch_4d), b4_path, batch_sids, batch_qc)
+        save_batch(torch.stack(batch_schaefer), bs_path, batch_sids)
+        for row, sid in enumerate(batch_sids):
+            manifest.record(sid, "batch", location=os.path.basename(b4_path), row=row)
         log(f"✅ Saved batch files: {b4_path} and {bs_path}")
 
         del batch_4d, batch_schaefer
@@ -109,37 +190,398 @@ def create_batches():
         log(f"⚠️ Excluded or deleted {len(bad)} subjects.")
         for s, reason in bad[:5]:
             log(f"   - {s}: {reason}")
+    manifest.close()
+
+# ==============================================================
+# PHASE 1 (PARALLEL) — WORKERS WRITE INTO PREALLOCATED OUTPUTS
+# ==============================================================
+_worker_projector = None
+
+def _init_worker(projector):
+    """Runs once per worker process: keep the precomputed atlas projector."""
+    global _worker_projector
+    _worker_projector = projector
+
+def _load_subject(subj):
+    """Validate a subject from its header, then load it. Returns (data, None) or (None, reason)."""
+    nii_path = nii_path_for(subj)
+    if not os.path.exists(nii_path):
+        return None, "missing"
+    nii = nib.load(nii_path)
+    if nii.shape != EXPECTED_SHAPE:  # header only, no voxel data read
+        return None, f"invalid shape {nii.shape}"
+    if not np.allclose(nii.affine, _worker_projector.affine):
+        return None, "affine does not match the atlas grid"
+    return nii.get_fdata(dtype=np.float32), None
+
+def _ingest_subject(row, subj, b4_path, bs_path):
+    """
+    Load, validate and extract one subject, writing straight into row `row` of the batch outputs.
+    Returns (row, subj, error, qc).
+    """
+    try:
+        data, error = _load_subject(subj)
+        if error:
+            return row, subj, error, None
+        out_4d = np.load(b4_path, mmap_mode="r+")
+        out_4d[row] = data
+        out_4d.flush()
+        del out_4d
+        out_s = np.load(bs_path, mmap_mode="r+")
+        out_s[row] = extract_schaefer(data, _worker_projector)
+        out_s.flush()
+        return row, subj, None, scan_qc(data)
+    except Exception as e:
+        return row, subj, str(e), None
+
+def _ingest_subject_to_shard(subj):
+    """Load, validate and extract one subject into its own shard. Returns (subj, entry, error)."""
+    try:
+        data, error = _load_subject(subj)
+        if error:
+            return subj, None, error
+        sid = subj.replace("subject_", "")
+        entry = write_shard(
+            shards_dir, sid, data, extract_schaefer(data, _worker_projector),
+            storage_dtype=SHARD_STORAGE_DTYPE,
+        )
+        return subj, entry, None
+    except Exception as e:
+        return subj, None, str(e)
+
+def _allocate_batch(batch_num, batch_subjects):
+    """Scratch .npy memmaps (one row per subject) that workers fill in place."""
+    b4_scratch = os.path.join(output_dir, f".scratch_4d_{batch_num}.npy")
+    bs_scratch = os.path.join(output_dir, f".scratch_schaefer_{batch_num}.npy")
+    np.lib.format.open_memmap(b4_scratch, mode="w+", dtype=np.float32, shape=(len(batch_subjects),) + EXPECTED_SHAPE)
+    np.lib.format.open_memmap(bs_scratch, mode="w+", dtype=np.float32, shape=(len(batch_subjects), EXPECTED_SHAPE[-1], N_ROIS))
+    return {"subjects": batch_subjects, "paths": (b4_scratch, bs_scratch), "pending": len(batch_subjects), "valid": {}}
+
+def _compact_rows(path, rows):
+    """
+    Move rows `rows` (sorted) of a scratch memmap to its first len(rows) rows, in place,
+    COPY_CHUNK_SIZE time points at a time. Returns a view on them backed by the file.
+    """
+    out = np.load(path, mmap_mode="r+")
+    for dst, src in enumerate(rows):
+        if dst != src:
+            for t0 in range(0, out.shape[-1], COPY_CHUNK_SIZE):
+                out[dst, ..., t0:t0 + COPY_CHUNK_SIZE] = out[src, ..., t0:t0 + COPY_CHUNK_SIZE]
+    out.flush()
+    return out[:len(rows)]
+
+def _finalize_batch(batch_num, b4_scratch, bs_scratch, valid_rows, subjects, manifest):
+    if not valid_rows:
+        log(f"⚠️ No valid subjects in batch {batch_num}, skipping save.")
+    else:
+        rows = sorted(valid_rows)
+        sids = [subjects[r].replace("subject_", "") for r in rows]
+        qc = [valid_rows[r] for r in rows]
+        b4_path = os.path.join(output_dir, f"batch_4d_{batch_num}.pt")
+        bs_path = os.path.join(output_dir, f"batch_schaefer_{batch_num}.pt")
+        # torch.save writes straight from the file-backed pages; the batch is never copied into RAM
+        save_batch(torch.from_numpy(_compact_rows(b4_scratch, rows)), b4_path, sids, qc)
+        save_batch(torch.from_numpy(_compact_rows(bs_scratch, rows)), bs_path, sids)
+        for row, sid in enumerate(sids):
+            manifest.record(sid, "batch", location=os.path.basename(b4_path), row=row)
+        log(f"✅ Saved batch files: {b4_path} and {bs_path}")
+    os.remove(b4_scratch)
+    os.remove(bs_scratch)
+
+def create_batches_parallel(num_workers=NUM_WORKERS):
+    """
+    Process-parallel variant of `create_batches` producing the same batch files.
+
+    The atlas is resampled once in the parent and the resulting projector is
+    shipped to each worker a single time through the pool initializer.
+
+    Every subject is an independent task. Workers write the scan and its
+    atlas time series straight into a row of the batch's scratch .npy
+    memmaps, so no voxel data is pickled back to the parent. Tasks are
+    submitted in subject order, at most 2 * num_workers ahead, and a batch's
+    scratch files are only created when its first subject is submitted; a
+    batch is saved (and its scratch removed) as soon as its last subject
+    finishes. Scratch disk use is therefore about two batches whatever the
+    number of subjects.
+
+    Only subjects that are new or changed according to the ingestion manifest
+    are processed; their batches are numbered after the existing ones.
+    """
+    manifest = IngestManifest(manifest_path)
+    subjects = pending_subjects(manifest, "batch")
+    if not subjects:
+        log("✅ No new subjects, nothing to ingest.")
+        return
+
+    log(f"✅ Ingesting {len(subjects)} subjects from {base_dir} — {num_workers} workers")
+    projector = load_projector(subjects)
+    ram()
+
+    bad = []
+    t0 = time.time()
+    first_batch = next_batch_num()
+    tasks = iter(
+        (first_batch + i // BATCH_SIZE, i % BATCH_SIZE, subj) for i, subj in enumerate(subjects)
+    )
+    batches = {}
+
+    with ProcessPoolExecutor(max_workers=num_workers, initializer=_init_worker, initargs=(projector,)) as pool, \
+            tqdm(total=len(subjects), desc="Ingesting subjects", ncols=100) as progress:
+        running = {}
+
+        def submit_next():
+            task = next(tasks, None)
+            if task is None:
+                return
+            batch_num, row, subj = task
+            if batch_num not in batches:
+                start = (batch_num - first_batch) * BATCH_SIZE
+                batches[batch_num] = _allocate_batch(batch_num, subjects[start:start + BATCH_SIZE])
+            running[pool.submit(_ingest_subject, row, subj, *batches[batch_num]["paths"])] = batch_num
+
+        for _ in range(2 * num_workers):
+            submit_next()
+        while running:
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                batch_num = running.pop(future)
+                submit_next()
+                batch = batches[batch_num]
+                row, subj, error, qc = future.result()
+                sid = subj.replace("subject_", "")
+                if error is None:
+                    batch["valid"][row] = qc
+                    manifest.record_qc(sid, qc)
+                else:
+                    log(f"⚠️ Subject {sid}: {error}")
+                    bad.append((sid, error))
+                    manifest.record(sid, "batch", error=error)
+                    if error.startswith("invalid shape"):
+                        shutil.rmtree(os.path.join(base_dir, subj), ignore_errors=True)
+                progress.update()
+                batch["pending"] -= 1
+                if batch["pending"] == 0:
+                    _finalize_batch(batch_num, *batches.pop(batch_num)["paths"], batch["valid"], batch["subjects"], manifest)
+                    ram()
+
+    elapsed = time.time() - t0
+    log(f"✅ Phase 1 finished in {elapsed/60:.1f} min ({len(subjects) / max(elapsed, 1e-9) * 3600:.0f} subjects/hour). "
+        f"Total subjects processed: {len(subjects)}")
+    if bad:
+        log(f"⚠️ Excluded or deleted {len(bad)} subjects.")
+        for s, reason in bad[:5]:
+            log(f"   - {s}: {reason}")
+    manifest.close()
+
+# ==============================================================
+# SHARDED OUTPUT — ONE FILE PER SUBJECT + MANIFEST
+# ==============================================================
+def create_shards(num_workers=NUM_WORKERS):
+    """
+    Write every valid subject as its own .npy shard (scan + Schaefer series) under
+    `shards_dir`, registering it in the store manifest. Replaces phase 1 + phase 2
+    when OUTPUT_FORMAT == "shards"; there is nothing to merge afterwards.
+    Only new or changed subjects (per the ingestion manifest) are written.
+    """
+    manifest = IngestManifest(manifest_path)
+    subjects = pending_subjects(manifest, "shard")
+    if not subjects:
+        log("✅ No new subjects, nothing to ingest.")
+        return
+
+    log(f"✅ Ingesting {len(subjects)} subjects from {base_dir} — {num_workers} workers → {shards_dir}")
+    projector = load_projector(subjects)
+    store = ShardStore(shards_dir)
+
+    bad = []
+    t0 = time.time()
+    with ProcessPoolExecutor(max_workers=num_workers, initializer=_init_worker, initargs=(projector,)) as pool:
+        futures = [pool.submit(_ingest_subject_to_shard, subj) for subj in subjects]
+        # Register in subject order (workers still run ahead) so store indices are deterministic
+        for done, future in enumerate(tqdm(futures, desc="Writing shards", ncols=100), 1):
+            subj, entry, error = future.result()
+            sid = subj.replace("subject_", "")
+            if error is None:
+                store.add_entry(entry, save=done % BATCH_SIZE == 0)
+                manifest.record(sid, "shard", location=entry["scan"], row=store.index_of(sid))
+                manifest.record_qc(sid, entry["qc"])
+            else:
+                log(f"⚠️ Subject {sid}: {error}")
+                bad.append((sid, error))
+                manifest.record(sid, "shard", error=error)
+                if error.startswith("invalid shape"):
+                    shutil.rmtree(os.path.join(base_dir, subj), ignore_errors=True)
+    store.save()
+    manifest.close()
+
+    elapsed = time.time() - t0
+    log(f"✅ {len(store)} subjects in shard store ({elapsed/60:.1f} min). Excluded {len(bad)}.")
 
 # ==============================================================
 # PHASE 2 — MERGE STREAMÉ
 # ==============================================================
+def grow_npy(path, n_rows):
+    """
+    Add `n_rows` zero rows to an .npy file in place: the header is rewritten with
+    the new shape (np.save leaves room for that) and the file is extended.
+    Returns False, leaving the file untouched, if the header would not fit.
+    """
+    with open(path, "r+b") as f:
+        version = np.lib.format.read_magic(f)
+        read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) else np.lib.format.read_array_header_2_0
+        shape, fortran_order, dtype = read_header(f)
+        data_offset = f.tell()
+        new_shape = (shape[0] + n_rows,) + tuple(shape[1:])
+        header = io.BytesIO()
+        write_header = np.lib.format.write_array_header_1_0 if version == (1, 0) else np.lib.format.write_array_header_2_0
+        write_header(header, {"descr": np.lib.format.dtype_to_descr(dtype), "fortran_order": fortran_order, "shape": new_shape})
+        if fortran_order or header.tell() != data_offset:
+            return False
+        f.seek(0)
+        f.write(header.getvalue())
+        f.truncate(data_offset + int(np.prod(new_shape)) * dtype.itemsize)
+    return True
+
+def batch_files(pattern):
+    return sorted(
+        [f for f in os.listdir(output_dir) if f.startswith(pattern) and f.endswith(".pt")],
+        key=lambda f: int(f[len(pattern):-len(".pt")]),
+    )
+
+def read_rows_meta(output_path):
+    path = output_path[:-len(".npy")] + ".json"
+    if not (os.path.exists(output_path) and os.path.exists(path)):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+def write_rows_meta(output_path, row_subjects, row_qc, merged):
+    # Row order, per-row QC stats and the batches merged so far, so preprocessing
+    # never has to rescan the voxels and the next merge only reads new batches
+    rows_meta = {"subject_ids": row_subjects, "batches": merged}
+    if None not in row_qc:
+        rows_meta["qc"] = row_qc
+    tmp = output_path[:-len(".npy")] + ".json.tmp"
+    with open(tmp, "w") as f:
+        json.dump(rows_meta, f)
+    os.replace(tmp, output_path[:-len(".npy")] + ".json")
+
 def merge_batches(output_path, pattern, label):
-    files = sorted([f for f in os.listdir(output_dir) if f.startswith(pattern) and f.endswith(".pt")])
+    """
+    Merge batch files into one memory-mapped .npy output, incrementally.
+
+    When the output and its row sidecar already exist, only batches that were
+    not merged yet are read: rows of new subjects are appended to the output
+    in place and rows of re-ingested subjects (whose scan changed) overwrite
+    their existing row, so adding subjects costs only their own rows.
+    Otherwise (first merge, or batches without subject ids) the output is
+    written in a single pass over all batches.
+    """
+    files = batch_files(pattern)
     if not files:
         log(f"❌ No batch files found for pattern '{pattern}'")
         return
 
+    rows_meta = read_rows_meta(output_path)
+    if rows_meta is not None and "batches" in rows_meta:
+        new_files = [f for f in files if f not in set(rows_meta["batches"])]
+        if not new_files:
+            log(f"✅ {label}: all {len(files)} batches already merged into {output_path}")
+            return
+        if append_batches(output_path, rows_meta, new_files, label):
+            return
+    merge_all_batches(output_path, files, label)
+
+def append_batches(output_path, rows_meta, new_files, label):
+    """Merge `new_files` into an existing output; False if it has to be rewritten instead."""
+    metas = [read_batch_meta(os.path.join(output_dir, f)) for f in new_files]
+    row_subjects = list(rows_meta["subject_ids"])
+    if any("subject_ids" not in meta for meta in metas) or None in row_subjects:
+        return False
+    if np.load(output_path, mmap_mode="r").shape[0] != len(row_subjects):
+        log(f"⚠️ {output_path} does not match its row sidecar (interrupted merge?), rewriting it")
+        return False
+
+    # Target row of every (batch, row); the last batch holding a subject wins
+    row_of = {sid: r for r, sid in enumerate(row_subjects)}
+    row_qc = list(rows_meta.get("qc", [None] * len(row_subjects)))
+    plan = {}
+    for b, meta in enumerate(metas):
+        for r, sid in enumerate(meta["subject_ids"]):
+            if sid not in row_of:
+                row_of[sid] = len(row_subjects)
+                row_subjects.append(sid)
+                row_qc.append(None)
+            plan[sid] = (b, r)
+    n_new = len(row_subjects) - np.load(output_path, mmap_mode="r").shape[0]
+    if n_new and not grow_npy(output_path, n_new):
+        return False
+
+    log(f"\n🔗 Appending {len(new_files)} {label} batches → {output_path} "
+        f"({n_new} new rows, {len(plan) - n_new} replaced)")
+    final = np.load(output_path, mmap_mode="r+")
+    for b, (f, meta) in enumerate(tqdm(list(zip(new_files, metas)), desc=f"Merging {label}", ncols=100)):
+        batch = torch.load(os.path.join(output_dir, f), map_location="cpu", mmap=True).numpy()
+        qc = meta.get("qc")
+        for r, sid in enumerate(meta["subject_ids"]):
+            if plan[sid] == (b, r):
+                final[row_of[sid]] = batch[r]
+                row_qc[row_of[sid]] = qc[r] if qc is not None else None
+        del batch
+    final.flush()
+    del final
+    write_rows_meta(output_path, row_subjects, row_qc, rows_meta["batches"] + new_files)
+    log(f"✅ Saved {output_path} ({len(row_subjects)} rows)")
+    ram()
+    return True
+
+def merge_all_batches(output_path, files, label):
+    """
+    Single-pass merge of all batch files.
+
+    Shapes come from the phase 1 sidecars, so no batch is loaded just to count
+    rows. Each batch is mmap-loaded and copied straight into its slice of the
+    preallocated output, keeping peak RAM at (at most) one batch.
+
+    A subject re-ingested after its scan changed appears in a later batch; only
+    its latest row is kept. The row order is written to a `.json` sidecar
+    next to the output so preprocessing can map rows back to subjects.
+    """
     log(f"\n🔗 Merging {len(files)} {label} batches → {output_path}")
-    first = torch.load(os.path.join(output_dir, files[0]), map_location="cpu")
-    total = sum(torch.load(os.path.join(output_dir, f), map_location="cpu").shape[0] for f in files)
-    shape = [total] + list(first.shape[1:])
+    metas = [read_batch_meta(os.path.join(output_dir, f)) for f in files]
+    latest = {}
+    for b, meta in enumerate(metas):
+        for r, sid in enumerate(meta.get("subject_ids", [])):
+            latest[sid] = (b, r)
+    keep = [
+        [r for r in range(meta["shape"][0]) if "subject_ids" not in meta or latest[meta["subject_ids"][r]] == (b, r)]
+        for b, meta in enumerate(metas)
+    ]
+    total = sum(len(rows) for rows in keep)
+    shape = [total] + list(metas[0]["shape"][1:])
     log(f"📐 Target shape : {tuple(shape)}")
 
-    final = torch.empty(shape, dtype=first.dtype)
+    final = np.lib.format.open_memmap(output_path + ".tmp", mode="w+", dtype=np.dtype(metas[0]["dtype"]), shape=tuple(shape))
     offset = 0
+    row_subjects, row_qc = [], []
 
-    for f in tqdm(files, desc=f"Merging {label}", ncols=100):
-        batch = torch.load(os.path.join(output_dir, f), map_location="cpu")
-        final[offset:offset + batch.shape[0]] = batch
-        offset += batch.shape[0]
+    for f, meta, rows in tqdm(zip(files, metas, keep), total=len(files), desc=f"Merging {label}", ncols=100):
+        batch = torch.load(os.path.join(output_dir, f), map_location="cpu", mmap=True)
+        if len(rows) == meta["shape"][0]:
+            final[offset:offset + batch.shape[0]] = batch.numpy()
+        else:
+            final[offset:offset + len(rows)] = batch.numpy()[rows]
+        offset += len(rows)
+        sids, qc = meta.get("subject_ids"), meta.get("qc")
+        row_subjects.extend(sids[r] if sids is not None else None for r in rows)
+        row_qc.extend(qc[r] if qc is not None else None for r in rows)
         del batch
-        gc.collect()
-        ram()
 
-    torch.save(final, output_path)
-    log(f"✅ Saved {output_path} ({tuple(final.shape)})")
+    final.flush()
     del final
-    gc.collect()
+    os.replace(output_path + ".tmp", output_path)
+    write_rows_meta(output_path, row_subjects, row_qc, files)
+    log(f"✅ Saved {output_path} ({tuple(shape)})")
     ram()
 
 def merge_all():
@@ -151,5 +593,12 @@ def merge_all():
 # EXECUTION CONTROL
 # ==============================================================
 if __name__ == "__main__":
-    create_batches()   # ➜ Phase 1 : crée les batchs (et supprime les sujets invalides)
-    merge_all()        # ➜ Phase 2 : fusionne les batchs
\ No newline at end of file
+    if OUTPUT_FORMAT == "shards":
+        create_shards()
+    else:
+        # ➜ Phase 1 : crée les batchs (et supprime les sujets invalides)
+        if NUM_WORKERS > 1:
+            create_batches_parallel()
+        else:
+            create_batches()
+        merge_all()        # ➜ Phase 2 : fusionne les batchs
\ No newline at end of file
@@ -4,13 +4,18 @@ date: 25/09/2025
 """
 
 #!/usr/bin/env python3
-print("cececec")
 from pathlib import Path
 import boto3, botocore
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
 from datetime import datetime
+import json
 import os
 import sys
+import threading
+import time
 import nibabel as nib
+from nibabel.openers import ImageOpener
+from nibabel.volumeutils import array_to_file, seek_tell
 import numpy as np
 
 # ====== CONFIG ======
@@ -20,8 +25,24 @@ ROOT = "HCP_1200"
 REQUEST_PAYER = "requester"
 DRY_RUN = False
 VERBOSE = True
+MAX_TRANSFER_WORKERS = 8      # concurrent S3 transfers (threads)
+MAX_DOWNSAMPLE_WORKERS = 4    # concurrent downsamples (processes)
+DOWNSAMPLE_CHUNK_SIZE = 100   # time points streamed per downsample block
+DOWNSAMPLE_FACTOR = 2         # keep every n-th voxel along each spatial axis
+SOURCE_SHAPE = (91, 109, 91)  # spatial grid of the MNINonLinear 2 mm scans on S3
+STATE_MANIFEST = BASE / "download_state.json"
+# Point at a local S3 stand-in (moto server, minio, ...) instead of AWS
+S3_ENDPOINT_URL = os.environ.get("HCP_S3_ENDPOINT_URL")
 # ====================
 
+SCAN_RELPATH = "MNINonLinear/Results/rfMRI_REST1_LR/rfMRI_REST1_LR.nii.gz"
+
+PENDING = "pending"
+DOWNLOADED = "downloaded"
+DOWNSAMPLED = "downsampled"
+FAILED = "failed"
+
+
 def log(msg):
     print(f"[{datetime.now().strftime('%H:%M:%S')}] {msg}")
 
@@ -29,9 +50,16 @@ def s3():
     cfg = botocore.config.Config(
         region_name="us-east-1",
         retries={"max_attempts": 10, "mode": "standard"},
-        s3={"addressing_style": "virtual"},
+        s3={"addressing_style": "path" if S3_ENDPOINT_URL else "virtual"},
+        max_pool_connections=max(10, MAX_TRANSFER_WORKERS * 2),
     )
-    return boto3.client("s3", config=cfg)
+    return boto3.client("s3", config=cfg, endpoint_url=S3_ENDPOINT_URL)
+
+def subject_key(sid: str) -> str:
+    return f"{ROOT}/{sid}/{SCAN_RELPATH}"
+
+def subject_dst(sid: str) -> Path:
+    return BASE / f"subject_{sid}" / SCAN_RELPATH
 
 def folder_size_bytes(path: Path) -> int:
     total = 0
@@ -46,6 +74,53 @@ def folder_size_bytes(path: Path) -> int:
                 pass
     return total
 
+
+class StateManifest:
+    """
+    Durable per-subject download state (pending/downloaded/downsampled/failed).
+
+    The manifest is rewritten atomically after every transition, so an
+    interrupted run can be restarted and resumes from the recorded states
+    without reopening any NIfTI file.
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self.entries = {}
+        if self.path.exists():
+            with open(self.path, "r") as f:
+                self.entries = json.load(f)
+
+    def state(self, sid):
+        return self.entries.get(sid, {}).get("state", PENDING)
+
+    def update(self, sid, state, flush=True, **fields):
+        with self._lock:
+            entry = self.entries.setdefault(sid, {})
+            entry.update(fields)
+            entry["state"] = state
+            entry["updated"] = datetime.now().isoformat(timespec="seconds")
+            if flush:
+                self._flush()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def count(self, state):
+        return sum(1 for e in self.entries.values() if e.get("state") == state)
+
+    def _flush(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_suffix(self.path.suffix + ".tmp")
+        with open(tmp, "w") as f:
+            json.dump(self.entries, f, indent=1, sort_keys=True)
+            f.flush()
+            os.fsync(f.fileno())
+        tmp.replace(self.path)
+
+
 def download_one(client, s3_key: str, local_path: Path):
     local_path.parent.mkdir(parents=True, exist_ok=True)
 
@@ -71,9 +146,104 @@ def download_one(client, s3_key: str, local_path: Path):
     log(f"Finished download of s3://{BUCKET}/{s3_key} to {local_path}")
     return "DOWNLOADED"
 
-def main():
+def file_signature(path: Path):
+    st = path.stat()
+    return {"size": st.st_size, "mtime": st.st_mtime}
+
+def downsampled_shape(shape):
+    """Spatial shape left by `downsample_subject` (every DOWNSAMPLE_FACTOR-th voxel, from the first)."""
+    return tuple(len(range(0, s, DOWNSAMPLE_FACTOR)) for s in shape)
+
+def is_downsampled(dst: Path) -> bool:
+    """
+    Check the spatial shape against the downsampled SOURCE_SHAPE, from the NIfTI
+    header only; the voxel data is never decompressed.
+    """
+    try:
+        return tuple(nib.load(str(dst)).shape[:3]) == downsampled_shape(SOURCE_SHAPE)
+    except Exception:
+        return False
+
+def is_subject_done(dst: Path, entry: dict) -> bool:
+    """
+    Decide whether a subject is already downsampled.
+
+    A manifest entry whose recorded size and mtime still match the file on disk
+    is trusted as-is (a single stat call). Otherwise fall back to the header check.
+    """
+    if not dst.exists():
+        return False
+    if entry.get("state") == DOWNSAMPLED:
+        try:
+            sig = file_signature(dst)
+        except FileNotFoundError:
+            return False
+        if entry.get("size") == sig["size"] and entry.get("mtime") == sig["mtime"]:
+            return True
+    return dst.stat().st_size > 0 and is_downsampled(dst)
+
+def downsample_subject(path: str, chunk_size: int = None):
+    """
+    Downsample a scan in place by 2 along each spatial axis. Runs in a worker process.
+
+    The volume is streamed through nibabel's array proxy `chunk_size` time points at
+    a time and each strided block is appended to the output file, so peak memory is
+    bounded by one full-resolution chunk instead of the whole 4D volume.
+    Output voxels are stored as float32. A file that already has the downsampled
+    shape (a run stopped before recording it) is left as it is.
+    """
+    chunk_size = chunk_size or DOWNSAMPLE_CHUNK_SIZE
+    original_size = os.path.getsize(path)
+    img = nib.load(path, keep_file_open=True)
+    spatial = tuple(img.shape[:3])
+    if spatial == downsampled_shape(SOURCE_SHAPE):
+        return original_size, original_size
+    if spatial != tuple(SOURCE_SHAPE):
+        raise ValueError(f"{path}: unexpected spatial shape {spatial}, expected {tuple(SOURCE_SHAPE)}")
+    n_t = img.shape[3]
+    out_shape = downsampled_shape(spatial) + (n_t,)
+    affine = img.affine.copy()
+    affine[:3, :3] *= DOWNSAMPLE_FACTOR
+
+    hdr = img.header.copy()
+    hdr.set_data_shape(out_shape)
+    hdr.set_data_dtype(np.float32)
+    hdr.set_slope_inter(1.0, 0.0)
+    hdr.set_sform(affine, code="aligned")
+    hdr.set_qform(affine, code="unknown")
+
+    tmp = path + ".tmp.nii.gz"
+    with ImageOpener(tmp, "wb") as f:
+        hdr.write_to(f)
+        seek_tell(f, hdr.get_data_offset(), write0=True)
+        # NIfTI is Fortran-ordered, so consecutive time blocks are contiguous on disk
+        step = DOWNSAMPLE_FACTOR
+        for t0 in range(0, n_t, chunk_size):
+            chunk = np.asarray(
+                img.dataobj[::step, ::step, ::step, t0:t0 + chunk_size], dtype=np.float32
+            )
+            array_to_file(chunk, f, np.float32, offset=None, order="F")
+            del chunk
+    del img  # releases the persistent file handle held by the array proxy
+    os.replace(tmp, path)
+    return original_size, os.path.getsize(path)
+
+def list_subjects(client):
+    subjects = []
+    paginator = client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(
+        Bucket=BUCKET, Prefix=f"{ROOT}/", Delimiter="/", RequestPayer=REQUEST_PAYER
+    ):
+        for prefix in page.get("CommonPrefixes", []):
+            sid = prefix["Prefix"].split("/")[-2]
+            if sid.isdigit():
+                subjects.append(sid)
+    return sorted(subjects)
+
+def main(client=None, manifest_path=None):
     BASE.mkdir(parents=True, exist_ok=True)
-    client = s3()
+    client = client or s3()
+    manifest = StateManifest(manifest_path or STATE_MANIFEST)
 
     # 📊 Initial folder size
     initial_size = folder_size_bytes(BASE)
@@ -82,113 +252,118 @@ def main():
 
     # 📡 List all subjects from S3
     log("📡 Listing all subjects from S3...")
-    resp = client.list_objects_v2(
-        Bucket=BUCKET,
-        Prefix=f"{ROOT}/",
-        Delimiter="/",
-        RequestPayer=REQUEST_PAYER
-    )
-
-    subjects = []
-    for prefix in resp.get("CommonPrefixes", []):
-        sid = prefix["Prefix"].split("/")[-2]
-        if sid.isdigit():
-            subjects.append(sid)
-
+    subjects = list_subjects(client)
     total_subjects = len(subjects)
     log(f"✅ {total_subjects} subjects found.")
 
-    # --- Check how many are already downloaded ---
-    downloaded_subjects = 0
-    total_size_bytes = 0
-    for sid in sorted(subjects):
-        dst = BASE / f"subject_{sid}/MNINonLinear/Results/rfMRI_REST1_LR/rfMRI_REST1_LR.nii.gz"
-        if dst.exists():
-            size = dst.stat().st_size
-            if size > 0:
-                downloaded_subjects += 1
-                total_size_bytes += size
-
-    total_size_gb = total_size_bytes / (1024 ** 3)
-    remaining_subjects = total_subjects - downloaded_subjects
-    avg_size_per_subject_gb = (total_size_gb / downloaded_subjects) if downloaded_subjects > 0 else 0
-    estimated_remaining_gb = avg_size_per_subject_gb * remaining_subjects
-
-    log(f"📊 Already downloaded: {downloaded_subjects}/{total_subjects} subjects, {total_size_gb:.2f} GB")
-    log(f"📦 Remaining: {remaining_subjects} subjects (~{estimated_remaining_gb:.2f} GB)")
-
-    # 📥 Download remaining subjects
-    current_total_size_bytes = total_size_bytes
-    current_downloaded = downloaded_subjects
-    counts = {"downloaded": 0, "missing": 0, "errors": 0}
-
-    for idx, sid in enumerate(sorted(subjects), 1):
-        dst = BASE / f"subject_{sid}/MNINonLinear/Results/rfMRI_REST1_LR/rfMRI_REST1_LR.nii.gz"
-
-        # Skip already existing and downsampled
-        if dst.exists() and dst.stat().st_size > 0:
-            try:
-                img = nib.load(str(dst))
-                data = img.get_fdata()
-                spatial_shape = data.shape[:3]
-                if all(s <= 110 for s in spatial_shape):
-                    continue
-            except Exception:
-                pass
-        # Get estimated size if possible
-        try:
-            head = client.head_object(Bucket=BUCKET, Key=f"{ROOT}/{sid}/MNINonLinear/Results/rfMRI_REST1_LR/rfMRI_REST1_LR.nii.gz", RequestPayer=REQUEST_PAYER)
-            estimated_size_gb = head["ContentLength"] / (1024 ** 3)
-        except Exception:
-            estimated_size_gb = 0.0
+    # --- Resume from the manifest; only unknown subjects are checked on disk ---
+    to_download, to_downsample = [], []
+    for sid in subjects:
+        state = manifest.state(sid)
+        entry = manifest.entries.get(sid, {})
+        dst = subject_dst(sid)
+        if state == FAILED and entry.get("error") == "missing":
+            continue
+        if state == DOWNSAMPLED or sid not in manifest.entries:
+            # Trusted by size/mtime, or validated from the header for files
+            # that predate the manifest or were touched since
+            if is_subject_done(dst, entry):
+                if entry.get("mtime") is None or state != DOWNSAMPLED:
+                    manifest.update(sid, DOWNSAMPLED, flush=False, **file_signature(dst))
+                continue
+        if dst.exists() and dst.stat().st_size > 0 and state != FAILED:
+            # A crash between the downsample and the manifest flush leaves a
+            # DOWNLOADED entry for a file that is already downsampled
+            if is_downsampled(dst):
+                manifest.update(sid, DOWNSAMPLED, flush=False, **file_signature(dst))
+                continue
+            manifest.update(sid, DOWNLOADED, flush=False, **file_signature(dst))
+            to_downsample.append(sid)
+            continue
+        to_download.append(sid)
+    manifest.flush()
 
-        log(f"➡️ [{current_downloaded + 1}/{total_subjects}] Subject {sid} – starting download (~{estimated_size_gb:.2f} GB)")
+    done_subjects = manifest.count(DOWNSAMPLED)
+    log(f"📊 Already processed: {done_subjects}/{total_subjects} subjects")
+    log(f"📦 Remaining: {len(to_download)} to download, {len(to_downsample)} to downsample")
 
-        try:
-            out = download_one(client, f"{ROOT}/{sid}/MNINonLinear/Results/rfMRI_REST1_LR/rfMRI_REST1_LR.nii.gz", dst)
-            if out == "DOWNLOADED":
-                counts["downloaded"] += 1
-                current_downloaded += 1
-                current_total_size_bytes += dst.stat().st_size
-
-                # Downsampling
-                original_size_gb = dst.stat().st_size / (1024 ** 3)
-                img = nib.load(str(dst))
-                data = img.get_fdata(dtype=np.float32)
-                affine = img.affine.copy()
-                data_downsampled = data[::2, ::2, ::2, :]
-                affine[:3, :3] *= 2
-                downsampled_img = nib.Nifti1Image(data_downsampled, affine, img.header)
-                nib.save(downsampled_img, str(dst))
-                downsampled_size_gb = dst.stat().st_size / (1024 ** 3)
-                saved_gb = original_size_gb - downsampled_size_gb
-                log(f"📉 Downsampling complete for subject {sid} – reduced from {original_size_gb:.2f} GB to {downsampled_size_gb:.2f} GB (saved {saved_gb:.2f} GB)")
-
-                current_total_size_gb = current_total_size_bytes / (1024 ** 3)
-                remaining_subjects = total_subjects - current_downloaded
-                avg_size_per_subject_gb = (current_total_size_gb / current_downloaded) if current_downloaded > 0 else 0
-                estimated_remaining_gb = avg_size_per_subject_gb * remaining_subjects
-                log(f"✅ Subject {sid} downloaded – total: {current_total_size_gb:.2f} GB | remaining: {remaining_subjects} (~{estimated_remaining_gb:.2f} GB)")
-        except botocore.exceptions.ClientError as e:
-            code = e.response.get("Error", {}).get("Code", "")
-            if code in ("404", "NoSuchKey"):
-                counts["missing"] += 1
-            else:
-                counts["errors"] += 1
+    # 📥 Download and downsample remaining subjects
+    counts = {"downloaded": 0, "downsampled": 0, "missing": 0, "errors": 0}
+    t0 = time.time()
+
+    def throughput():
+        hours = (time.time() - t0) / 3600
+        return counts["downsampled"] / hours if hours > 0 else 0.0
+
+    with ThreadPoolExecutor(max_workers=MAX_TRANSFER_WORKERS) as transfers, \
+            ProcessPoolExecutor(max_workers=MAX_DOWNSAMPLE_WORKERS) as downsamplers:
+        running = {}
+
+        def submit_downsample(sid):
+            running[downsamplers.submit(downsample_subject, str(subject_dst(sid)))] = ("downsample", sid)
+
+        for sid in to_download:
+            manifest.update(sid, PENDING, flush=False)
+            running[transfers.submit(download_one, client, subject_key(sid), subject_dst(sid))] = ("download", sid)
+        for sid in to_downsample:
+            submit_downsample(sid)
+        manifest.flush()
+
+        while running:
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                stage, sid = running.pop(future)
+                try:
+                    result = future.result()
+                except botocore.exceptions.ClientError as e:
+                    code = e.response.get("Error", {}).get("Code", "")
+                    if code in ("404", "NoSuchKey"):
+                        counts["missing"] += 1
+                        manifest.update(sid, FAILED, error="missing")
+                    else:
+                        counts["errors"] += 1
+                        manifest.update(sid, FAILED, error=code or str(e))
+                    continue
+                except Exception as e:
+                    counts["errors"] += 1
+                    log(f"❌ Subject {sid} failed during {stage}: {e}")
+                    manifest.update(sid, FAILED, error=f"{stage}: {e}")
+                    continue
+
+                if stage == "download":
+                    if result == "DRY":
+                        continue
+                    if result == "DOWNLOADED":
+                        counts["downloaded"] += 1
+                    manifest.update(sid, DOWNLOADED, **file_signature(subject_dst(sid)))
+                    submit_downsample(sid)
+                else:
+                    original_size, downsampled_size = result
+                    counts["downsampled"] += 1
+                    manifest.update(sid, DOWNSAMPLED, **file_signature(subject_dst(sid)))
+                    saved_gb = (original_size - downsampled_size) / (1024 ** 3)
+                    done = manifest.count(DOWNSAMPLED)
+                    log(f"📉 Subject {sid} done – reduced from {original_size / (1024 ** 3):.2f} GB to "
+                        f"{downsampled_size / (1024 ** 3):.2f} GB (saved {saved_gb:.2f} GB) | "
+                        f"{done}/{total_subjects} | {throughput():.1f} subjects/hour")
 
     # 📊 Final summary
     final_size = folder_size_bytes(BASE)
     final_size_gb = final_size / (1024 ** 3)
     added_gb = (final_size - initial_size) / (1024 ** 3)
+    elapsed_h = (time.time() - t0) / 3600
 
     log("==== Summary ====")
     log(f"📈 Final folder size: {final_size_gb:.2f} GB")
     log(f"📥 Added memory: {added_gb:.2f} GB")
-    log(f"✅ New files downloaded: {counts['downloaded']} | Missing: {counts['missing']} | Errors: {counts['errors']}")
+    log(f"✅ New files downloaded: {counts['downloaded']} | Downsampled: {counts['downsampled']} | "
+        f"Missing: {counts['missing']} | Errors: {counts['errors']}")
+    log(f"⏱️ {elapsed_h:.2f} h elapsed – throughput {throughput():.1f} subjects/hour")
+    return counts
 
 if __name__ == "__main__":
     try:
         main()
     except botocore.exceptions.NoCredentialsError:
         print("❌ AWS credentials not found. Run `aws configure`.", file=sys.stderr)
-        sys.exit(2)
\ No newline at end of file
+        sys.exit(2)
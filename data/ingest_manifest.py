@@ -0,0 +1,188 @@
+import hashlib
+import json
+import os
+import sqlite3
+from datetime import datetime
+
+MANIFEST_FILENAME = "ingest_manifest.sqlite"
+SCAN_RELPATH = os.path.join("MNINonLinear", "Results", "rfMRI_REST1_LR", "rfMRI_REST1_LR.nii.gz")
+HASH_CHUNK_SIZE = 8 * 1024 * 1024
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS subjects (
+    idx INTEGER PRIMARY KEY AUTOINCREMENT,
+    subject_id TEXT UNIQUE NOT NULL,
+    path TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    content_hash TEXT NOT NULL,
+    added_at TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS artifacts (
+    subject_id TEXT NOT NULL REFERENCES subjects(subject_id),
+    kind TEXT NOT NULL,
+    content_hash TEXT NOT NULL,
+    location TEXT,
+    row INTEGER,
+    error TEXT,
+    created_at TEXT NOT NULL,
+    PRIMARY KEY (subject_id, kind)
+);
+CREATE TABLE IF NOT EXISTS qc (
+    subject_id TEXT PRIMARY KEY REFERENCES subjects(subject_id),
+    content_hash TEXT NOT NULL,
+    stats TEXT NOT NULL
+);
+"""
+
+
+def default_manifest_path(base_dir):
+    return os.path.join(base_dir, MANIFEST_FILENAME)
+
+
+def file_hash(path):
+    """Content hash of a file, read in chunks."""
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def find_subject_scans(base_dir):
+    """Sorted (subject_id, scan_path) pairs for every `subject_*` directory that has a scan."""
+    found = []
+    for subject_dir in sorted(os.listdir(base_dir)):
+        path = os.path.join(base_dir, subject_dir, SCAN_RELPATH)
+        if subject_dir.startswith("subject_") and os.path.exists(path):
+            found.append((subject_dir.replace("subject_", ""), path))
+    return found
+
+
+class IngestManifest:
+    """
+    Incremental ingestion state shared by the conversion scripts (SQLite).
+
+    Every subject gets a stable index the first time it is registered; indices
+    are never reassigned, so adding subjects only appends. Each derived artifact
+    (tensor batch row, shard, metadata entry...) is recorded with the content
+    hash of the scan it was produced from, so a script only has to process the
+    subjects whose artifact is missing or was built from an older file.
+    Content hashes are recomputed only when a file's size or mtime changes.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.conn = sqlite3.connect(path)
+        self.conn.executescript(_SCHEMA)
+        self.conn.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.conn.close()
+
+    def register(self, subject_id, path):
+        """
+        Add or refresh a subject's source scan.
+
+        Returns:
+            tuple: (stable index, content hash).
+        """
+        subject_id = str(subject_id)
+        st = os.stat(path)
+        row = self.conn.execute(
+            "SELECT idx, path, size, mtime_ns, content_hash FROM subjects WHERE subject_id = ?",
+            (subject_id,),
+        ).fetchone()
+        if row is not None and (row[1], row[2], row[3]) == (path, st.st_size, st.st_mtime_ns):
+            return row[0] - 1, row[4]
+
+        content_hash = file_hash(path)
+        with self.conn:
+            if row is None:
+                cur = self.conn.execute(
+                    "INSERT INTO subjects (subject_id, path, size, mtime_ns, content_hash, added_at)"
+                    " VALUES (?, ?, ?, ?, ?, ?)",
+                    (subject_id, path, st.st_size, st.st_mtime_ns, content_hash, _now()),
+                )
+                return cur.lastrowid - 1, content_hash
+            self.conn.execute(
+                "UPDATE subjects SET path = ?, size = ?, mtime_ns = ?, content_hash = ?"
+                " WHERE subject_id = ?",
+                (path, st.st_size, st.st_mtime_ns, content_hash, subject_id),
+            )
+        return row[0] - 1, content_hash
+
+    def register_all(self, base_dir):
+        """Register every subject scan under `base_dir`. Returns the subject ids in stable-index order."""
+        for subject_id, path in find_subject_scans(base_dir):
+            self.register(subject_id, path)
+        return [s["subject_id"] for s in self.subjects()]
+
+    def subjects(self):
+        """All registered subjects ordered by stable index (0-based)."""
+        rows = self.conn.execute(
+            "SELECT idx - 1, subject_id, path, content_hash FROM subjects ORDER BY idx"
+        ).fetchall()
+        return [dict(zip(("index", "subject_id", "path", "content_hash"), r)) for r in rows]
+
+    def pending(self, kind):
+        """Subjects whose `kind` artifact is missing or stale, ordered by stable index."""
+        rows = self.conn.execute(
+            "SELECT s.idx - 1, s.subject_id, s.path, s.content_hash FROM subjects s"
+            " LEFT JOIN artifacts a ON a.subject_id = s.subject_id AND a.kind = ?"
+            " WHERE a.content_hash IS NULL OR a.content_hash != s.content_hash"
+            " ORDER BY s.idx",
+            (kind,),
+        ).fetchall()
+        return [dict(zip(("index", "subject_id", "path", "content_hash"), r)) for r in rows]
+
+    def record(self, subject_id, kind, location=None, row=None, error=None):
+        """
+        Mark the `kind` artifact of a subject as built from its current scan.
+
+        With `error`, the subject is recorded as rejected instead; it is not
+        pending again until its scan changes.
+        """
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO artifacts"
+                " (subject_id, kind, content_hash, location, row, error, created_at)"
+                " SELECT subject_id, ?, content_hash, ?, ?, ?, ? FROM subjects WHERE subject_id = ?",
+                (kind, location, row, error, _now(), str(subject_id)),
+            )
+
+    def record_qc(self, subject_id, stats):
+        """Store the per-scan QC statistics (see `qc.scan_qc`) of a subject's current scan."""
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO qc (subject_id, content_hash, stats)"
+                " SELECT subject_id, content_hash, ? FROM subjects WHERE subject_id = ?",
+                (json.dumps(stats), str(subject_id)),
+            )
+
+    def qc_table(self):
+        """QC statistics of every subject whose scan has not changed since they were computed."""
+        rows = self.conn.execute(
+            "SELECT q.subject_id, q.stats FROM qc q"
+            " JOIN subjects s ON s.subject_id = q.subject_id AND s.content_hash = q.content_hash"
+        ).fetchall()
+        return {sid: json.loads(stats) for sid, stats in rows}
+
+    def artifacts(self, kind):
+        """Successfully built `kind` artifacts as {subject_id: (location, row)}."""
+        rows = self.conn.execute(
+            "SELECT subject_id, location, row FROM artifacts WHERE kind = ? AND error IS NULL",
+            (kind,),
+        ).fetchall()
+        return {sid: (location, row) for sid, location, row in rows}
+
+
+def _now():
+    return datetime.now().isoformat(timespec="seconds")
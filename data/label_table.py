@@ -0,0 +1,88 @@
+import numpy as np
+import torch
+
+
+class LabelTable:
+    """
+    Per-scan labels compiled once into typed columns.
+
+    Integer labels (class indices) that every scan has become an int64 column
+    per task; other numeric labels become float32 columns, with NaN where a
+    scan has no value; string labels become object columns. Row ``i`` is the
+    scan at dataset index ``i``, and ``scan_ids`` holds its integer id (the
+    row of its image_id in ``image_ids``), so a batch takes one fancy-index
+    per task instead of a dict lookup per sample.
+    """
+
+    def __init__(self, image_ids, columns, strings=None):
+        self.image_ids = list(image_ids)
+        self.scan_ids = torch.arange(len(self.image_ids), dtype=torch.int64)
+        self.columns = columns
+        self.strings = strings or {}
+        self._tensors = {task: torch.from_numpy(col) for task, col in columns.items()}
+
+    @classmethod
+    def from_dict(cls, imageID_to_labels, image_ids):
+        """
+        Args:
+            imageID_to_labels (dict): {image_id: {task: value}}, as in imageID_to_labels.json.
+            image_ids (Sequence[str]): image_id of every row, in dataset order.
+        """
+        image_ids = list(image_ids)
+        rows = [imageID_to_labels.get(image_id, {}) for image_id in image_ids]
+        keys = dict.fromkeys(key for row in rows for key in row)
+        columns, strings = {}, {}
+        for key in keys:
+            values = [row.get(key) for row in rows]
+            if any(isinstance(v, str) for v in values):
+                strings[key] = np.array(values, dtype=object)
+            elif all(isinstance(v, (int, np.integer)) for v in values):
+                columns[key] = np.array(values, dtype=np.int64)
+            else:
+                columns[key] = np.array(
+                    [np.nan if v is None else v for v in values], dtype=np.float32
+                )
+        return cls(image_ids, columns, strings)
+
+    @classmethod
+    def from_infos(cls, imageID_to_labels, index_to_info):
+        """Table aligned to `index_to_info` ({dataset index: {"image_id": ...}})."""
+        return cls.from_dict(
+            imageID_to_labels, [index_to_info[i]["image_id"] for i in range(len(index_to_info))]
+        )
+
+    def __len__(self):
+        return len(self.image_ids)
+
+    @property
+    def tasks(self):
+        return list(self.columns)
+
+    def column(self, task):
+        """Values of `task` for every row (float32 and all NaN if no scan has it)."""
+        if task in self.columns:
+            return self.columns[task]
+        return np.full(len(self), np.nan, dtype=np.float32)
+
+    def batch(self, rows):
+        """
+        Labels of the given rows in the `collate_fn_corr` layout: a tensor per
+        numeric task (int64 or float32, as its column), a list per string
+        label and the int64 scan ids.
+        """
+        rows = torch.as_tensor(rows, dtype=torch.int64)
+        batched = {task: col[rows] for task, col in self._tensors.items()}
+        index = rows.numpy()
+        for key, col in self.strings.items():
+            batched[key] = col[index].tolist()
+        batched["scan_id"] = self.scan_ids[rows]
+        return batched
+
+    def class_counts(self, task):
+        """Samples per class of a categorical or binary `task` (np.bincount over non-NaN rows)."""
+        values = self.column(task)
+        if values.dtype != np.int64:
+            values = values[~np.isnan(values)].astype(np.int64)
+        if values.size and values.min() < 0:
+            raise ValueError(f"Class labels of task {task} must be non-negative.")
+        return np.bincount(values)
@@ -0,0 +1,274 @@
+"""
+Low-rank compressed scan store.
+
+Convert a shard store (see `shards.py`) with, e.g.:
+    python -m code_iclr.data.lowrank --shards /path/to/shards --out /path/to/lowrank --energy 0.95
+"""
+
+import argparse
+import json
+import os
+
+import numpy as np
+import torch
+
+from .shards import ShardStore, _atomic_save_npy
+
+MANIFEST_NAME = "manifest.json"
+
+
+def factorize(scan, rank=None, energy=0.95, chunk_voxels=65536):
+    """
+    Per-voxel temporal mean plus a truncated SVD of the demeaned scan, seen as
+    a [voxels, T] matrix, computed out of core.
+
+    The mean is kept as a factor of its own, so the components (and the
+    `energy` threshold) describe the fluctuations around it rather than the
+    static image. The T x T Gram matrix of the residual is accumulated in
+    float64 over voxel chunks and eigendecomposed; the spatial factors are
+    then one chunked projection. Only `chunk_voxels` rows are resident at a
+    time, so `scan` may be a memory map.
+
+    Args:
+        scan: Array of shape [H, W, D, T].
+        rank (int, optional): Number of components kept (capped by T).
+        energy (float): Without `rank`, keep the fewest components whose squared
+            singular values reach this fraction of the residual's total.
+        chunk_voxels (int): Voxel rows per chunk.
+    Returns:
+        tuple: (mean [voxels] float32, spatial [voxels, r] float32 (left vectors
+        scaled by the singular values), temporal [r, T] float32, relative
+        Frobenius error of the residual, kept residual energy).
+    """
+    n_time = scan.shape[-1]
+    flat = scan.reshape(-1, n_time)
+    mean = np.empty(len(flat), dtype=np.float32)
+    gram = np.zeros((n_time, n_time))
+    for start in range(0, len(flat), chunk_voxels):
+        block = np.asarray(flat[start : start + chunk_voxels], dtype=np.float64)
+        block_mean = block.mean(axis=1, keepdims=True)
+        mean[start : start + len(block)] = block_mean[:, 0]
+        block -= block_mean
+        gram += block.T @ block
+
+    eigvals, eigvecs = np.linalg.eigh(gram)
+    eigvals, eigvecs = np.clip(eigvals[::-1], 0, None), eigvecs[:, ::-1]
+    total = eigvals.sum()
+    if rank is None:
+        cumulative = np.cumsum(eigvals) / total if total > 0 else np.ones_like(eigvals)
+        rank = int(np.searchsorted(cumulative, energy) + 1)
+    rank = max(1, min(rank, n_time))
+    basis = eigvecs[:, :rank]
+
+    spatial = np.empty((len(flat), rank), dtype=np.float32)
+    for start in range(0, len(flat), chunk_voxels):
+        block = np.asarray(flat[start : start + chunk_voxels], dtype=np.float64)
+        block -= mean[start : start + len(block), None]
+        spatial[start : start + len(block)] = block @ basis
+
+    kept = eigvals[:rank].sum() / total if total > 0 else 1.0
+    error = float(np.sqrt(max(1.0 - kept, 0.0)))
+    return mean, spatial, np.ascontiguousarray(basis.T, dtype=np.float32), error, float(kept)
+
+
+class LowRankStore:
+    """
+    Per-subject truncated SVD factors with a JSON manifest.
+
+    Each subject keeps a ``mean`` [voxels] and ``spatial`` [voxels, r] and
+    ``temporal`` [r, T] factors of its demeaned scan (plus its dense atlas
+    series and the QC stats of its source shard), so a scan costs
+    voxels + r * (voxels + T) instead of voxels * T values. Factor files are
+    memory-mapped once per store (and process) and windows are decoded from
+    those maps, so after the first read they are served from the page cache
+    instead of being loaded again for every window. Reads mirror
+    `ShardStore` (`qc`, `stack`, `regions`), and `scans` gives a lazy
+    `LowRankScans` that decodes only the windows that are requested.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.manifest_path = os.path.join(root, MANIFEST_NAME)
+        self.entries = []
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, "r") as f:
+                self.entries = json.load(f)["subjects"]
+        self._index = {e["subject_id"]: i for i, e in enumerate(self.entries)}
+        self._open = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_open"] = {}
+        return state
+
+    @property
+    def subject_ids(self):
+        return [e["subject_id"] for e in self.entries]
+
+    def save(self):
+        os.makedirs(self.root, exist_ok=True)
+        tmp = self.manifest_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"version": 1, "format": "lowrank", "subjects": self.entries}, f, indent=1)
+        os.replace(tmp, self.manifest_path)
+
+    def add(self, subject_id, scan, regions=None, qc=None, rank=None, energy=0.95, save=True):
+        """Factorize one [H, W, D, T] scan and register it (replacing an older entry)."""
+        mean, spatial, temporal, error, kept = factorize(scan, rank=rank, energy=energy)
+        os.makedirs(os.path.join(self.root, "factors"), exist_ok=True)
+        entry = {
+            "subject_id": str(subject_id),
+            "mean": os.path.join("factors", f"{subject_id}.mean.npy"),
+            "spatial": os.path.join("factors", f"{subject_id}.spatial.npy"),
+            "temporal": os.path.join("factors", f"{subject_id}.temporal.npy"),
+            "scan_shape": list(scan.shape),
+            "rank": int(temporal.shape[0]),
+            "energy": kept,
+            "rel_error": error,
+            "qc": qc,
+        }
+        _atomic_save_npy(os.path.join(self.root, entry["mean"]), mean)
+        _atomic_save_npy(os.path.join(self.root, entry["spatial"]), spatial)
+        _atomic_save_npy(os.path.join(self.root, entry["temporal"]), temporal)
+        if regions is not None:
+            entry["regions"] = os.path.join("factors", f"{subject_id}.regions.npy")
+            entry["regions_shape"] = list(regions.shape)
+            _atomic_save_npy(os.path.join(self.root, entry["regions"]), np.ascontiguousarray(regions))
+
+        sid = entry["subject_id"]
+        if sid in self._index:
+            i = self._index[sid]
+            self.entries[i] = entry
+            for kind in ("mean", "spatial", "temporal", "regions"):
+                self._open.pop((kind, i), None)
+        else:
+            self._index[sid] = len(self.entries)
+            self.entries.append(entry)
+        if save:
+            self.save()
+        return entry
+
+    @classmethod
+    def from_shards(cls, shard_store, root, rank=None, energy=0.95, overwrite=False):
+        """Factorize every subject of a `ShardStore` (skipping converted ones unless `overwrite`)."""
+        store = cls(root)
+        for i, sid in enumerate(shard_store.subject_ids):
+            if sid in store._index and not overwrite:
+                continue
+            entry = shard_store.entries[i]
+            scan = shard_store.decode_scan(i, shard_store.scan(i))
+            regions = shard_store.regions(i) if "regions" in entry else None
+            new = store.add(sid, scan, regions, qc=entry.get("qc"), rank=rank, energy=energy, save=False)
+            print(f"{sid}: rank {new['rank']}, energy {new['energy']:.4f}, rel. error {new['rel_error']:.4f}")
+        store.save()
+        return store
+
+    def _array(self, kind, i):
+        key = (kind, i)
+        if key not in self._open:
+            self._open[key] = np.load(os.path.join(self.root, self.entries[i][kind]), mmap_mode="r")
+        return self._open[key]
+
+    def qc(self, key):
+        """Per-subject QC statistic of the source scans, aligned with the store indices."""
+        return np.array([e["qc"][key] for e in self.entries], dtype=np.float64)
+
+    def errors(self):
+        """{subject_id: relative Frobenius reconstruction error of the demeaned scan}."""
+        return {e["subject_id"]: e["rel_error"] for e in self.entries}
+
+    def regions(self, i):
+        """Memory-mapped atlas time series of subject `i`, shape [T, n_regions]."""
+        return self._array("regions", i)
+
+    def window(self, i, t_start=0, t_end=None):
+        """Decode frames [t_start, t_end) of subject `i` as a float32 [H, W, D, t] tensor."""
+        # Products of the cached maps: nothing is loaded or copied besides the output
+        out = self._array("spatial", i) @ self._array("temporal", i)[:, t_start:t_end]
+        if "mean" in self.entries[i]:
+            out += self._array("mean", i)[:, None]
+        return torch.from_numpy(out.reshape(tuple(self.entries[i]["scan_shape"][:-1]) + (-1,)))
+
+    def stack(self, indices, kind="scan"):
+        """Dense [len(indices), ...] tensor of decoded scans ("scan") or atlas series ("regions")."""
+        if kind == "regions":
+            return torch.from_numpy(np.stack([np.asarray(self.regions(i)) for i in indices]))
+        return torch.stack([self.window(i) for i in indices])
+
+    def scans(self, indices=None):
+        """Lazy [N, H, W, D, T] view of the given subjects (all by default)."""
+        return LowRankScans(self, range(len(self)) if indices is None else indices)
+
+
+class LowRankScans:
+    """
+    Lazy [N, H, W, D, T] scans backed by a `LowRankStore`.
+
+    Indexing the sample axis with a slice, list or array gives another lazy
+    view (so splits never decode anything); ``scans[i]`` decodes a whole scan
+    and ``scans[i, ..., t0:t1]`` a single window, the voxel means plus one
+    [voxels, r] @ [r, t] product. `decode` materializes a (small) view densely.
+    """
+
+    def __init__(self, store, indices):
+        self.store = store
+        self.indices = np.asarray(indices, dtype=np.int64)
+        first = store.entries[int(self.indices[0])] if len(self.indices) else store.entries[0]
+        self.shape = (len(self.indices),) + tuple(first["scan_shape"])
+
+    def __len__(self):
+        return len(self.indices)
+
+    def size(self, dim=None):
+        return self.shape if dim is None else self.shape[dim]
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            i, *rest = key
+            t = rest[-1] if rest else slice(None)
+            if rest[:-1] not in ([], [Ellipsis]) or not isinstance(t, slice) or t.step not in (None, 1):
+                raise IndexError("LowRankScans supports scans[i] and scans[i, ..., t0:t1] only.")
+            return self.store.window(int(self.indices[i]), t.start or 0, t.stop)
+        if isinstance(key, (int, np.integer)):
+            return self.store.window(int(self.indices[key]))
+        if isinstance(key, torch.Tensor):
+            key = key.numpy()
+        return LowRankScans(self.store, self.indices[key])
+
+    def decode(self):
+        """All scans of this view as one dense tensor."""
+        return self.store.stack(self.indices)
+
+    def rel_errors(self):
+        """Relative reconstruction error of each scan of this view."""
+        return np.array([self.store.entries[i]["rel_error"] for i in self.indices])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--shards", required=True, help="Source shard store directory")
+    parser.add_argument("--out", required=True, help="Low-rank store directory")
+    parser.add_argument("--rank", type=int, default=None)
+    parser.add_argument("--energy", type=float, default=0.95)
+    parser.add_argument("--overwrite", action="store_true")
+    args = parser.parse_args()
+
+    store = LowRankStore.from_shards(
+        ShardStore(args.shards), args.out, rank=args.rank, energy=args.energy, overwrite=args.overwrite
+    )
+    errors = np.array(list(store.errors().values()))
+    dense = sum(int(np.prod(e["scan_shape"])) for e in store.entries)
+    factors = sum(
+        int(np.prod(e["scan_shape"][:-1])) * (e["rank"] + 1) + e["rank"] * e["scan_shape"][-1] for e in store.entries
+    )
+    print(
+        f"{len(store)} subjects, {dense / max(factors, 1):.1f}x fewer values, "
+        f"rel. error mean {errors.mean():.4f} / max {errors.max():.4f}"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,416 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+import nibabel as nib
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+
+from .dataset import collate_fn_corr, compile_labels
+from .shared import share
+from .transforms import _chunk_moments, _merge_moments
+
+try:
+    import indexed_gzip as igzip
+except ImportError:  # falls back to sequential gzip, where every backward seek re-decompresses
+    igzip = None
+
+INDEX_SPACING = 4 * 1024 * 1024  # Bytes of uncompressed data between gzip access points
+INDEX_SUFFIX = ".gzidx"
+SUMMARY_SUFFIX = ".summary.npz"
+
+
+def index_path_for(path, index_dir=None):
+    """Location of the cached gzip access-point index of `path`."""
+    name = os.path.basename(path) + INDEX_SUFFIX
+    if index_dir is None:
+        return os.path.join(os.path.dirname(path), name)
+    # Index files of different subjects share the same base name
+    digest = hashlib.md5(os.path.abspath(path).encode()).hexdigest()[:12]
+    return os.path.join(index_dir, f"{digest}_{name}")
+
+
+def summary_path_for(path, index_dir=None):
+    """Location of the cached whole-file summary of `path`, next to its gzip index."""
+    return index_path_for(path, index_dir)[: -len(INDEX_SUFFIX)] + SUMMARY_SUFFIX
+
+
+class NiftiWindowReader:
+    """
+    Random access to time windows of a 4D NIfTI file without decompressing it whole.
+
+    NIfTI data are Fortran-ordered, so the frames [t_start, t_end) form one
+    contiguous byte range. For `.nii.gz` files an indexed_gzip access-point
+    index is built on first use (one full decompression pass) and cached next
+    to the file or in `index_dir`; after that any window is a seek plus a read
+    of just that range. The index is rebuilt when the data file is newer.
+    """
+
+    def __init__(self, path, index_dir=None, spacing=INDEX_SPACING):
+        self.path = path
+        self.index_dir = index_dir
+        self.spacing = spacing
+
+        proxy = nib.load(path).dataobj  # Reads only the header bytes
+        self.shape = tuple(int(s) for s in proxy.shape)
+        if len(self.shape) != 4:
+            raise ValueError(f"{path}: expected a 4D image, got shape {self.shape}")
+        self.dtype = proxy.dtype
+        self.offset = int(proxy.offset)
+        self.frame_bytes = int(np.prod(self.shape[:3])) * self.dtype.itemsize
+        self.slope = float(proxy.slope)
+        self.inter = float(proxy.inter)
+
+        self._file = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self.shape[-1]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_file"] = None
+        state["_lock"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _open(self):
+        if self._file is not None:
+            return self._file
+        if not self.path.endswith(".gz"):
+            self._file = open(self.path, "rb")
+        elif igzip is None:
+            import gzip
+
+            self._file = gzip.open(self.path, "rb")
+        else:
+            index_path = index_path_for(self.path, self.index_dir)
+            fresh = os.path.exists(index_path) and (
+                os.path.getmtime(index_path) >= os.path.getmtime(self.path)
+            )
+            self._file = igzip.IndexedGzipFile(
+                self.path, spacing=self.spacing, index_file=index_path if fresh else None
+            )
+            if not fresh:
+                self._file.build_full_index()
+                os.makedirs(os.path.dirname(index_path) or ".", exist_ok=True)
+                tmp = index_path + ".tmp"
+                self._file.export_index(tmp)
+                os.replace(tmp, index_path)
+        return self._file
+
+    def build_index(self):
+        """Build (or load) the access-point index now instead of on the first read."""
+        with self._lock:
+            self._open()
+
+    def read(self, t_start, t_end):
+        """
+        Read frames [t_start, t_end).
+
+        Returns:
+            np.ndarray: float32 array of shape [H, W, D, t_end - t_start].
+        """
+        if not 0 <= t_start < t_end <= self.shape[-1]:
+            raise IndexError(f"Window [{t_start}, {t_end}) outside [0, {self.shape[-1]})")
+        n = t_end - t_start
+        raw = np.empty(n * self.frame_bytes, dtype=np.uint8)
+        with self._lock:
+            f = self._open()
+            f.seek(self.offset + t_start * self.frame_bytes)
+            if f.readinto(memoryview(raw)) != raw.nbytes:
+                raise IOError(f"{self.path}: truncated data")
+        data = raw.view(self.dtype).reshape(self.shape[:3] + (n,), order="F")
+        data = data.astype(np.float32)
+        if self.slope != 1.0 or self.inter != 0.0:
+            data = data * np.float32(self.slope) + np.float32(self.inter)
+        return data
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def file_key(self):
+        """Path, size and mtime of the file; a cached summary is valid for this key only."""
+        st = os.stat(self.path)
+        return [os.path.abspath(self.path), st.st_size, st.st_mtime_ns]
+
+    def summary(self, projector=None):
+        """
+        Whole-file statistics, decoded once and cached in `summary_path_for`.
+
+        Holds the atlas series ("regions", [n_regions, T] float32), the `scan_qc`
+        stats ("qc"), the `NormalizeByRegion` moments ("count", "mean", "m2",
+        float64 over time) and the voxels nonzero at any time ("nonzero"). The
+        cache is keyed on `file_key` and, when `projector` is given, on its
+        fingerprint; otherwise the file is read once and the cache rewritten,
+        which needs `projector`.
+        """
+        path = summary_path_for(self.path, self.index_dir)
+        key = self.file_key()
+        atlas = projector.fingerprint() if projector is not None else None
+        if os.path.exists(path):
+            with np.load(path) as cached:
+                meta = json.loads(str(cached["meta"]))
+                if meta["key"] == key and atlas in (None, meta["atlas"]):
+                    summary = {name: cached[name] for name in ("regions", "count", "mean", "m2", "nonzero")}
+                    summary["qc"] = meta["qc"]
+                    return summary
+        if projector is None:
+            raise ValueError(f"{self.path}: no up-to-date summary, an atlas projector is needed to build it.")
+
+        from .qc import scan_qc
+
+        scan = self.read(0, len(self))
+        self.close()
+        count, mean, m2 = _chunk_moments(torch.from_numpy(scan)[None], (0, 4))
+        summary = {
+            "regions": np.ascontiguousarray(projector.transform(scan).T, dtype=np.float32),
+            "count": np.int64(count),
+            "mean": mean.numpy(),
+            "m2": m2.numpy(),
+            "nonzero": (scan != 0).any(axis=-1),
+            "qc": scan_qc(scan),
+        }
+        del scan
+        meta = {"key": key, "atlas": atlas, "qc": summary["qc"]}
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp = path + ".tmp.npz"
+        arrays = {name: value for name, value in summary.items() if name != "qc"}
+        np.savez(tmp, meta=np.array(json.dumps(meta)), **arrays)
+        os.replace(tmp, path)
+        return summary
+
+
+class NiftiScans:
+    """
+    Lazy [N, H, W, D, T] scans read from the original NIfTI files.
+
+    Works like `ShardScans`: indexing the sample axis with a slice, list or
+    array gives another lazy view, ``scans[i]`` reads a whole scan and
+    ``scans[i, ..., t0:t1]`` a single window (a seek plus one read through the
+    cached gzip index), and `decode` reads a (small) view densely.
+    """
+
+    def __init__(self, readers, subject_ids=None):
+        self.readers = list(readers)
+        self.subject_ids = list(subject_ids) if subject_ids is not None else [r.path for r in self.readers]
+        shapes = {r.shape for r in self.readers}
+        if len(shapes) > 1:
+            raise ValueError(f"All scans must have the same shape, got {sorted(shapes)}")
+        self.shape = (len(self.readers),) + (shapes.pop() if shapes else ())
+
+    @classmethod
+    def from_dir(cls, base_dir, index_dir=None):
+        """Every `subject_*` scan under `base_dir` (the layout of import_hcp_data), in subject order."""
+        from .ingest_manifest import find_subject_scans
+
+        found = find_subject_scans(base_dir)
+        return cls(
+            [NiftiWindowReader(path, index_dir=index_dir) for _, path in found],
+            [sid for sid, _ in found],
+        )
+
+    @property
+    def paths(self):
+        return [r.path for r in self.readers]
+
+    def __len__(self):
+        return len(self.readers)
+
+    def size(self, dim=None):
+        return self.shape if dim is None else self.shape[dim]
+
+    def read(self, j, t_start=0, t_end=None):
+        """Frames [t_start, t_end) of scan `j` of this view as a float32 [H, W, D, t] tensor."""
+        reader = self.readers[j]
+        return torch.from_numpy(reader.read(t_start, len(reader) if t_end is None else t_end))
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            j, *rest = key
+            t = rest[-1] if rest else slice(None)
+            if rest[:-1] not in ([], [Ellipsis]) or not isinstance(t, slice) or t.step not in (None, 1):
+                raise IndexError("NiftiScans supports scans[i] and scans[i, ..., t0:t1] only.")
+            return self.read(int(j), t.start or 0, t.stop)
+        if isinstance(key, (int, np.integer)):
+            return self.read(int(key))
+        if isinstance(key, torch.Tensor):
+            key = key.numpy()
+        index = np.arange(len(self))[key]
+        return NiftiScans([self.readers[i] for i in index], [self.subject_ids[i] for i in index])
+
+    def decode(self):
+        """All scans of this view as one dense tensor."""
+        return torch.stack([self.read(j) for j in range(len(self))])
+
+    def regions_and_qc(self, projector):
+        """
+        Atlas series ([N, n_regions, T] tensor) and `scan_qc` stats of every scan.
+
+        Come from the cached file summaries (`NiftiWindowReader.summary`): only
+        new or changed files are read, sequentially and one at a time, and that
+        read also fills in their normalizer moments and nonzero masks.
+        """
+        summaries = [reader.summary(projector) for reader in self.readers]
+        regions = torch.stack([torch.from_numpy(s["regions"]) for s in summaries])
+        return regions, [s["qc"] for s in summaries]
+
+    def moments(self):
+        """`NormalizeByRegion` (count, mean, M2) of this view, merged from the file summaries."""
+        total = None
+        for reader in self.readers:
+            s = reader.summary()
+            total = _merge_moments(total, (int(s["count"]), torch.from_numpy(s["mean"]), torch.from_numpy(s["m2"])))
+        return total
+
+    def nonzero_mask(self):
+        """`crop.nonzero_mask` of this view, from the file summaries."""
+        mask = None
+        for reader in self.readers:
+            nonzero = torch.from_numpy(reader.summary()["nonzero"])
+            mask = nonzero if mask is None else mask | nonzero
+        return mask
+
+
+class NiftiWindowDataset(Dataset):
+    """
+    Time-window dataset read straight from the original NIfTI files.
+
+    Windows are served from an LRU cache of fixed-size time blocks, so
+    consecutive windows of the same scan cost one decompressed read per block.
+    Items and batches have the `WindowedScanDataset` layout: (window, scan
+    row, recon) items whose labels are gathered per batch from a `LabelTable`,
+    with `batch_transform` applied to each collated batch.
+    """
+
+    def __init__(
+        self,
+        scans,
+        index_to_info,
+        imageID_to_labels,
+        window_size,
+        stride=None,
+        custom_recon=None,
+        batch_transform=None,
+        projector=None,
+        recon_transform=None,
+        block_size=100,
+        cache_blocks=8,
+        max_open_files=16,
+        index_dir=None,
+    ):
+        """
+        Args:
+            scans (NiftiScans or Sequence[str]): The scans, or their 4D `.nii`/`.nii.gz` files.
+            index_to_info (dict): Per-scan info, keyed by position in `scans`.
+            imageID_to_labels (dict or LabelTable): Labels per image_id.
+            window_size (int): Number of time points per window.
+            stride (int, optional): Step between window starts. Defaults to `window_size` (no overlap).
+            custom_recon (optional): Atlas time series of shape [N, regions, T].
+            batch_transform (callable, optional): Applied in `collate_fn` to each
+                [B, H, W, D, window_size] batch, e.g. `NormalizeResize3D`.
+            projector (AtlasProjector, optional): Computes the atlas target per
+                window when `custom_recon` is not given.
+            recon_transform (callable, optional): Applied to a [1, n_regions, window_size]
+                target computed by `projector`.
+            block_size (int): Time points per cached block.
+            cache_blocks (int): Maximum number of blocks kept in memory.
+            max_open_files (int): Files kept open (each holds its gzip index in memory).
+            index_dir (str, optional): Where to cache gzip indices when `scans` are paths.
+                Defaults to next to each file.
+        """
+        if not isinstance(scans, NiftiScans):
+            scans = NiftiScans([NiftiWindowReader(p, index_dir=index_dir) for p in scans])
+        self.scans = scans
+        self.readers = scans.readers
+        self.index_to_info = index_to_info
+        self.labels = compile_labels(imageID_to_labels, index_to_info)
+        self.window_size = window_size
+        self.block_size = max(block_size, 1)
+        self.cache_blocks = cache_blocks
+        self.max_open_files = max(max_open_files, 1)
+        self.custom_recon = custom_recon
+        self.batch_transform = batch_transform
+        self.projector = projector
+        self.recon_transform = recon_transform
+
+        stride = stride or window_size
+        self.windows = [
+            (f, t)
+            for f, reader in enumerate(self.readers)
+            for t in range(0, len(reader) - window_size + 1, stride)
+        ]
+        self._cache = OrderedDict()
+        self._open_files = OrderedDict()
+
+    def __len__(self):
+        return len(self.windows)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_cache"] = OrderedDict()
+        state["_open_files"] = OrderedDict()
+        return state
+
+    def share_memory(self):
+        """Move the in-memory atlas series to shared memory for DataLoader workers."""
+        share(self.custom_recon)
+        return self
+
+    def _block(self, f, b):
+        key = (f, b)
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+        reader = self.readers[f]
+        start = b * self.block_size
+        block = reader.read(start, min(start + self.block_size, len(reader)))
+        self._open_files[f] = None
+        self._open_files.move_to_end(f)
+        while len(self._open_files) > self.max_open_files:
+            self.readers[self._open_files.popitem(last=False)[0]].close()
+        self._cache[key] = block
+        while len(self._cache) > self.cache_blocks:
+            self._cache.popitem(last=False)
+        return block
+
+    def read_window(self, f, t_start):
+        """Window [t_start, t_start + window_size) of scan `f` as float32 [H, W, D, T]."""
+        t_end = t_start + self.window_size
+        first, last = t_start // self.block_size, (t_end - 1) // self.block_size
+        parts = []
+        for b in range(first, last + 1):
+            lo = max(t_start - b * self.block_size, 0)
+            hi = min(t_end - b * self.block_size, self.block_size)
+            parts.append(self._block(f, b)[..., lo:hi])
+        return parts[0] if len(parts) == 1 else np.concatenate(parts, axis=-1)
+
+    def __getitem__(self, idx):
+        f, t_start = self.windows[idx]
+        window = self.read_window(f, t_start)
+
+        recon = None
+        if self.custom_recon is not None:
+            recon = self.custom_recon[f, :, t_start : t_start + self.window_size]
+        elif self.projector is not None:
+            recon = torch.from_numpy(np.ascontiguousarray(self.projector.transform(window).T))
+            if self.recon_transform is not None:
+                recon = self.recon_transform(recon[None])[0]
+
+        # Labels are looked up per batch from `self.labels` (see `collate_fn`)
+        return torch.from_numpy(window), f, recon
+
+    def collate_fn(self, batch):
+        """Collate (labels by row from `self.labels`) and apply `batch_transform`."""
+        data_batch, batched_labels, custom_recon_batch = collate_fn_corr(batch, self.labels)
+        if self.batch_transform is not None:
+            data_batch = self.batch_transform(data_batch)
+        return data_batch, batched_labels, custom_recon_batch
@@ -1,10 +1,11 @@
 import torch
 from torch.utils.data import DataLoader
-from torchvision import transforms
 
-from .dataset import collate_fn_corr, fmri_corr_dataset
-from .preprocessing import load_and_process_data
-from .transforms import NormalizeByRegion, Resize3D
+from .cache import batch_det_transform, det_transform_mode, load_processed_splits
+from .crop import patch_mask
+from .dataset import WindowedScanDataset
+from .nifti_window import NiftiWindowDataset
+from .streaming import ShardWindowStream
 
 
 def prepare_dataloaders(config, stage="pretrain"):
@@ -18,77 +19,141 @@ def prepare_dataloaders(config, stage="pretrain"):
     """
     print("Loading and preprocessing data...")
 
-    # Load raw data
-    train_set, val_set, test_set, imageID_to_labels, (full_4d, full_atlas), (scan_norm, region_norm) = (
-        load_and_process_data(config)
+    # Normalized and resized splits, from the preprocessing cache when it matches the config
+    splits, imageID_to_labels, (scan_norm, region_norm), (crop, brain_mask) = (
+        load_processed_splits(config)
     )
-    train_data, regions_train, index_to_info_tr = train_set
-    val_data, regions_val, index_to_info_val = val_set
-    test_data, regions_test, index_to_info_test = test_set
+    train_data, regions_train, index_to_info_tr = splits["train"]
+    val_data, regions_val, index_to_info_val = splits["val"]
+    test_data, regions_test, index_to_info_test = splits["test"]
 
     result = {
         "imageID_to_labels": imageID_to_labels,
         "train_info": index_to_info_tr,
         "val_info": index_to_info_val,
         "test_info": index_to_info_test,
+        "normalizers": (scan_norm, region_norm),
+        # BrainCrop applied to the scans (None without BRAIN_CROP); crop.uncrop maps back
+        "crop": crop,
+        # Patches of the model input grid holding any brain voxel (PRUNE_BACKGROUND_PATCHES)
+        "patch_mask": None,
     }
-    det_transform = transforms.Compose(
-    [
-        scan_norm,
-        Resize3D(scale_factor=0.7, align_corners=False),
-    ]
-)
-    recon_transform = transforms.Compose([region_norm])
+    if brain_mask is not None:
+        result["patch_mask"] = patch_mask(brain_mask, config.PATCH_SIZE)
+        kept, total = int(result["patch_mask"].sum()), result["patch_mask"].numel()
+        print(f"Background pruning keeps {kept} of {total} spatial patches ({1 - kept / total:.0%} fewer)")
+    # With a deferred DET_TRANSFORM_MODE the splits hold raw scans, and scan normalization
+    # plus resize run fused on every batch: in collate_fn ("batch") or in the trainer ("device")
+    mode = det_transform_mode(config)
+    lazy_transform = batch_det_transform(config, scan_norm, crop) if mode != "precompute" else None
+    result["device_transform"] = lazy_transform if mode == "device" else None
+    result["input_shape"] = (
+        lazy_transform.output_shape(train_data.shape[1:-1] + (config.WINDOW_SIZE,))
+        if lazy_transform is not None
+        else tuple(train_data.shape[1:-1]) + (config.WINDOW_SIZE,)
+    )
+    # None keeps float32; "float16", "bfloat16" or "int16" stores the transformed scans compactly
+    storage_dtype = getattr(config, "STORAGE_DTYPE", None)
+    # Windows are views into the per-scan splits; a stride below WINDOW_SIZE overlaps them
+    window_args = {
+        "window_size": config.WINDOW_SIZE,
+        "stride": getattr(config, "WINDOW_STRIDE", None),
+        "batch_transform": lazy_transform if mode == "batch" else None,
+    }
+
+    loader_args = dataloader_args(config)
+    # STREAM_SHARDS: the splits are lazy ShardScans, streamed shard by shard each epoch
+    stream = getattr(config, "STREAM_SHARDS", False)
+    stream_args = dict(window_args, buffer_size=getattr(config, "SHUFFLE_BUFFER", 256), seed=config.SEED)
+    if stream and loader_args.get("persistent_workers"):
+        # Persistent workers keep their copy of the stream, so set_epoch would not reach them
+        loader_args["persistent_workers"] = False
+    # NIFTI_DIR: the splits are lazy NiftiScans, windows are read from the original files
+    nifti = getattr(config, "NIFTI_DIR", None)
+    nifti_args = dict(window_args, block_size=getattr(config, "NIFTI_BLOCK_SIZE", 100))
 
     if stage == "pretrain" or stage == "finetune":
         print(f"Creating datasets and dataloaders for {stage}...")
 
-        dataset_tr = fmri_corr_dataset(
-            train_data,
-            index_to_info_tr,
-            imageID_to_labels,
-            det_transform=det_transform,
-            custom_recon=regions_train,
-            recon_transform=recon_transform,
-        )
-
-        dataset_val = fmri_corr_dataset(
-            val_data,
-            index_to_info_val,
-            imageID_to_labels,
-            det_transform=det_transform,
-            custom_recon=regions_val,
-            recon_transform=recon_transform,
-        )
-
-        dataset_test = fmri_corr_dataset(
-            test_data,
-            index_to_info_test,
-            imageID_to_labels,
-            det_transform=det_transform,
-            custom_recon=regions_test,
-            recon_transform=recon_transform,
-        )
-
+        if stream:
+            dataset_tr = ShardWindowStream(
+                train_data, index_to_info_tr, imageID_to_labels,
+                custom_recon=regions_train, shuffle=True, **stream_args,
+            )
+            dataset_val = ShardWindowStream(
+                val_data, index_to_info_val, imageID_to_labels,
+                custom_recon=regions_val, shuffle=True, **stream_args,
+            )
+            dataset_test = ShardWindowStream(
+                test_data, index_to_info_test, imageID_to_labels,
+                custom_recon=regions_test, shuffle=False, **stream_args,
+            )
+        elif nifti:
+            dataset_tr = NiftiWindowDataset(
+                train_data, index_to_info_tr, imageID_to_labels, custom_recon=regions_train, **nifti_args
+            )
+            dataset_val = NiftiWindowDataset(
+                val_data, index_to_info_val, imageID_to_labels, custom_recon=regions_val, **nifti_args
+            )
+            dataset_test = NiftiWindowDataset(
+                test_data, index_to_info_test, imageID_to_labels, custom_recon=regions_test, **nifti_args
+            )
+        else:
+            dataset_tr = WindowedScanDataset(
+                train_data,
+                index_to_info_tr,
+                imageID_to_labels,
+                random_crop=getattr(config, "RANDOM_TEMPORAL_CROP", False),
+                **window_args,
+                custom_recon=regions_train,
+                storage_dtype=storage_dtype,
+            )
+
+            dataset_val = WindowedScanDataset(
+                val_data,
+                index_to_info_val,
+                imageID_to_labels,
+                **window_args,
+                custom_recon=regions_val,
+                storage_dtype=storage_dtype,
+            )
+
+            dataset_test = WindowedScanDataset(
+                test_data,
+                index_to_info_test,
+                imageID_to_labels,
+                **window_args,
+                custom_recon=regions_test,
+                storage_dtype=storage_dtype,
+            )
+
+        # Streamed datasets shuffle themselves (shard order and shuffle buffer)
         train_dataloader = DataLoader(
             dataset_tr,
             batch_size=config.BATCH_SIZE,
-            shuffle=True,
-            collate_fn=collate_fn_corr,
+            shuffle=not stream,
+            collate_fn=dataset_tr.collate_fn,
+            **loader_args,
         )
         val_dataloader = DataLoader(
             dataset_val,
             batch_size=config.BATCH_SIZE,
-            shuffle=True,
-            collate_fn=collate_fn_corr,
+            shuffle=not stream,
+            collate_fn=dataset_val.collate_fn,
+            **loader_args,
         )
         test_dataloader = DataLoader(
             dataset_test,
             batch_size=config.BATCH_SIZE,
             shuffle=False,
-            collate_fn=collate_fn_corr,
+            collate_fn=dataset_test.collate_fn,
+            **loader_args,
         )
 
+        if loader_args["num_workers"] > 0:
+            for dataset in (dataset_tr, dataset_val, dataset_test):
+                dataset.share_memory()
+
         result.update(
             {
                 "train_dataloader": train_dataloader,
@@ -104,22 +169,36 @@ def prepare_dataloaders(config, stage="pretrain"):
         print("Creating datasets and dataloaders for TTA...")
 
         # TTA only needs test data with custom_recon (atlas) for reconstruction loss
-        dataset_test = fmri_corr_dataset(
-            test_data,
-            index_to_info_test,
-            imageID_to_labels,
-            det_transform=det_transform,
-            custom_recon=regions_test,
-            recon_transform=recon_transform,
-        )
+        if stream:
+            dataset_test = ShardWindowStream(
+                test_data, index_to_info_test, imageID_to_labels,
+                custom_recon=regions_test, shuffle=False, **stream_args,
+            )
+        elif nifti:
+            dataset_test = NiftiWindowDataset(
+                test_data, index_to_info_test, imageID_to_labels, custom_recon=regions_test, **nifti_args
+            )
+        else:
+            dataset_test = WindowedScanDataset(
+                test_data,
+                index_to_info_test,
+                imageID_to_labels,
+                **window_args,
+                custom_recon=regions_test,
+                storage_dtype=storage_dtype,
+            )
 
         test_dataloader = DataLoader(
             dataset_test,
             batch_size=config.BATCH_SIZE,
             shuffle=False,
-            collate_fn=collate_fn_corr,
+            collate_fn=dataset_test.collate_fn,
+            **loader_args,
         )
 
+        if loader_args["num_workers"] > 0:
+            dataset_test.share_memory()
+
         result.update(
             {
                 "test_dataloader": test_dataloader,
@@ -135,6 +214,22 @@ def prepare_dataloaders(config, stage="pretrain"):
     return result
 
 
+def dataloader_args(config):
+    """
+    DataLoader worker settings of the config (NUM_WORKERS, PREFETCH_FACTOR,
+    PIN_MEMORY, PERSISTENT_WORKERS); pinning only applies when CUDA is available.
+    """
+    num_workers = getattr(config, "NUM_WORKERS", 0)
+    args = {
+        "num_workers": num_workers,
+        "pin_memory": getattr(config, "PIN_MEMORY", False) and torch.cuda.is_available(),
+    }
+    if num_workers > 0:
+        args["prefetch_factor"] = getattr(config, "PREFETCH_FACTOR", 2)
+        args["persistent_workers"] = getattr(config, "PERSISTENT_WORKERS", False)
+    return args
+
+
 def compute_num_patches_3d(input_shape, patch_size):
     """
     Compute the number of 3D patches given input shape and patch size.
@@ -1,7 +1,14 @@
+import os
 import torch
 import numpy as np
 import json
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
 from typing import Tuple, Union
+from .lowrank import LowRankScans, LowRankStore
+from .nifti_window import NiftiScans
+from .shards import MANIFEST_NAME, ShardScans, ShardStore, write_shard
+from .shared import MappedRows, load_npy
 from .transforms import NormalizeByRegion
 
 class DataSplitter:
@@ -98,8 +105,260 @@ class TimeWindowSplitter:
         return new_info_dict
 
 
+class TemporalDenoiser:
+    """
+    Batched temporal cleaning of [N, voxels, T] chunks.
+
+    Steps, each vectorized over every voxel of every scan in the chunk:
+    polynomial detrending (projection onto the orthogonal complement of a
+    cached orthonormal polynomial basis), FFT band-pass (a cached mask over
+    the rfft bins) and regression of the global signal and/or confounds (one
+    batched least-squares solve per chunk). Confounds get the same detrending
+    and filtering as the data, and the atlas series of the same scans can be
+    cleaned with the same regressors.
+    """
+
+    def __init__(self, tr, detrend_order=1, band=(0.01, 0.1), global_signal=False):
+        """
+        Args:
+            tr (float): Repetition time in seconds.
+            detrend_order (int, optional): Degree of the polynomial trend removed
+                (0 removes the mean only); None skips detrending.
+            band (tuple, optional): (low, high) pass band in Hz; either bound may
+                be None. None skips filtering.
+            global_signal (bool): Regress out the mean signal of the in-brain
+                (nonzero) voxels of each scan.
+        """
+        self.tr = tr
+        self.detrend_order = detrend_order
+        self.band = band
+        self.global_signal = global_signal
+        self._bases = {}
+
+    def _basis(self, n_time, device):
+        key = (n_time, device)
+        if key not in self._bases:
+            basis = keep = None
+            if self.detrend_order is not None:
+                t = torch.linspace(-1, 1, n_time, dtype=torch.float64)
+                vander = torch.stack([t**k for k in range(self.detrend_order + 1)], dim=1)
+                basis = torch.linalg.qr(vander)[0].float().to(device)
+            if self.band is not None:
+                low, high = self.band
+                freqs = torch.fft.rfftfreq(n_time, d=self.tr)
+                keep = torch.ones_like(freqs, dtype=torch.bool)
+                if low is not None:
+                    keep &= freqs >= low
+                if high is not None:
+                    keep &= freqs <= high
+                keep = keep.float().to(device)
+            self._bases[key] = (basis, keep)
+        return self._bases[key]
+
+    def filter(self, x):
+        """Detrend and band-pass [..., T] series."""
+        basis, keep = self._basis(x.shape[-1], x.device)
+        if basis is not None:
+            x = x - (x @ basis) @ basis.T
+        if keep is not None:
+            x = torch.fft.irfft(torch.fft.rfft(x) * keep, n=x.shape[-1])
+        return x
+
+    @staticmethod
+    def regress(x, regressors):
+        """Residuals of [N, V, T] series after least squares on [N, T, k] regressors."""
+        beta = torch.linalg.lstsq(regressors, x.transpose(1, 2)).solution  # [N, k, V]
+        return x - (regressors @ beta).transpose(1, 2)
+
+    def __call__(self, scans, regions=None, confounds=None):
+        """
+        Args:
+            scans: [N, V, T] voxel series (background voxels are all zero).
+            regions (optional): [N, R, T] atlas series of the same scans.
+            confounds (optional): [N, T, k] nuisance regressors.
+        Returns:
+            tuple: Cleaned (scans, regions); background voxels stay zero.
+        """
+        scans = scans.float()
+        brain = (scans != 0).any(dim=-1, keepdim=True)
+        scans = self.filter(scans) * brain
+        regions = self.filter(regions.float()) if regions is not None else None
+
+        regressors = []
+        if confounds is not None:
+            regressors.append(self.filter(confounds.float().transpose(1, 2)).transpose(1, 2))
+        if self.global_signal:
+            n_brain = brain.sum(dim=1).clamp(min=1)
+            regressors.append((scans.sum(dim=1, keepdim=True) / n_brain).transpose(1, 2))
+        if regressors:
+            regressors = torch.cat(regressors, dim=-1)
+            scans = self.regress(scans, regressors) * brain
+            if regions is not None:
+                regions = self.regress(regions, regressors)
+        return scans, regions
+
+
+def denoise_in_chunks(denoiser, scans, regions=None, chunk_size=2, num_threads=4):
+    """
+    Apply a `TemporalDenoiser` in place, `chunk_size` scans at a time on `num_threads` threads.
+
+    Args:
+        scans: [N, H, W, D, T] tensor (resident or a copy-on-write memory map).
+        regions (optional): [N, R, T] atlas series, cleaned with the same regressors.
+    """
+
+    def work(start):
+        chunk = scans[start : start + chunk_size]
+        flat = chunk.reshape(len(chunk), -1, chunk.shape[-1])
+        region_chunk = regions[start : start + chunk_size] if regions is not None else None
+        clean, clean_regions = denoiser(flat, region_chunk)
+        chunk.copy_(clean.reshape(chunk.shape))
+        if regions is not None:
+            region_chunk.copy_(clean_regions)
+
+    with ThreadPoolExecutor(max_workers=num_threads) as pool:
+        list(pool.map(work, range(0, len(scans), chunk_size)))
+
+
+def denoised_shards_dir(shards_dir, denoise):
+    """Directory of the shards cleaned with the `denoise` settings, inside `shards_dir`."""
+    key = hashlib.sha1(json.dumps(denoise, sort_keys=True, default=str).encode()).hexdigest()[:12]
+    return os.path.join(shards_dir, "denoised", key)
+
+
+def denoise_shards(denoiser, store, indices, root, chunk_size=2):
+    """
+    Apply a `TemporalDenoiser` to shards of `store`, `chunk_size` scans at a time,
+    writing the cleaned scans and atlas series to a new shard store at `root`.
+
+    Memory is one chunk of scans whatever the number of subjects. Subjects
+    already cleaned there from the same source shard (same QC stats) are
+    skipped, so an interrupted run resumes where it stopped.
+
+    Args:
+        store (ShardStore): Source store, with atlas series.
+        indices (Sequence[int]): Store indices of the subjects to clean.
+        root (str): Directory of the denoised store.
+    Returns:
+        tuple: (denoised ShardStore, its indices of the subjects of `indices`).
+    """
+    out = ShardStore(root)
+    indices = [int(i) for i in indices]
+
+    def done(i):
+        source = store.entries[i]
+        try:
+            return out.entries[out.index_of(source["subject_id"])].get("source_qc") == source["qc"]
+        except KeyError:
+            return False
+
+    todo = [i for i in indices if not done(i)]
+    chunks = zip(
+        store.iter_chunks(todo, chunk_size=chunk_size),
+        store.iter_chunks(todo, kind="regions", chunk_size=chunk_size),
+    )
+    for start, (scans, regions) in zip(range(0, len(todo), chunk_size), chunks):
+        flat = scans.reshape(len(scans), -1, scans.shape[-1])
+        clean, clean_regions = denoiser(flat, regions.transpose(1, 2))
+        clean = clean.reshape(scans.shape)
+        for j, i in enumerate(todo[start : start + chunk_size]):
+            source = store.entries[i]
+            entry = write_shard(
+                root,
+                source["subject_id"],
+                clean[j].numpy(),
+                clean_regions[j].T.numpy(),
+                storage_dtype=source.get("scan_storage"),
+            )
+            entry["source_qc"] = source["qc"]
+            out.add_entry(entry, save=False)
+        out.save()
+    return out, [out.index_of(store.entries[i]["subject_id"]) for i in indices]
+
+
+def load_tensor(path_without_ext):
+    """
+    Load a dataset tensor, preferring the memory-mapped .npy written by the merge
+    step (zero-copy, pages are read on demand) over a legacy .pt file.
+    """
+    npy_path = f"{path_without_ext}.npy"
+    if os.path.exists(npy_path):
+        # copy-on-write keeps the file untouched while giving torch a writable view
+        return load_npy(npy_path, mode="c")
+    return torch.load(f"{path_without_ext}.pt")
+
+
+def infos_for_subjects(index_to_info, subject_ids):
+    """Re-key index_to_name entries by row for a store whose rows are the given subjects."""
+    info_by_subject = {v["subject_id"]: v for v in index_to_info.values()}
+    return {
+        i: info_by_subject.get(
+            sid, {"filename": "", "subject_id": sid, "date": "N/A", "image_id": sid}
+        )
+        for i, sid in enumerate(subject_ids)
+    }
+
+
+def iter_chunks(tensor, chunk_size=16):
+    """Slices of `tensor` along the sample dimension, for streaming statistics."""
+    for start in range(0, len(tensor), chunk_size):
+        chunk = tensor[start : start + chunk_size]
+        yield chunk if isinstance(chunk, torch.Tensor) else chunk.decode()
+
+
+def schaefer_projector(config, target_path):
+    """Schaefer atlas of ``config.ATLAS`` (e.g. "schaefer200") resampled onto the grid of a scan."""
+    from nilearn import datasets
+
+    from .atlas import AtlasProjector
+
+    atlas = getattr(config, "ATLAS", "schaefer200")
+    if not atlas.startswith("schaefer"):
+        raise ValueError(f"Unsupported ATLAS {atlas!r}; only Schaefer atlases can be extracted on the fly.")
+    maps = datasets.fetch_atlas_schaefer_2018(n_rois=int(atlas[len("schaefer"):])).maps
+    return AtlasProjector.from_atlas_img(maps, target_path)
+
+
+def normalizers_dir(store_root, config):
+    """
+    Where the normalizers fitted on the retained scans of a shard or low-rank
+    store are kept: inside the store, keyed on its manifest contents and the
+    settings that select and clean the scans (QC_METRIC, REMOVE_TOP_K_STD, DENOISE).
+    """
+    with open(os.path.join(store_root, MANIFEST_NAME), "rb") as f:
+        manifest = hashlib.sha1(f.read()).hexdigest()
+    settings = {
+        "QC_METRIC": getattr(config, "QC_METRIC", "std"),
+        "REMOVE_TOP_K_STD": config.REMOVE_TOP_K_STD,
+        "DENOISE": getattr(config, "DENOISE", None),
+    }
+    payload = json.dumps({"manifest": manifest, "settings": settings}, sort_keys=True, default=str)
+    return os.path.join(store_root, "normalizers", hashlib.sha1(payload.encode()).hexdigest()[:16])
+
+
+def save_normalizers(norm_dir, scan_norm, region_norm):
+    """Write scan_norm.pt / region_norm.pt, region_norm last (its presence marks a complete entry)."""
+    os.makedirs(norm_dir, exist_ok=True)
+    for name, normalizer in (("scan_norm", scan_norm), ("region_norm", region_norm)):
+        tmp = os.path.join(norm_dir, f"{name}.tmp.pt")
+        normalizer.save(tmp)
+        os.replace(tmp, os.path.join(norm_dir, f"{name}.pt"))
+
+
+def drop_top_k_std(std_data, k):
+    """Indices of the scans kept after removing the `k` scans with the highest value (std by default)."""
+    top_k_std_scans = np.argsort(std_data)[-k:]
+    mask_bad = np.isin(np.arange(len(std_data)), top_k_std_scans)
+    return np.where(~mask_bad)[0]
+
+
 def load_and_process_data(config):
-    """Main function to load, preprocess, and split the data."""
+    """
+    Main function to load, preprocess, and split the data.
+
+    Splits are returned per scan ([N, H, W, D, T] and [N, regions, T]);
+    time windows are indexed lazily by `WindowedScanDataset`.
+    """
 
     with open(f"{config.BASE_DATA_PATH}/index_to_name.json", "r") as f:
         index_to_info = json.load(f)
@@ -108,24 +367,115 @@ def load_and_process_data(config):
     with open(f"{config.BASE_DATA_PATH}/imageID_to_labels.json", "r") as f:
         imageID_to_labels = json.load(f)
 
-    all_data_4d = torch.load(f"{config.BASE_DATA_PATH}/data/all_4d_downsampled.pt")
-    schaefer_atlas = torch.load(
-        f"{config.BASE_DATA_PATH}/data/time_regions_tensor_not_normalized_schaefer.pt"
-    )
-    schaefer_atlas = schaefer_atlas.permute(0, 2, 1)  # samples, regions, time
+    # Any per-scan statistic of qc.scan_qc can drive the outlier screening
+    qc_metric = getattr(config, "QC_METRIC", "std")
 
-    std_data = np.std(all_data_4d.numpy(), axis=tuple(range(1, all_data_4d.data.ndim)))
-    top_k_std_scans = np.argsort(std_data)[-config.REMOVE_TOP_K_STD :]
-    mask_bad = np.isin(np.arange(all_data_4d.size(0)), top_k_std_scans)
+    shards_dir = getattr(config, "SHARDS_DIR", None)
+    lowrank_dir = getattr(config, "LOWRANK_DIR", None)
+    nifti_dir = getattr(config, "NIFTI_DIR", None)
+    # Store whose directory keeps the fitted normalizers (see `normalizers_dir`)
+    norm_store = None
+    if nifti_dir:
+        # Original NIfTI files: scans are read window by window (NiftiScans); the
+        # atlas series and QC stats come from one sequential pass over every file
+        all_data_4d = NiftiScans.from_dir(nifti_dir, index_dir=getattr(config, "NIFTI_INDEX_DIR", None))
+        if not len(all_data_4d):
+            raise FileNotFoundError(f"No subject_* scans under NIFTI_DIR {nifti_dir}")
+        index_to_info = infos_for_subjects(index_to_info, all_data_4d.subject_ids)
+        schaefer_atlas, qc = all_data_4d.regions_and_qc(schaefer_projector(config, all_data_4d.paths[0]))
+        clean_indices = drop_top_k_std(np.array([q[qc_metric] for q in qc]), config.REMOVE_TOP_K_STD)
+        all_data_4d = all_data_4d[clean_indices]
+        schaefer_atlas = schaefer_atlas[clean_indices]
+    elif lowrank_dir and os.path.exists(os.path.join(lowrank_dir, MANIFEST_NAME)):
+        # Low-rank store: scans stay factorized (LowRankScans) and windows are
+        # decoded when the dataset reads them
+        store = LowRankStore(lowrank_dir)
+        norm_store = lowrank_dir
+        index_to_info = infos_for_subjects(index_to_info, store.subject_ids)
+        clean_indices = drop_top_k_std(store.qc(qc_metric), config.REMOVE_TOP_K_STD)
+        all_data_4d = store.scans(clean_indices)
+        schaefer_atlas = store.stack(clean_indices, kind="regions").permute(0, 2, 1)
+        errors = all_data_4d.rel_errors()
+        print(f"Low-rank scans: rel. reconstruction error of the demeaned scans mean {errors.mean():.4f}, max {errors.max():.4f}")
+    elif shards_dir and os.path.exists(os.path.join(shards_dir, MANIFEST_NAME)):
+        # Sharded store: outlier screening uses the manifest QC stats, and the
+        # retained scans stay on disk (ShardScans), read per window or per chunk.
+        # SHARDS_IN_MEMORY reads them (in parallel) into one resident tensor instead
+        store = ShardStore(shards_dir)
+        norm_store = shards_dir
+        index_to_info = infos_for_subjects(index_to_info, store.subject_ids)
+        clean_indices = drop_top_k_std(store.qc(qc_metric), config.REMOVE_TOP_K_STD)
+        if getattr(config, "SHARDS_IN_MEMORY", False) and not getattr(config, "STREAM_SHARDS", False):
+            all_data_4d = store.stack(clean_indices)
+        else:
+            all_data_4d = store.scans(clean_indices)
+        schaefer_atlas = store.stack(clean_indices, kind="regions").permute(0, 2, 1)
+    else:
+        all_data_4d = load_tensor(f"{config.BASE_DATA_PATH}/data/all_4d_downsampled")
+        schaefer_atlas = load_tensor(
+            f"{config.BASE_DATA_PATH}/data/time_regions_tensor_not_normalized_schaefer"
+        )
+        schaefer_atlas = schaefer_atlas.permute(0, 2, 1)  # samples, regions, time
 
-    clean_indices = np.where(~mask_bad)[0]
-    all_data_4d = all_data_4d[clean_indices]
-    schaefer_atlas = schaefer_atlas[clean_indices]
+        # Rows written by an incremental merge are listed in a sidecar, with their
+        # ingest-time QC stats; index_to_name keys are then stable subject indices
+        rows_meta = {}
+        rows_path = f"{config.BASE_DATA_PATH}/data/all_4d_downsampled.json"
+        if os.path.exists(rows_path):
+            with open(rows_path, "r") as f:
+                rows_meta = json.load(f)
+        row_subjects = rows_meta.get("subject_ids")
+        if row_subjects and None not in row_subjects:
+            index_to_info = infos_for_subjects(index_to_info, row_subjects)
+        elif any(i not in index_to_info for i in range(len(all_data_4d))):
+            # Stable indices leave gaps for rejected subjects, so they are rows only through the sidecar
+            raise ValueError(
+                f"index_to_name.json is not keyed by the rows of the merged tensor and {rows_path} "
+                "is missing; re-run the merge of create_tensors_data to write it."
+            )
+
+        if "qc" in rows_meta:
+            qc_data = np.array([q[qc_metric] for q in rows_meta["qc"]], dtype=np.float64)
+        elif qc_metric == "std":
+            # Older merged tensors without a QC table: full pass over the voxels
+            qc_data = np.std(all_data_4d.numpy(), axis=tuple(range(1, all_data_4d.data.ndim)))
+        else:
+            raise ValueError(f"No cached QC table next to {rows_path} for QC_METRIC={qc_metric!r}.")
+        clean_indices = drop_top_k_std(qc_data, config.REMOVE_TOP_K_STD)
+        # Row views of the mapped tensor: the selection and the splits copy nothing,
+        # rows are read a chunk (or a window) at a time where they are used
+        all_data_4d = MappedRows(all_data_4d, clean_indices)
+        schaefer_atlas = schaefer_atlas[clean_indices]
 
     index_to_info = {
         i: index_to_info[clean_idx] for i, clean_idx in enumerate(clean_indices)
     }
 
+    # Optional temporal cleaning, e.g. DENOISE = {"tr": 0.72, "detrend_order": 2,
+    # "band": (0.01, 0.1), "global_signal": True}; applied before splitting and normalization
+    denoise = getattr(config, "DENOISE", None)
+    if denoise:
+        if isinstance(all_data_4d, LowRankScans):
+            raise ValueError("DENOISE is not supported on low-rank scans; denoise the shards before factorizing.")
+        if isinstance(all_data_4d, NiftiScans):
+            raise ValueError("DENOISE is not supported with NIFTI_DIR; ingest the scans into shards first.")
+        if isinstance(all_data_4d, ShardScans):
+            # Cleaned chunk by chunk into a shard store of their own (reused by later
+            # runs with the same DENOISE settings), then read from it like the source
+            store, rows = denoise_shards(
+                TemporalDenoiser(**denoise),
+                all_data_4d.store,
+                all_data_4d.indices,
+                denoised_shards_dir(shards_dir, denoise),
+            )
+            all_data_4d = store.scans(rows)
+            schaefer_atlas = store.stack(rows, kind="regions").permute(0, 2, 1)
+            norm_store = store.root
+        else:
+            if isinstance(all_data_4d, MappedRows):
+                all_data_4d = all_data_4d.decode()  # cleaned in place
+            denoise_in_chunks(TemporalDenoiser(**denoise), all_data_4d, schaefer_atlas)
+
     splitter = DataSplitter(
         all_data_4d, config.VAL_SPLIT, config.TEST_SPLIT, config.SEED
     )
@@ -146,39 +496,22 @@ def load_and_process_data(config):
     index_to_info_val = {i: index_to_info[idx] for i, idx in enumerate(val_indices)}
     index_to_info_test = {i: index_to_info[idx] for i, idx in enumerate(test_indices)}
 
-    region_normalize_4d = NormalizeByRegion(all_data_4d)
-    region_normalize_atlas = NormalizeByRegion(schaefer_atlas)
-
-    # Apply windowing
-    original_time_len = train_data.shape[-1]
-    train_data = TimeWindowSplitter(train_data, config.WINDOW_SIZE).split()
-    val_data = TimeWindowSplitter(val_data, config.WINDOW_SIZE).split()
-    test_data = TimeWindowSplitter(test_data, config.WINDOW_SIZE).split()
-    regions_train = (
-        TimeWindowSplitter(regions_train.unsqueeze(1).unsqueeze(1), config.WINDOW_SIZE)
-        .split()
-        .squeeze()
-    )
-    regions_val = (
-        TimeWindowSplitter(regions_val.unsqueeze(1).unsqueeze(1), config.WINDOW_SIZE)
-        .split()
-        .squeeze()
-    )
-    regions_test = (
-        TimeWindowSplitter(regions_test.unsqueeze(1).unsqueeze(1), config.WINDOW_SIZE)
-        .split()
-        .squeeze()
-    )
-
-    index_to_info_tr = TimeWindowSplitter.update_info_dict(
-        index_to_info_tr, original_time_len, config.WINDOW_SIZE
-    )
-    index_to_info_val = TimeWindowSplitter.update_info_dict(
-        index_to_info_val, original_time_len, config.WINDOW_SIZE
-    )
-    index_to_info_test = TimeWindowSplitter.update_info_dict(
-        index_to_info_test, original_time_len, config.WINDOW_SIZE
-    )
+    # One-pass float64 statistics over sample chunks, without full-size temporaries;
+    # NIfTI scans merge the moments cached per file instead of decoding every file again.
+    # Fitted on a store's scans they are kept in the store, for launches without the split cache
+    norm_dir = normalizers_dir(norm_store, config) if norm_store else None
+    if norm_dir and os.path.exists(os.path.join(norm_dir, "region_norm.pt")):
+        print(f"Using normalizers from {norm_dir}")
+        region_normalize_4d = NormalizeByRegion.load(os.path.join(norm_dir, "scan_norm.pt"))
+        region_normalize_atlas = NormalizeByRegion.load(os.path.join(norm_dir, "region_norm.pt"))
+    else:
+        if isinstance(all_data_4d, NiftiScans):
+            region_normalize_4d = NormalizeByRegion.from_moments(all_data_4d.moments())
+        else:
+            region_normalize_4d = NormalizeByRegion.fit_stream(iter_chunks(all_data_4d))
+        region_normalize_atlas = NormalizeByRegion.fit_stream(iter_chunks(schaefer_atlas))
+        if norm_dir:
+            save_normalizers(norm_dir, region_normalize_4d, region_normalize_atlas)
 
     return (
         (train_data, regions_train, index_to_info_tr),
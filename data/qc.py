@@ -0,0 +1,62 @@
+import numpy as np
+
+QC_KEYS = ("mean", "std", "max_abs", "tsnr", "dvars", "dvars_max")
+
+
+def scan_qc(scan, chunk_size=100):
+    """
+    Per-scan quality statistics, computed over time chunks in float64.
+
+    Only one [voxels, chunk_size] block is converted at a time, and every
+    statistic is a vectorized reduction over that block: per-voxel temporal
+    moments are merged across chunks (Chan et al.), and the frame differences
+    carry the last frame of the previous chunk.
+
+    Args:
+        scan: Array of shape [H, W, D, T] (NumPy array, memmap or anything sliceable on time).
+        chunk_size (int): Time points per chunk.
+    Returns:
+        dict: mean, std (over all voxels and time, as ``np.std``), max_abs,
+        tsnr (median temporal mean / std over voxels with signal),
+        dvars and dvars_max (RMS frame-to-frame difference, mean and max over frames).
+    """
+    t_total = scan.shape[-1]
+    n_vox = int(np.prod(scan.shape[:-1]))
+    count = 0
+    vox_mean = np.zeros(n_vox)
+    vox_m2 = np.zeros(n_vox)
+    max_abs = 0.0
+    dvars = []
+    prev = None
+
+    for start in range(0, t_total, chunk_size):
+        chunk = np.asarray(scan[..., start : start + chunk_size], dtype=np.float64).reshape(n_vox, -1)
+        n = chunk.shape[1]
+        mean = chunk.mean(axis=1)
+        m2 = ((chunk - mean[:, None]) ** 2).sum(axis=1)
+        delta = mean - vox_mean
+        total = count + n
+        vox_m2 += m2 + delta**2 * (count * n / total)
+        vox_mean += delta * (n / total)
+        count = total
+
+        max_abs = max(max_abs, float(np.abs(chunk).max()))
+        frames = chunk if prev is None else np.concatenate([prev, chunk], axis=1)
+        dvars.append(np.sqrt((np.diff(frames, axis=1) ** 2).mean(axis=0)))
+        prev = chunk[:, -1:]
+
+    global_mean = vox_mean.mean()
+    global_m2 = vox_m2.sum() + count * ((vox_mean - global_mean) ** 2).sum()
+    vox_std = np.sqrt(vox_m2 / count)
+    signal = vox_std > 0
+    tsnr = np.median(vox_mean[signal] / vox_std[signal]) if signal.any() else 0.0
+    dvars = np.concatenate(dvars) if dvars else np.zeros(0)
+
+    return {
+        "mean": float(global_mean),
+        "std": float(np.sqrt(global_m2 / (count * n_vox))),
+        "max_abs": max_abs,
+        "tsnr": float(tsnr),
+        "dvars": float(dvars.mean()) if dvars.size else 0.0,
+        "dvars_max": float(dvars.max()) if dvars.size else 0.0,
+    }
@@ -0,0 +1,295 @@
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+from .compact import decode_array, encode_array
+from .qc import scan_qc
+
+MANIFEST_NAME = "manifest.json"
+
+
+def _atomic_save_npy(path, array):
+    tmp = path + ".tmp.npy"
+    np.save(tmp, array)
+    os.replace(tmp, path)
+
+
+def read_npy_into(path, out):
+    """Read an .npy file straight into a preallocated array (file I/O releases the GIL)."""
+    with open(path, "rb") as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        if tuple(shape) != out.shape or dtype != out.dtype or fortran_order:
+            raise ValueError(f"{path}: {shape} {dtype} does not match {out.shape} {out.dtype}")
+        if f.readinto(memoryview(out).cast("B")) != out.nbytes:
+            raise IOError(f"{path}: truncated shard")
+
+
+def write_shard(root, subject_id, scan, regions=None, storage_dtype=None):
+    """
+    Write one subject's shards and return its manifest entry.
+
+    Safe to call from worker processes: only the subject's own files are
+    written, the manifest itself is updated by the caller via `ShardStore.add_entry`.
+
+    Args:
+        root (str): Store directory.
+        subject_id (str): Subject identifier, used as the shard file name.
+        scan (np.ndarray): 4D scan of shape [H, W, D, T].
+        regions (np.ndarray, optional): Atlas time series of shape [T, n_regions].
+        storage_dtype (str, optional): Store the scan as "float16", "bfloat16" or
+            "int16" (per-voxel scale/offset shards). Stats are taken before encoding.
+    Returns:
+        dict: Manifest entry with relative paths, shapes, dtypes and QC stats.
+    """
+    scan = np.ascontiguousarray(scan)
+    os.makedirs(os.path.join(root, "scans"), exist_ok=True)
+    entry = {
+        "subject_id": str(subject_id),
+        "scan": os.path.join("scans", f"{subject_id}.npy"),
+        "scan_shape": list(scan.shape),
+        "scan_dtype": str(scan.dtype),
+        "qc": scan_qc(scan),
+    }
+    if storage_dtype is not None:
+        scan, scale, offset = encode_array(scan, storage_dtype)
+        entry["scan_dtype"] = str(scan.dtype)
+        entry["scan_storage"] = storage_dtype
+        if scale is not None:
+            for name, array in (("scale", scale), ("offset", offset)):
+                entry[f"scan_{name}"] = os.path.join("scans", f"{subject_id}.{name}.npy")
+                _atomic_save_npy(os.path.join(root, entry[f"scan_{name}"]), array)
+    _atomic_save_npy(os.path.join(root, entry["scan"]), scan)
+
+    if regions is not None:
+        regions = np.ascontiguousarray(regions)
+        os.makedirs(os.path.join(root, "regions"), exist_ok=True)
+        entry["regions"] = os.path.join("regions", f"{subject_id}.npy")
+        entry["regions_shape"] = list(regions.shape)
+        entry["regions_dtype"] = str(regions.dtype)
+        _atomic_save_npy(os.path.join(root, entry["regions"]), regions)
+    return entry
+
+
+class ShardStore:
+    """
+    On-disk dataset with one fixed-layout .npy file per subject and a JSON manifest.
+
+    Shards are opened lazily with ``np.load(mmap_mode="r")``, so only the pages
+    actually read are brought into memory. Open handles are per process and are
+    dropped on pickling, which lets DataLoader workers read different shards in parallel.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.manifest_path = os.path.join(root, MANIFEST_NAME)
+        self.entries = []
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, "r") as f:
+                self.entries = json.load(f)["subjects"]
+        self._index = {e["subject_id"]: i for i, e in enumerate(self.entries)}
+        self._open = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_open"] = {}
+        return state
+
+    @property
+    def subject_ids(self):
+        return [e["subject_id"] for e in self.entries]
+
+    def index_of(self, subject_id):
+        return self._index[str(subject_id)]
+
+    def add_entry(self, entry, save=True):
+        """Register (or replace) a subject written by `write_shard`. Indices of existing subjects never move."""
+        sid = entry["subject_id"]
+        if sid in self._index:
+            i = self._index[sid]
+            self.entries[i] = entry
+            for kind in ("scan", "regions"):
+                self._open.pop((kind, i), None)
+        else:
+            self._index[sid] = len(self.entries)
+            self.entries.append(entry)
+        if save:
+            self.save()
+
+    def add(self, subject_id, scan, regions=None, save=True, storage_dtype=None):
+        entry = write_shard(self.root, subject_id, scan, regions, storage_dtype)
+        self.add_entry(entry, save=save)
+        return entry
+
+    def save(self):
+        os.makedirs(self.root, exist_ok=True)
+        tmp = self.manifest_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"version": 1, "subjects": self.entries}, f, indent=1)
+        os.replace(tmp, self.manifest_path)
+
+    def _array(self, kind, i):
+        key = (kind, i)
+        if key not in self._open:
+            self._open[key] = np.load(
+                os.path.join(self.root, self.entries[i][kind]), mmap_mode="r"
+            )
+        return self._open[key]
+
+    def scan(self, i):
+        """Memory-mapped scan of subject `i`, shape [H, W, D, T], as stored (possibly compact)."""
+        return self._array("scan", i)
+
+    def decode_scan(self, i, payload):
+        """Dequantize a compact scan payload of subject `i` to float32 (no-op for float32 shards)."""
+        entry = self.entries[i]
+        storage = entry.get("scan_storage")
+        if storage is None:
+            return payload
+        scale = offset = None
+        if "scan_scale" in entry:
+            scale = np.load(os.path.join(self.root, entry["scan_scale"]))
+            offset = np.load(os.path.join(self.root, entry["scan_offset"]))
+        return decode_array(payload, storage, scale, offset)
+
+    def read_scan(self, i):
+        """
+        Scan of subject `i` read into memory (not mapped) and dequantized to float32.
+
+        A plain sequential read, so streaming many shards does not keep their
+        pages mapped into the process.
+        """
+        entry = self.entries[i]
+        payload = np.empty(tuple(entry["scan_shape"]), dtype=np.dtype(entry["scan_dtype"]))
+        read_npy_into(os.path.join(self.root, entry["scan"]), payload)
+        return np.asarray(self.decode_scan(i, payload), dtype=np.float32)
+
+    def regions(self, i):
+        """Memory-mapped atlas time series of subject `i`, shape [T, n_regions]."""
+        return self._array("regions", i)
+
+    def qc(self, key):
+        """Per-subject QC statistic as an array aligned with the store indices."""
+        return np.array([e["qc"][key] for e in self.entries], dtype=np.float64)
+
+    def stack(self, indices, kind="scan", num_threads=8):
+        """
+        Read the given subjects into one tensor, reading shards in parallel threads.
+
+        Compact scan shards are dequantized to float32 as they are read.
+
+        Args:
+            indices (Sequence[int]): Store indices to read.
+            kind (str): "scan" or "regions".
+            num_threads (int): Number of concurrent shard reads.
+        Returns:
+            torch.Tensor: Stacked tensor of shape [len(indices), ...].
+        """
+        indices = list(indices)
+        first = self.entries[indices[0]] if indices else self.entries[0]
+        compact = kind == "scan" and any("scan_storage" in self.entries[i] for i in indices)
+        out = np.empty(
+            (len(indices),) + tuple(first[f"{kind}_shape"]),
+            dtype=np.float32 if compact else np.dtype(first[f"{kind}_dtype"]),
+        )
+
+        def read(j):
+            entry = self.entries[indices[j]]
+            path = os.path.join(self.root, entry[kind])
+            if compact and "scan_storage" in entry:
+                payload = np.empty(out.shape[1:], dtype=np.dtype(entry["scan_dtype"]))
+                read_npy_into(path, payload)
+                out[j] = self.decode_scan(indices[j], payload)
+            else:
+                read_npy_into(path, out[j])
+
+        with ThreadPoolExecutor(max_workers=num_threads) as pool:
+            list(pool.map(read, range(len(indices))))
+        return torch.from_numpy(out)
+
+    def scans(self, indices=None):
+        """Lazy [N, H, W, D, T] view of the given subjects (all by default)."""
+        return ShardScans(self, range(len(self)) if indices is None else indices)
+
+    def iter_chunks(self, indices, kind="scan", chunk_size=4):
+        """
+        Yield the given subjects as [<=chunk_size, ...] float tensors, a chunk at a time.
+
+        Chunks keep the stored layout (regions are [n, T, n_regions]). Lets
+        statistics such as `NormalizeByRegion.fit_stream` run out-of-core.
+        """
+        indices = list(indices)
+        for start in range(0, len(indices), chunk_size):
+            yield self.stack(indices[start : start + chunk_size], kind=kind, num_threads=chunk_size)
+
+    @classmethod
+    def from_tensors(cls, root, scans, regions, subject_ids, storage_dtype=None):
+        """Convert monolithic [N, H, W, D, T] / [N, T, n_regions] tensors into a shard store."""
+        store = cls(root)
+        for i, sid in enumerate(subject_ids):
+            store.add(
+                sid,
+                np.asarray(scans[i]),
+                np.asarray(regions[i]) if regions is not None else None,
+                save=False,
+                storage_dtype=storage_dtype,
+            )
+        store.save()
+        return store
+
+
+class ShardScans:
+    """
+    Lazy [N, H, W, D, T] scans backed by a `ShardStore`.
+
+    Indexing the sample axis with a slice, list or array gives another lazy
+    view (so splits never read anything); ``scans[i]`` reads a whole scan and
+    ``scans[i, ..., t0:t1]`` a single window from its memory map, dequantized
+    to float32. `decode` reads a (small) view densely.
+    """
+
+    def __init__(self, store, indices):
+        self.store = store
+        self.indices = np.asarray(indices, dtype=np.int64)
+        first = store.entries[int(self.indices[0])] if len(self.indices) else store.entries[0]
+        self.shape = (len(self.indices),) + tuple(first["scan_shape"])
+
+    def __len__(self):
+        return len(self.indices)
+
+    def size(self, dim=None):
+        return self.shape if dim is None else self.shape[dim]
+
+    def read(self, j, t_start=0, t_end=None):
+        """Frames [t_start, t_end) of scan `j` of this view as a float32 [H, W, D, t] tensor."""
+        i = int(self.indices[j])
+        if t_start == 0 and t_end is None:
+            return torch.from_numpy(self.store.read_scan(i))
+        payload = self.store.scan(i)[..., t_start:t_end]
+        return torch.from_numpy(np.array(self.store.decode_scan(i, payload), dtype=np.float32))
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            j, *rest = key
+            t = rest[-1] if rest else slice(None)
+            if rest[:-1] not in ([], [Ellipsis]) or not isinstance(t, slice) or t.step not in (None, 1):
+                raise IndexError("ShardScans supports scans[i] and scans[i, ..., t0:t1] only.")
+            return self.read(j, t.start or 0, t.stop)
+        if isinstance(key, (int, np.integer)):
+            return self.read(key)
+        if isinstance(key, torch.Tensor):
+            key = key.numpy()
+        return ShardScans(self.store, self.indices[key])
+
+    def decode(self):
+        """All scans of this view as one dense tensor."""
+        return self.store.stack(self.indices)
@@ -0,0 +1,100 @@
+"""
+Dataset tensors that DataLoader workers attach to without copying.
+
+Tensors opened with `load_npy` stay memory-mapped and are reopened by path
+in each worker; any other tensor is moved to shared memory once by `share`.
+Forked workers inherit both; spawned ones (and forkserver) receive them
+through `pack` / `unpack` in the dataset's pickled state.
+"""
+
+import numpy as np
+import torch
+
+
+def load_npy(path, mode="c"):
+    """Memory-mapped tensor of a .npy file that workers reopen instead of copying."""
+    tensor = torch.from_numpy(np.load(path, mmap_mode=mode))
+    tensor.npy_source = (path, mode)
+    return tensor
+
+
+def is_mapped(tensor):
+    return getattr(tensor, "npy_source", None) is not None
+
+
+def share(tensor):
+    """Move an in-memory tensor to shared memory (mapped ones are left as they are)."""
+    if isinstance(tensor, MappedRows):
+        share(tensor.tensor)
+    elif isinstance(tensor, torch.Tensor) and not is_mapped(tensor) and not tensor.is_shared():
+        tensor.share_memory_()
+    return tensor
+
+
+class MappedRows:
+    """
+    Lazy selection of rows of a (typically memory-mapped) [N, ...] tensor.
+
+    Works like `ShardScans`: indexing the first axis with a slice, list or
+    array gives another view without reading anything, ``rows[i]`` and
+    ``rows[i, ..., t0:t1]`` read from the tensor, and `decode` copies the
+    (small) view densely. The tensor is pickled through `pack`, so workers
+    reopen a `load_npy` map instead of receiving a copy.
+    """
+
+    def __init__(self, tensor, indices=None):
+        self.tensor = tensor
+        self.indices = np.arange(len(tensor)) if indices is None else np.asarray(indices, dtype=np.int64)
+        self.shape = (len(self.indices),) + tuple(tensor.shape[1:])
+
+    def __len__(self):
+        return len(self.indices)
+
+    def size(self, dim=None):
+        return self.shape if dim is None else self.shape[dim]
+
+    def rows(self, positions):
+        """Rows of the underlying tensor at `positions` of this view, as an int64 tensor."""
+        return torch.from_numpy(self.indices)[torch.as_tensor(positions, dtype=torch.int64)]
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            j, *rest = key
+            return self.tensor[(int(self.indices[j]),) + tuple(rest)]
+        if isinstance(key, (int, np.integer)):
+            return self.tensor[int(self.indices[key])]
+        if isinstance(key, torch.Tensor):
+            key = key.numpy()
+        return MappedRows(self.tensor, self.indices[key])
+
+    def decode(self):
+        """All rows of this view as one dense tensor."""
+        return self.tensor[torch.from_numpy(self.indices)]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["tensor"] = pack(self.tensor)
+        return state
+
+    def __setstate__(self, state):
+        state["tensor"] = unpack(state["tensor"])
+        self.__dict__.update(state)
+
+
+class MappedNpy:
+    """Picklable stand-in for a `load_npy` tensor."""
+
+    def __init__(self, path, mode):
+        self.path = path
+        self.mode = mode
+
+    def open(self):
+        return load_npy(self.path, self.mode)
+
+
+def pack(value):
+    return MappedNpy(*value.npy_source) if isinstance(value, torch.Tensor) and is_mapped(value) else value
+
+
+def unpack(value):
+    return value.open() if isinstance(value, MappedNpy) else value
@@ -0,0 +1,145 @@
+import math
+
+import numpy as np
+import torch.distributed as dist
+from torch.utils.data import IterableDataset, get_worker_info
+
+from .dataset import collate_fn_corr, compile_labels
+from .shared import share
+
+
+class ShardWindowStream(IterableDataset):
+    """
+    Time windows streamed from a shard store, for splits larger than memory.
+
+    Each epoch visits the shards (one per scan) in a shuffled order, split
+    across distributed ranks and then across DataLoader workers; every shard
+    is read once, sequentially, cut into windows, and the windows pass
+    through a bounded shuffle buffer. Memory is one scan plus `buffer_size`
+    windows per worker, whatever the size of the split. Items and batches
+    have the `WindowedScanDataset` layout.
+    """
+
+    def __init__(
+        self,
+        scans,
+        index_to_info,
+        imageID_to_labels,
+        window_size,
+        stride=None,
+        custom_recon=None,
+        batch_transform=None,
+        shuffle=True,
+        buffer_size=256,
+        seed=0,
+        rank=None,
+        world_size=None,
+    ):
+        """
+        Args:
+            scans (ShardScans): Lazy [N, H, W, D, T] view of the split's shards.
+            index_to_info (dict): Per-scan info, keyed by position in `scans`.
+            imageID_to_labels (dict or LabelTable): Labels per image_id.
+            window_size (int): Time points per window.
+            stride (int, optional): Step between window offsets. Defaults to `window_size`.
+            custom_recon: In-memory atlas time series of shape [N, regions, T].
+            batch_transform (callable, optional): Applied in `collate_fn` to each
+                [B, H, W, D, window_size] batch, e.g. `NormalizeResize3D`.
+            shuffle (bool): Shuffle the shard order and the windows (through the buffer).
+            buffer_size (int): Windows held for shuffling; 1 keeps shard order.
+            seed (int): Base seed; the order changes with `set_epoch`.
+            rank, world_size (int, optional): Distributed split. Default to
+                the initialized process group, if any.
+        """
+        self.scans = scans
+        self.index_to_info = index_to_info
+        self.labels = compile_labels(imageID_to_labels, index_to_info)
+        self.window_size = window_size
+        self.stride = stride or window_size
+        self.custom_recon = custom_recon
+        self.batch_transform = batch_transform
+        self.shuffle = shuffle
+        self.buffer_size = max(buffer_size, 1)
+        self.seed = seed
+        self.epoch = 0
+        distributed = dist.is_available() and dist.is_initialized()
+        self.rank = rank if rank is not None else (dist.get_rank() if distributed else 0)
+        self.world_size = world_size if world_size is not None else (dist.get_world_size() if distributed else 1)
+
+        self.n_time = scans.shape[-1]
+        if self.n_time < window_size:
+            raise ValueError(
+                f"Time dimension ({self.n_time}) is shorter than the window size ({window_size})."
+            )
+        self.windows_per_scan = (self.n_time - window_size) // self.stride + 1
+
+    def set_epoch(self, epoch):
+        """
+        Reseed the shard order and shuffle buffer (as `DistributedSampler.set_epoch`).
+
+        Call it before every epoch: the order only changes through it. Workers
+        see the new epoch when they start, so persistent workers are not supported.
+        """
+        self.epoch = epoch
+
+    def scans_per_rank(self):
+        return math.ceil(len(self.scans) / self.world_size)
+
+    def __len__(self):
+        return self.scans_per_rank() * self.windows_per_scan
+
+    def share_memory(self):
+        """Move the in-memory atlas series to shared memory for DataLoader workers."""
+        share(self.custom_recon)
+        return self
+
+    def shard_order(self):
+        """Scans of this rank and worker for the current epoch, in visiting order."""
+        order = np.arange(len(self.scans))
+        if self.shuffle:
+            order = np.random.default_rng([self.seed, self.epoch]).permutation(order)
+        # Wrap around so that every rank gets the same number of shards (and batches)
+        per_rank = self.scans_per_rank()
+        order = np.resize(order, per_rank * self.world_size)[self.rank :: self.world_size]
+        worker = get_worker_info()
+        if worker is not None:
+            order = order[worker.id :: worker.num_workers]
+        return order
+
+    def windows(self, scan):
+        """(window, scan, recon) items of one scan, read from its shard in one pass."""
+        data = self.scans[int(scan)]
+        for t_start in range(0, self.windows_per_scan * self.stride, self.stride):
+            t_end = t_start + self.window_size
+            recon = (
+                self.custom_recon[scan, :, t_start:t_end]
+                if self.custom_recon is not None
+                else None
+            )
+            yield data[..., t_start:t_end].clone(), int(scan), recon
+
+    def __iter__(self):
+        worker = get_worker_info()
+        worker_id = worker.id if worker is not None else 0
+        rng = np.random.default_rng([self.seed, self.epoch, self.rank, worker_id])
+        buffer = []
+        for scan in self.shard_order():
+            for item in self.windows(scan):
+                if not self.shuffle or self.buffer_size == 1:
+                    yield item
+                elif len(buffer) < self.buffer_size:
+                    buffer.append(item)
+                else:
+                    j = rng.integers(len(buffer))
+                    buffer[j], item = item, buffer[j]
+                    yield item
+        if self.shuffle:
+            rng.shuffle(buffer)
+        yield from buffer
+
+    def collate_fn(self, batch):
+        """Collate (labels by row from `self.labels`) and apply `batch_transform`."""
+        data_batch, batched_labels, custom_recon_batch = collate_fn_corr(batch, self.labels)
+        if self.batch_transform is not None:
+            data_batch = self.batch_transform(data_batch)
+        return data_batch, batched_labels, custom_recon_batch
@@ -1,31 +1,245 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
 import torch
 import torch.nn.functional as F
 import einops
 
+from .shared import load_npy
+
+
+def _chunk_moments(chunk, dims):
+    """Count, mean and sum of squared deviations of one chunk, in float64."""
+    chunk = chunk.double()
+    count = 1
+    for d in dims:
+        count *= chunk.shape[d]
+    mean = chunk.mean(dim=dims, keepdim=True)
+    m2 = ((chunk - mean) ** 2).sum(dim=dims)
+    return count, mean.reshape(m2.shape), m2
+
+
+def _merge_moments(a, b):
+    """Chan et al. parallel combination of two (count, mean, M2) triples."""
+    if a is None:
+        return b
+    n_a, mean_a, m2_a = a
+    n_b, mean_b, m2_b = b
+    n = n_a + n_b
+    delta = mean_b - mean_a
+    mean = mean_a + delta * (n_b / n)
+    m2 = m2_a + m2_b + delta**2 * (n_a * n_b / n)
+    return n, mean, m2
+
+
+def apply_in_chunks(transform, tensor, chunk_size=16, out_path=None):
+    """
+    Apply a per-sample-independent transform to [N, ...] data `chunk_size` samples at a time.
+
+    With `out_path` the result is written to a .npy file as it is produced and
+    returned memory-mapped (copy-on-write), so it is never resident in full.
+    Lazy scans (`ShardScans`, `LowRankScans`) are decoded a chunk at a time.
+    """
+    out = mm = None
+    for start in range(0, len(tensor), chunk_size):
+        chunk = tensor[start : start + chunk_size]
+        if not isinstance(chunk, torch.Tensor):
+            chunk = chunk.decode()
+        chunk = transform(chunk)
+        if out is None:
+            shape = (len(tensor),) + tuple(chunk.shape[1:])
+            if out_path is None:
+                out = torch.empty(shape, dtype=chunk.dtype)
+            else:
+                dtype = np.dtype(str(chunk.dtype).replace("torch.", ""))
+                mm = np.lib.format.open_memmap(out_path, mode="w+", dtype=dtype, shape=shape)
+                out = torch.from_numpy(mm)
+        out[start : start + len(chunk)] = chunk
+    if mm is not None:
+        mm.flush()
+        del out, mm
+        out = load_npy(out_path)
+    return out
+
+
+class _StreamingNormalizer:
+    """
+    Shared out-of-core fitting and persistence of the normalizers' mean/std.
+
+    Subclasses define `_reduce_dims(ndim)`, the dimensions their statistics
+    are taken over.
+    """
+
+    @classmethod
+    def fit_stream(cls, chunks, num_threads=4):
+        """
+        Fit from an iterable of chunks instead of one resident tensor.
+
+        Each chunk is a slice of the dataset along the sample dimension, e.g.
+        [n_i, spatial_1, ..., spatial_k, time]. Per-chunk moments are computed in
+        float64 on `num_threads` threads and merged with Welford/Chan updates,
+        so the result matches fitting on the concatenated tensor.
+        """
+        total = None
+        pending = []
+        with ThreadPoolExecutor(max_workers=num_threads) as pool:
+            for chunk in chunks:
+                pending.append(pool.submit(_chunk_moments, chunk, cls._reduce_dims(chunk.dim())))
+                if len(pending) >= num_threads:
+                    total = _merge_moments(total, pending.pop(0).result())
+            for future in pending:
+                total = _merge_moments(total, future.result())
+        if total is None:
+            raise ValueError("fit_stream received no chunks.")
+        return cls.from_moments(total)
+
+    @classmethod
+    def from_moments(cls, moments):
+        """Normalizer of merged (count, mean, M2) moments, e.g. cached per scan."""
+        count, mean, m2 = moments
+        normalizer = cls.__new__(cls)
+        normalizer.mean = mean.float()
+        # Unbiased, like tensor.std
+        normalizer.std = torch.clamp(torch.sqrt(m2 / max(count - 1, 1)).float(), min=1e-6)
+        return normalizer
+
+    def save(self, path):
+        torch.save({"type": type(self).__name__, "mean": self.mean, "std": self.std}, path)
+
+    @classmethod
+    def load(cls, path):
+        state = torch.load(path, map_location="cpu")
+        if state["type"] != cls.__name__:
+            raise ValueError(f"{path} holds {state['type']} statistics, not {cls.__name__}.")
+        normalizer = cls.__new__(cls)
+        normalizer.mean, normalizer.std = state["mean"], state["std"]
+        return normalizer
+
+
+def linear_interp_matrix(in_size, out_size, align_corners=False):
+    """
+    [out_size, in_size] matrix of 1D linear interpolation, with the source
+    coordinates `F.interpolate` uses for an explicit output size.
+    """
+    dst = torch.arange(out_size, dtype=torch.float64)
+    if align_corners:
+        scale = (in_size - 1) / (out_size - 1) if out_size > 1 else 0.0
+        src = dst * scale
+    else:
+        src = ((dst + 0.5) * (in_size / out_size) - 0.5).clamp(min=0)
+    i0 = src.floor().long().clamp(max=in_size - 1)
+    i1 = (i0 + 1).clamp(max=in_size - 1)
+    frac = src - i0
+    matrix = torch.zeros(out_size, in_size, dtype=torch.float64)
+    rows = torch.arange(out_size)
+    matrix.index_put_((rows, i0), 1 - frac, accumulate=True)
+    matrix.index_put_((rows, i1), frac, accumulate=True)
+    return matrix
+
+
+class SeparableResize3D:
+    """
+    Trilinear resize between two fixed spatial shapes as three 1D contractions.
+
+    Trilinear interpolation is separable, so it equals applying one
+    [out, in] interpolation matrix per spatial axis. The matrices are built
+    once per (device, dtype) and each axis is contracted where it is, by
+    viewing the tensor as [leading, axis, trailing] and multiplying from the
+    left (a tensordot that keeps the axis order): no permute to channels-first,
+    no strided copies and no recomputation of the source coordinates per call.
+    """
+
+    def __init__(self, in_size, out_size, align_corners=False):
+        self.in_size = tuple(int(s) for s in in_size)
+        self.out_size = tuple(int(s) for s in out_size)
+        self.matrices = [
+            linear_interp_matrix(i, o, align_corners) for i, o in zip(self.in_size, self.out_size)
+        ]
+        self._cache = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_cache"] = {}
+        return state
+
+    def _weights(self, device, dtype):
+        key = (device, dtype)
+        if key not in self._cache:
+            self._cache[key] = [m.to(device=device, dtype=dtype) for m in self.matrices]
+        return self._cache[key]
+
+    def __call__(self, tensor, time_last=True):
+        """
+        Args:
+            tensor: [..., H, W, D, T] if `time_last`, else [..., H, W, D]
+                (e.g. the [N, T, H, W, D] layout `F.interpolate` takes).
+        Returns:
+            Tensor with (H, W, D) replaced by `out_size`, same layout.
+        """
+        first = tensor.dim() - (4 if time_last else 3)
+        for offset, weight in enumerate(self._weights(tensor.device, tensor.dtype)):
+            tensor = _contract_axis(tensor, weight, first + offset)
+        return tensor
+
+
+def _contract_axis(tensor, weight, dim):
+    """Apply an [out, in] matrix along `dim`, keeping the other axes in place."""
+    shape = tuple(tensor.shape)
+    trailing = 1
+    for s in shape[dim + 1 :]:
+        trailing *= s
+    if trailing == 1:
+        out = tensor.reshape(-1, shape[dim]) @ weight.T
+    else:
+        out = torch.matmul(weight, tensor.reshape(-1, shape[dim], trailing))
+    return out.reshape(shape[:dim] + (weight.shape[0],) + shape[dim + 1 :])
+
 
 class Resize3D:
     """Resize 3D spatial dimensions while keeping the time dimension intact."""
 
-    def __init__(self, scale_factor=None, target_size=None, align_corners=False):
+    def __init__(self, scale_factor=None, target_size=None, align_corners=False, separable=None):
+        """
+        Args:
+            scale_factor (float, optional): Spatial scale; output sizes are floored.
+            target_size (tuple, optional): Explicit (H', W', D') output size.
+            align_corners (bool): As in `F.interpolate`.
+            separable (bool, optional): Use the cached-weight `SeparableResize3D`
+                engine (one per input shape) instead of permuting and calling
+                `F.interpolate`. None picks it for CUDA tensors only: its dense
+                contractions do more arithmetic than the 8-tap stencil, which
+                only pays off where matmuls are cheap (see benchmarks/bench_resize.py).
+        """
         assert (scale_factor is not None) or (target_size is not None), (
             "You must provide either scale_factor or target_size."
         )
         self.scale_factor = scale_factor
         self.target_size = target_size
         self.align_corners = align_corners
+        self.separable = separable
+        self._engines = {}
 
-    def __call__(self, tensor):
-        # Assumes shape [N, H, W, D, T]
-        x, y, z = tensor.shape[1:4]
-
+    def output_size(self, spatial_shape):
+        """Spatial size (H', W', D') produced for inputs of spatial size (H, W, D)."""
         if self.scale_factor is not None:
-            new_size = (
-                int(x * self.scale_factor),
-                int(y * self.scale_factor),
-                int(z * self.scale_factor),
+            return tuple(int(s * self.scale_factor) for s in spatial_shape)
+        return tuple(self.target_size)
+
+    def engine(self, spatial_shape):
+        """The `SeparableResize3D` for inputs of spatial size (H, W, D), built once."""
+        spatial_shape = tuple(spatial_shape)
+        if spatial_shape not in self._engines:
+            self._engines[spatial_shape] = SeparableResize3D(
+                spatial_shape, self.output_size(spatial_shape), self.align_corners
             )
-        else:
-            new_size = self.target_size
+        return self._engines[spatial_shape]
+
+    def __call__(self, tensor):
+        # Assumes shape [N, H, W, D, T]
+        separable = tensor.is_cuda if self.separable is None else self.separable
+        if separable:
+            return self.engine(tensor.shape[1:4])(tensor)
+        new_size = self.output_size(tensor.shape[1:4])
 
         tensor = tensor.permute(0, 4, 1, 2, 3)  # N, T, H, W, D
         resized = F.interpolate(
@@ -35,7 +249,68 @@ class Resize3D:
         return resized
 
 
-class NormalizeByRegion:
+class NormalizeResize3D:
+    """
+    `NormalizeByRegion` followed by `Resize3D`, fused into one batched operation.
+
+    Both steps are linear in the data, so
+    ``resize((x - mean) / std) == resize(x / std) - resize(mean / std)``.
+    The second term is computed once per device, which leaves one multiply,
+    one interpolation and one subtraction per batch, with no normalized
+    full-resolution copy. Meant to run on collated [B, H, W, D, T] batches,
+    on whatever device they are on.
+    """
+
+    def __init__(self, normalizer, resize, crop=None):
+        """
+        Args:
+            normalizer (NormalizeByRegion): Fitted per-voxel statistics of shape [H, W, D].
+            resize (Resize3D): Spatial resize applied after normalization.
+            crop (BrainCrop, optional): Spatial crop of the resized grid.
+        """
+        self.inv_std = 1.0 / normalizer.std
+        self.scaled_mean = normalizer.mean * self.inv_std
+        self.resize = resize
+        self.crop = crop
+        self._constants = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_constants"] = {}
+        return state
+
+    def output_shape(self, shape):
+        """Shape of a transformed [..., H, W, D, T] sample or batch."""
+        shape = tuple(shape)
+        shape = shape[:-4] + self.resize.output_size(shape[-4:-1]) + shape[-1:]
+        return self.crop.output_shape(shape) if self.crop is not None else shape
+
+    def _on(self, device):
+        if device not in self._constants:
+            inv_std = self.inv_std.to(device)
+            bias = self.resize(self.scaled_mean.to(device)[None, ..., None])[0, ..., 0]
+            self._constants[device] = (inv_std[..., None], bias[..., None])
+        return self._constants[device]
+
+    def __call__(self, batch):
+        """
+        Args:
+            batch: Tensor of shape [B, H, W, D, T].
+        Returns:
+            Normalized, resized (and cropped) tensor of shape [B, H', W', D', T].
+        """
+        inv_std, bias = self._on(batch.device)
+        out = self.resize(batch * inv_std)
+        if self.crop is not None:
+            return self.crop(out) - self.crop(bias)
+        return out.sub_(bias)
+
+
+class NormalizeByRegion(_StreamingNormalizer):
+    @staticmethod
+    def _reduce_dims(ndim):
+        return (0, ndim - 1)
+
     def __init__(self, tensor):
         """
         Initialize region-wise normalization for tensors with arbitrary spatial dimensions.
@@ -81,7 +356,11 @@ class NormalizeByRegion:
         return sample
 
 
-class NormalizeGlobal:
+class NormalizeGlobal(_StreamingNormalizer):
+    @staticmethod
+    def _reduce_dims(ndim):
+        return tuple(range(ndim))
+
     def __init__(self, tensor):
         """
         Initialize global normalization for tensors with arbitrary dimensions.
@@ -104,7 +383,11 @@ class NormalizeGlobal:
         return (sample - self.mean) / self.std
 
 
-class NormalizeByTime:
+class NormalizeByTime(_StreamingNormalizer):
+    @staticmethod
+    def _reduce_dims(ndim):
+        return tuple(range(ndim - 1))
+
     def __init__(self, tensor):
         """
         Initialize time-wise normalization for tensors with arbitrary spatial dimensions.
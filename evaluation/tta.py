@@ -9,6 +9,7 @@ from ..training.losses import (
     calculate_task_losses,
     choose_labels,
 )
+from ..training.prefetch import DevicePrefetcher
 
 
 class TestTimeOptimizer:
@@ -29,6 +30,7 @@ class TestTimeOptimizer:
         tta_lr=5e-4,
         device="cuda",
         verbose=1,
+        batch_transform=None,
     ):
         self.self_supervised_model = self_supervised_model.to(device)
         self.prediction_head = prediction_head.to(device)
@@ -40,6 +42,8 @@ class TestTimeOptimizer:
         self.tta_lr = tta_lr
         self.device = device
         self.verbose = verbose
+        # Deterministic transform applied to each batch once it is on the device
+        self.batch_transform = batch_transform
 
         # Set models to evaluation mode and freeze parameters
         self.self_supervised_model.eval()
@@ -83,6 +87,8 @@ class TestTimeOptimizer:
         Handles a single test batch, performing TTA if enabled.
         """
         data = data.to(self.device)
+        if self.batch_transform is not None:
+            data = self.batch_transform(data)
         custom_recon = (
             custom_recon.to(self.device) if custom_recon is not None else None
         )
@@ -142,8 +148,12 @@ class TestTimeOptimizer:
 
         self.metrics_tracker_test.start_epoch()
 
+        batches = self.test_dataloader
+        if self.hyperparams.get("prefetch_to_device", self.hyperparams.get("PREFETCH_TO_DEVICE", True)):
+            # Copy the next batch to the device while the current one is adapted
+            batches = DevicePrefetcher(batches, self.device)
         loop = tqdm(
-            self.test_dataloader,
+            batches,
             desc=f"Evaluation ({'TTA' if tta_enabled else 'Baseline'})",
         )
         for data, labels_dict, custom_recon in loop:
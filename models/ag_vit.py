@@ -83,6 +83,7 @@ class TransformerAutoEncoder(nn.Module):
         merge_patches=10,
         use_patch_merger=True,
         first_pass=True,
+        patch_mask=None,
     ):
         super().__init__()
         self.h, self.w, self.d, self.time = input_size
@@ -90,6 +91,21 @@ class TransformerAutoEncoder(nn.Module):
         self.embedding_dim = embedding_dim
         self.p_dropout = p_dropout
         self.num_of_spatial_patches = num_of_spatial_patches
+
+        # Optional static boolean mask over the spatial patch grid (see data.crop.patch_mask):
+        # only the kept patches become tokens, with their positional embeddings gathered by index
+        if patch_mask is not None:
+            patch_mask = torch.as_tensor(patch_mask, dtype=torch.bool).flatten()
+            if patch_mask.numel() != num_of_spatial_patches:
+                raise ValueError(
+                    f"patch_mask has {patch_mask.numel()} entries for {num_of_spatial_patches} spatial patches."
+                )
+            patch_index = torch.nonzero(patch_mask).flatten()
+            num_active_patches = len(patch_index)
+        else:
+            patch_index = None
+            num_active_patches = num_of_spatial_patches
+        self.register_buffer("patch_index", patch_index)
         self.first_pass = first_pass
         self.use_temporal_selection = reduce_time_factor_percent < 1
         self.reduce_time_factor_percent = reduce_time_factor_percent
@@ -98,11 +114,11 @@ class TransformerAutoEncoder(nn.Module):
 
         if self.use_patch_selection:
             self.reduced_patches = int(
-                num_of_spatial_patches * reduced_patches_factor_percent
+                num_active_patches * reduced_patches_factor_percent
             )
             self.patch_selection = PatchSelection(self.reduced_patches)
         else:
-            self.reduced_patches = num_of_spatial_patches
+            self.reduced_patches = num_active_patches
 
         if self.use_temporal_selection:
             self.reduced_time_patches = int(self.time * reduce_time_factor_percent)
@@ -157,7 +173,11 @@ class TransformerAutoEncoder(nn.Module):
     def create_2d_positional_embeddings(self, patches_shape):
         B, T, n_spatial_patches, _ = patches_shape
 
-        spatial_pos = self.spatial_pos_embed[:, :n_spatial_patches]
+        patch_index = getattr(self, "patch_index", None)
+        if patch_index is not None:
+            spatial_pos = self.spatial_pos_embed[:, patch_index]
+        else:
+            spatial_pos = self.spatial_pos_embed[:, :n_spatial_patches]
         temporal_pos = self.temporal_pos_embed[:, :T]
 
         spatial_pos = spatial_pos.unsqueeze(1)
@@ -173,6 +193,14 @@ class TransformerAutoEncoder(nn.Module):
         return pos_embed_2d.expand(B, -1, -1)
 
     def reconstruct(self, decoded_patches, B, H, W, D, pad_h, pad_w, pad_d):
+        patch_index = getattr(self, "patch_index", None)
+        if patch_index is not None:
+            # Pruned background patches are reconstructed as zeros
+            full = decoded_patches.new_zeros(
+                (B, self.num_of_spatial_patches) + decoded_patches.shape[2:]
+            )
+            full[:, patch_index] = decoded_patches
+            decoded_patches = full
         total_patches = decoded_patches.shape[1]
         num_patches_h = (H + pad_h) // self.patch_size[0]
         num_patches_w = (W + pad_w) // self.patch_size[1]
@@ -199,7 +227,8 @@ class TransformerAutoEncoder(nn.Module):
             x (torch.Tensor): Input tensor with shape (B, T, H, W, D)
 
         Returns:
-            torch.Tensor: Patches with shape (B, T, n_spatial_patches, patch_dim)
+            torch.Tensor: Patches with shape (B, T, n_spatial_patches, patch_dim),
+                restricted to the kept patches when a patch mask is set
             tuple: Padding dimensions (pad_h, pad_w, pad_d)
         """
         x = einops.rearrange(x, "b h w d t -> b t h w d")
@@ -215,9 +244,14 @@ class TransformerAutoEncoder(nn.Module):
         x = x.unfold(3, self.patch_size[1], self.patch_size[1])  # Patches along W
         x = x.unfold(4, self.patch_size[2], self.patch_size[2])  # Patches along D
 
-        self.n_of_spatial_patches = x.size(2) * x.size(3) * x.size(4)
+        n_grid_patches = x.size(2) * x.size(3) * x.size(4)
         patch_dim = self.patch_size[0] * self.patch_size[1] * self.patch_size[2]
-        patches = x.reshape(B, T, self.n_of_spatial_patches, patch_dim)
+        patches = x.reshape(B, T, n_grid_patches, patch_dim)
+
+        patch_index = getattr(self, "patch_index", None)
+        if patch_index is not None:
+            patches = patches.index_select(2, patch_index)
+        self.n_of_spatial_patches = patches.size(2)
 
         return patches, (pad_h, pad_w, pad_d), (H, W, D, T)
 
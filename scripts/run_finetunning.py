@@ -64,6 +64,7 @@ def main():
         metrics_tracker_test=metrics_tracker_val,
         loss_fns=loss_fns,
         freeze_model=True,
+        batch_transform=data_components["device_transform"],
     )
 
     print("Starting fine-tuning...")
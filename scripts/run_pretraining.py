@@ -43,7 +43,7 @@ def main():
 
     # --- Initialize Model ---
     print("Initializing model...")
-    input_shape = dataset_tr[0][0].shape
+    input_shape = data_components["input_shape"]
 
     num_spatial_patches = compute_num_patches_3d(input_shape[:-1], config.PATCH_SIZE)
 
@@ -63,6 +63,7 @@ def main():
         custom_decoder=config.CUSTOM_RECON_BOOL,
         merge_patches=config.MERGE_PATCHES,
         use_patch_merger=config.USE_PATCH_MERGER,
+        patch_mask=data_components["patch_mask"],
     ).to(config.DEVICE)
 
     # --- Setup Training Components ---
@@ -92,6 +93,7 @@ def main():
     }
     hyperparams['num_epochs'] = config.NUM_EPOCHS
     hyperparams['max_norm'] = config.MAX_NORM
+    hyperparams["prefetch_to_device"] = config.PREFETCH_TO_DEVICE
     hyperparams["chosen_labels"] = chosen_labels
     hyperparams["len_train_dataset"] = len(dataset_tr)
     hyperparams["track_grad"] = True
@@ -115,6 +117,7 @@ def main():
         tracker_description="ICLR submission run",
         run_id=run_id,
         baselines=None,
+        batch_transform=data_components["device_transform"],
 
 
     )
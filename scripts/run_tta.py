@@ -47,6 +47,7 @@ def main():
         tta_lr=config.TTA_LR,
         device=device,
         verbose=config.VERBOSE,
+        batch_transform=data_components["device_transform"],
     )
 
     print(
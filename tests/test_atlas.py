@@ -0,0 +1,58 @@
+"""
+AtlasProjector against nilearn's region-mean extraction.
+
+Run from the repository root with `python -m pytest tests`.
+"""
+
+import nibabel as nib
+import numpy as np
+import pytest
+import torch
+
+from data.atlas import AtlasProjector
+
+nilearn_maskers = pytest.importorskip("nilearn.maskers")
+
+
+@pytest.fixture
+def atlas():
+    rng = np.random.default_rng(0)
+    labels = rng.integers(0, 6, size=(7, 8, 6))
+    labels[labels == 3] = 0  # Gaps in the label values are kept as-is
+    scans = rng.standard_normal((3, 7, 8, 6, 12)).astype(np.float32)
+    return labels, scans
+
+
+def nilearn_regions(labels, scan):
+    masker = nilearn_maskers.NiftiLabelsMasker(
+        nib.Nifti1Image(labels.astype(np.int32), np.eye(4)), strategy="mean", standardize=False
+    )
+    return masker.fit_transform(nib.Nifti1Image(scan, np.eye(4)))
+
+
+def test_matches_nilearn_labels_masker(atlas):
+    labels, scans = atlas
+    projector = AtlasProjector(labels, affine=np.eye(4))
+
+    assert projector.n_regions == 4
+    for scan in scans:
+        np.testing.assert_allclose(
+            projector.transform(scan), nilearn_regions(labels, scan), rtol=1e-5, atol=1e-6
+        )
+
+
+def test_batched_numpy_and_torch_match_single_scans(atlas):
+    labels, scans = atlas
+    projector = AtlasProjector(labels)
+    single = np.stack([projector.transform(scan) for scan in scans])
+
+    np.testing.assert_allclose(projector.transform(scans), single, rtol=1e-6, atol=1e-6)
+    out = projector.transform(torch.from_numpy(scans))
+    assert isinstance(out, torch.Tensor) and out.shape == (3, 12, 4)
+    np.testing.assert_allclose(out.numpy(), single, rtol=1e-5, atol=1e-6)
+
+
+def test_rejects_scans_on_another_grid(atlas):
+    labels, scans = atlas
+    with pytest.raises(ValueError, match="does not match atlas grid"):
+        AtlasProjector(labels).transform(scans[:, :-1])
@@ -0,0 +1,131 @@
+"""
+Lazy time windows and batched fetching of the scan datasets, against the eager
+windowing and per-item indexing they replace.
+
+Run from the repository root with `python -m pytest tests`.
+"""
+
+import pytest
+import torch
+from torch.utils.data import DataLoader
+
+from data.dataset import WindowedScanDataset, fmri_corr_dataset
+from data.preprocessing import TimeWindowSplitter
+from data.shared import MappedRows
+
+
+class LazyScans:
+    """Stand-in for the lazy scan views (shards, low-rank, NIfTI): only `[i, ..., t0:t1]` reads."""
+
+    def __init__(self, tensor):
+        self.tensor = tensor
+        self.shape = tensor.shape
+
+    def __len__(self):
+        return len(self.tensor)
+
+    def __getitem__(self, key):
+        assert isinstance(key, tuple), "lazy views are read one window at a time"
+        return self.tensor[key]
+
+
+@pytest.fixture
+def scans():
+    torch.manual_seed(0)
+    return torch.randn(4, 3, 2, 2, 24), torch.randn(4, 5, 24)
+
+
+LABELS = {"I0": {"Sex_Binary": 1, "Group": "CN"}, "I2": {"Sex_Binary": 0, "Group": "AD"}}
+
+
+def infos(n):
+    return {i: {"image_id": f"I{i}", "subject_id": str(i), "window_index": None} for i in range(n)}
+
+
+def windowed(data, recon, **kwargs):
+    return WindowedScanDataset(data, infos(len(data)), LABELS, window_size=6, custom_recon=recon, **kwargs)
+
+
+def assert_same_batch(got, expected):
+    data, labels, recon = got
+    torch.testing.assert_close(data, expected[0], rtol=0, atol=0)
+    torch.testing.assert_close(recon, expected[2], rtol=0, atol=0)
+    assert labels.keys() == expected[1].keys()
+    torch.testing.assert_close(labels["Sex_Binary"], expected[1]["Sex_Binary"], equal_nan=True)
+    assert labels["Group"] == expected[1]["Group"]
+    assert labels["scan_id"].tolist() == expected[1]["scan_id"].tolist()
+
+
+def test_windows_match_time_window_splitter(scans):
+    data, recon = scans
+    dataset = windowed(data, recon)
+    eager = TimeWindowSplitter(data, 6).split()
+    eager_info = TimeWindowSplitter.update_info_dict(infos(4), 24, 6)
+
+    assert len(dataset) == len(eager) == 16
+    for idx in range(len(dataset)):
+        sample, scan, window_recon = dataset[idx]
+        torch.testing.assert_close(sample, eager[idx], rtol=0, atol=0)
+        torch.testing.assert_close(window_recon, recon[scan, :, (idx % 4) * 6 : (idx % 4 + 1) * 6])
+        assert dataset.window_info(idx) == eager_info[idx]
+
+
+@pytest.mark.parametrize("view", [lambda t: t, MappedRows, LazyScans])
+@pytest.mark.parametrize("stride", [None, 4])
+def test_batched_gather_matches_per_item_windows(scans, view, stride):
+    data, recon = scans
+    dataset = windowed(view(data), view(recon), stride=stride)
+    indices = [len(dataset) - 1, 0, 5, 5, 2]
+
+    batch, rows, batch_recon = dataset._gather(indices)
+    items = [dataset[i] for i in indices]
+    torch.testing.assert_close(batch, torch.stack([item[0] for item in items]), rtol=0, atol=0)
+    torch.testing.assert_close(batch_recon, torch.stack([item[2] for item in items]), rtol=0, atol=0)
+    assert rows.tolist() == [item[1] for item in items]
+
+
+def test_mapped_rows_windows_follow_the_selected_rows(scans):
+    data, recon = scans
+    selected = [3, 1]
+    dataset = windowed(MappedRows(data, selected), MappedRows(recon, selected))
+    expected = windowed(data[selected], recon[selected])
+
+    indices = list(range(len(expected)))
+    for got, want in zip(dataset._gather(indices), expected._gather(indices)):
+        torch.testing.assert_close(got, want, rtol=0, atol=0)
+
+
+@pytest.mark.parametrize(
+    "options",
+    [{}, {"storage_dtype": "int16"}, {"batch_transform": lambda batch: 2 * batch + 1}],
+    ids=["plain", "compact", "batch_transform"],
+)
+def test_getitems_matches_per_item_collate(scans, options):
+    data, recon = scans
+    indices = [7, 0, 13, 7]
+    for dataset in (
+        windowed(data, recon, **options),
+        fmri_corr_dataset(data, infos(len(data)), LABELS, custom_recon=recon, **options),
+    ):
+        batch_indices = [i % len(dataset) for i in indices]
+        per_item = dataset.collate_fn([dataset[i] for i in batch_indices])
+        assert_same_batch(dataset.__getitems__(batch_indices), per_item)
+
+
+def test_dataloader_batches_pass_through_collate(scans, monkeypatch):
+    data, recon = scans
+    dataset = windowed(data, recon)
+    fetched = []
+    getitems = dataset.__getitems__
+
+    def counting_getitems(indices):
+        fetched.append(list(indices))
+        return getitems(indices)
+
+    monkeypatch.setattr(dataset, "__getitems__", counting_getitems)
+    loader = DataLoader(dataset, batch_size=5, collate_fn=dataset.collate_fn)
+
+    for start, batch in zip(range(0, len(dataset), 5), loader):
+        indices = list(range(start, min(start + 5, len(dataset))))
+        assert_same_batch(batch, dataset.collate_fn([dataset[i] for i in indices]))
+    assert fetched == [list(range(start, min(start + 5, len(dataset)))) for start in range(0, len(dataset), 5)]
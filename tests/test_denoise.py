@@ -0,0 +1,73 @@
+"""
+Chunked temporal denoising, in place and shard to shard, against cleaning the
+whole tensor at once.
+
+Run from the repository root with `python -m pytest tests`.
+"""
+
+import pytest
+import torch
+
+from data import preprocessing
+from data.preprocessing import TemporalDenoiser, denoise_in_chunks, denoise_shards
+from data.shards import ShardStore
+
+
+@pytest.fixture
+def scans():
+    torch.manual_seed(0)
+    scans = torch.randn(5, 4, 3, 2, 40) + torch.linspace(0, 3, 40)
+    scans[:, 0, 0] = 0  # Background voxels
+    return scans, torch.randn(5, 6, 40)
+
+
+@pytest.fixture
+def denoiser():
+    return TemporalDenoiser(tr=0.72, detrend_order=2, band=(0.01, 0.3), global_signal=True)
+
+
+def whole(denoiser, scans, regions):
+    clean, clean_regions = denoiser(scans.reshape(len(scans), -1, scans.shape[-1]), regions)
+    return clean.reshape(scans.shape), clean_regions
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 5])
+def test_denoise_in_chunks_matches_whole_tensor(scans, denoiser, chunk_size):
+    scans, regions = scans
+    expected, expected_regions = whole(denoiser, scans, regions)
+
+    scans, regions = scans.clone(), regions.clone()
+    denoise_in_chunks(denoiser, scans, regions, chunk_size=chunk_size, num_threads=2)
+    torch.testing.assert_close(scans, expected, rtol=1e-5, atol=1e-5)
+    torch.testing.assert_close(regions, expected_regions, rtol=1e-5, atol=1e-5)
+    assert not scans[:, 0, 0].any()
+
+
+def test_denoise_shards_matches_whole_tensor_and_resumes(tmp_path, scans, denoiser, monkeypatch):
+    scans, regions = scans
+    store = ShardStore.from_tensors(
+        str(tmp_path / "shards"), scans.numpy(), regions.transpose(1, 2).numpy(), list("abcde")
+    )
+    indices = [3, 0, 4, 1]
+    expected, expected_regions = whole(denoiser, scans[indices], regions[indices])
+
+    root = str(tmp_path / "denoised")
+    out, out_indices = denoise_shards(denoiser, store, indices, root, chunk_size=3)
+    assert [out.subject_ids[i] for i in out_indices] == ["d", "a", "e", "b"]
+    torch.testing.assert_close(out.stack(out_indices), expected, rtol=1e-5, atol=1e-5)
+    torch.testing.assert_close(
+        out.stack(out_indices, kind="regions").transpose(1, 2), expected_regions, rtol=1e-5, atol=1e-5
+    )
+
+    # Subjects already cleaned from the same source shard are not written again
+    written = []
+    write_shard = preprocessing.write_shard
+
+    def counting_write_shard(root, subject_id, *args, **kwargs):
+        written.append(subject_id)
+        return write_shard(root, subject_id, *args, **kwargs)
+
+    monkeypatch.setattr(preprocessing, "write_shard", counting_write_shard)
+    _, again = denoise_shards(denoiser, ShardStore(str(tmp_path / "shards")), [0, 2], root, chunk_size=3)
+    assert written == ["c"]
+    assert [ShardStore(root).subject_ids[i] for i in again] == ["a", "c"]
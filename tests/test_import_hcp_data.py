@@ -0,0 +1,156 @@
+"""
+Resume and skip logic of the HCP downloader against an in-memory S3 stand-in.
+
+Run from the repository root with `python -m pytest tests`.
+"""
+
+import gzip
+import json
+
+import botocore.exceptions
+import nibabel as nib
+import numpy as np
+import pytest
+
+from data import import_hcp_data as hcp
+
+
+class FakeS3:
+    """The three client calls import_hcp_data makes, served from a dict of subject volumes."""
+
+    def __init__(self, volumes, missing=()):
+        self.volumes = volumes
+        self.missing = set(missing)
+        self.downloads = []
+
+    def get_paginator(self, name):
+        assert name == "list_objects_v2"
+        return self
+
+    def paginate(self, Bucket, Prefix, Delimiter, RequestPayer):
+        sids = sorted(set(self.volumes) | self.missing)
+        yield {"CommonPrefixes": [{"Prefix": f"{Prefix}{sid}/"} for sid in sids]}
+        yield {"CommonPrefixes": [{"Prefix": f"{Prefix}README/"}]}
+
+    def download_file(self, bucket, key, filename, ExtraArgs=None):
+        sid = key.split("/")[1]
+        self.downloads.append(sid)
+        if sid in self.missing:
+            raise botocore.exceptions.ClientError(
+                {"Error": {"Code": "404", "Message": "Not Found"}}, "HeadObject"
+            )
+        with open(filename, "wb") as f:
+            f.write(gzip.compress(nib.Nifti1Image(self.volumes[sid], np.eye(4)).to_bytes()))
+
+
+@pytest.fixture
+def base(tmp_path, monkeypatch):
+    monkeypatch.setattr(hcp, "BASE", tmp_path)
+    monkeypatch.setattr(hcp, "MAX_TRANSFER_WORKERS", 2)
+    monkeypatch.setattr(hcp, "MAX_DOWNSAMPLE_WORKERS", 1)
+    monkeypatch.setattr(hcp, "DOWNSAMPLE_CHUNK_SIZE", 2)
+    monkeypatch.setattr(hcp, "SOURCE_SHAPE", (8, 6, 4))
+    return tmp_path
+
+
+def volumes(*sids, shape=(8, 6, 4, 5)):
+    rng = np.random.default_rng(0)
+    return {sid: rng.standard_normal(shape).astype(np.float32) for sid in sids}
+
+
+def test_state_manifest_round_trip(tmp_path):
+    path = tmp_path / "state" / "download_state.json"
+    manifest = hcp.StateManifest(path)
+    assert manifest.state("100") == hcp.PENDING
+
+    manifest.update("100", hcp.DOWNLOADED, size=10, mtime=1.0)
+    manifest.update("101", hcp.FAILED, flush=False, error="missing")
+    assert hcp.StateManifest(path).entries.keys() == {"100"}  # unflushed updates are not on disk
+    manifest.flush()
+
+    reloaded = hcp.StateManifest(path)
+    assert reloaded.state("100") == hcp.DOWNLOADED
+    assert reloaded.entries["100"]["size"] == 10
+    assert reloaded.state("101") == hcp.FAILED
+    assert reloaded.count(hcp.FAILED) == 1
+    assert not path.with_suffix(".json.tmp").exists()
+
+
+def test_fresh_run_downloads_and_downsamples(base):
+    data = volumes("100", "101")
+    client = FakeS3(data, missing=["102"])
+    counts = hcp.main(client, base / "state.json")
+
+    assert sorted(client.downloads) == ["100", "101", "102"]
+    assert counts == {"downloaded": 2, "downsampled": 2, "missing": 1, "errors": 0}
+    manifest = json.loads((base / "state.json").read_text())
+    assert {sid: e["state"] for sid, e in manifest.items()} == {
+        "100": hcp.DOWNSAMPLED, "101": hcp.DOWNSAMPLED, "102": hcp.FAILED
+    }
+    assert manifest["102"]["error"] == "missing"
+    for sid, volume in data.items():
+        img = nib.load(str(hcp.subject_dst(sid)))
+        assert img.shape == (4, 3, 2, 5)
+        np.testing.assert_allclose(img.get_fdata(), volume[::2, ::2, ::2])
+        assert manifest[sid]["size"] == hcp.subject_dst(sid).stat().st_size
+
+
+def test_rerun_skips_everything_recorded(base, monkeypatch):
+    hcp.main(FakeS3(volumes("100", "101"), missing=["102"]), base / "state.json")
+
+    def no_headers(*args, **kwargs):
+        raise AssertionError("a trusted manifest entry must not reopen the NIfTI file")
+
+    monkeypatch.setattr(hcp, "is_downsampled", no_headers)
+    client = FakeS3(volumes("100", "101"), missing=["102"])
+    counts = hcp.main(client, base / "state.json")
+
+    assert client.downloads == []
+    assert counts == {"downloaded": 0, "downsampled": 0, "missing": 0, "errors": 0}
+
+
+def test_interrupted_run_resumes_per_state(base):
+    data = volumes("100", "101", "102")
+    manifest = hcp.StateManifest(base / "state.json")
+    # 100 was downloaded but not downsampled; 101 was still pending with a partial file
+    dst = hcp.subject_dst("100")
+    dst.parent.mkdir(parents=True)
+    nib.save(nib.Nifti1Image(data["100"], np.eye(4)), str(dst))
+    manifest.update("100", hcp.DOWNLOADED, **hcp.file_signature(dst))
+    manifest.update("101", hcp.PENDING)
+    part = hcp.subject_dst("101").with_suffix(".gz.part")
+    part.parent.mkdir(parents=True)
+    part.write_bytes(b"partial")
+
+    client = FakeS3(data)
+    counts = hcp.main(client, base / "state.json")
+
+    assert sorted(client.downloads) == ["101", "102"]
+    assert counts["downsampled"] == 3
+    assert hcp.StateManifest(base / "state.json").count(hcp.DOWNSAMPLED) == 3
+    assert nib.load(str(dst)).shape == (4, 3, 2, 5)
+
+
+def test_full_resolution_file_is_not_downsampled(base):
+    dst = base / "scan.nii.gz"
+    nib.save(nib.Nifti1Image(volumes("100")["100"], np.eye(4)), str(dst))
+    assert not hcp.is_downsampled(dst)
+    nib.save(nib.Nifti1Image(volumes("100", shape=(4, 3, 2, 5))["100"], np.eye(4)), str(dst))
+    assert hcp.is_downsampled(dst)
+
+
+def test_downloaded_entry_already_downsampled_is_kept(base):
+    # The downsample finished but the run stopped before the manifest recorded it
+    small = volumes("100", shape=(4, 3, 2, 5))["100"]
+    dst = hcp.subject_dst("100")
+    dst.parent.mkdir(parents=True)
+    nib.save(nib.Nifti1Image(small, np.eye(4)), str(dst))
+    manifest = hcp.StateManifest(base / "state.json")
+    manifest.update("100", hcp.DOWNLOADED, **hcp.file_signature(dst))
+
+    counts = hcp.main(FakeS3(volumes("100")), base / "state.json")
+
+    assert counts["downsampled"] == 0
+    assert hcp.StateManifest(base / "state.json").state("100") == hcp.DOWNSAMPLED
+    np.testing.assert_array_equal(nib.load(str(dst)).get_fdata(), small)
+    assert hcp.downsample_subject(str(dst)) == (dst.stat().st_size, dst.stat().st_size)
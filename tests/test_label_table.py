@@ -0,0 +1,90 @@
+"""
+Columnar label table and class weights against the per-sample dict handling
+they replace.
+
+Run from the repository root with `python -m pytest tests`.
+"""
+
+import importlib
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+import torch
+
+from data.dataset import collate_fn_corr
+from data.label_table import LabelTable
+
+# training.losses uses package-relative imports: load it as the scripts do, from the repository parent
+REPO = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(REPO.parent))
+losses = importlib.import_module(f"{REPO.name}.training.losses")
+
+LABELS = {
+    "I0": {"Sex_Binary": 0, "CDR_Category": 2, "CDRSB": 1.5, "Group": "CN"},
+    "I1": {"Sex_Binary": 1, "CDR_Category": 0, "CDRSB": float("nan"), "Group": "AD"},
+    "I2": {"Sex_Binary": 0, "CDR_Category": 2, "Group": "CN"},
+    "I3": {"Sex_Binary": 0, "CDR_Category": 3, "CDRSB": 4.0, "Group": "MCI"},
+    "I4": {"Sex_Binary": 1, "CDR_Category": 2.0, "CDRSB": 0.5, "Group": "CN"},
+}
+
+
+def dict_loop_weights(imageID_to_labels, tasks_types):
+    """Class weights as calculate_balanced_weights computed them with per-task dict counters."""
+    counts = {task: {} for task, t_type in tasks_types.items() if t_type != "regression"}
+    for labels in imageID_to_labels.values():
+        for task in counts:
+            if task in labels and not np.isnan(labels[task]):
+                counts[task][int(labels[task])] = counts[task].get(int(labels[task]), 0) + 1
+    weights = {}
+    for task, task_counts in counts.items():
+        if not task_counts:
+            continue
+        if tasks_types[task] == "binary":
+            pos = task_counts.get(1, 0)
+            weights[task] = torch.tensor(1.0 if pos == 0 else task_counts.get(0, 0) / pos)
+        else:
+            total = sum(task_counts.values())
+            weights[task] = torch.tensor(
+                [total / (len(task_counts) * task_counts[c] + 1e-6) for c in sorted(task_counts)]
+            )
+    return weights
+
+
+def test_batch_matches_per_sample_dict_collate():
+    image_ids = ["I3", "I0", "I2", "I4", "I1"]
+    table = LabelTable.from_dict(LABELS, image_ids)
+    rows = [4, 0, 2, 2]
+
+    _, batched, _ = collate_fn_corr([(torch.zeros(1), LABELS[image_ids[r]], None) for r in rows])
+    _, from_table, _ = collate_fn_corr([(torch.zeros(1), r, None) for r in rows], table)
+
+    assert from_table.keys() == batched.keys() | {"scan_id"}
+    assert from_table["Sex_Binary"].dtype == torch.int64
+    for task in ("Sex_Binary", "CDR_Category", "CDRSB"):
+        torch.testing.assert_close(from_table[task].double(), batched[task].double(), equal_nan=True)
+    assert from_table["Group"] == batched["Group"]
+    assert [table.image_ids[i] for i in from_table["scan_id"]] == [image_ids[r] for r in rows]
+
+
+def test_table_from_infos_follows_dataset_order():
+    infos = {0: {"image_id": "I2"}, 1: {"image_id": "missing"}, 2: {"image_id": "I1"}}
+    table = LabelTable.from_infos(LABELS, infos)
+
+    assert table.image_ids == ["I2", "missing", "I1"]
+    np.testing.assert_array_equal(table.column("CDRSB"), [np.nan, np.nan, np.nan])
+    np.testing.assert_array_equal(table.column("Sex_Binary"), [0, np.nan, 1])
+    np.testing.assert_array_equal(table.class_counts("Sex_Binary"), [1, 1])
+
+
+@pytest.mark.parametrize("as_table", [False, True])
+def test_balanced_weights_match_dict_loop(as_table):
+    tasks_types = {"Sex_Binary": "binary", "CDR_Category": "categorical", "CDRSB": "regression", "Absent": "binary"}
+    labels = losses.LabelTable.from_dict(LABELS, list(LABELS)) if as_table else LABELS
+
+    weights = losses.calculate_balanced_weights(labels, tasks_types, "cpu")
+    expected = dict_loop_weights(LABELS, tasks_types)
+    assert weights.keys() == expected.keys() == {"Sex_Binary", "CDR_Category"}
+    for task in expected:
+        torch.testing.assert_close(weights[task].float(), expected[task].float())
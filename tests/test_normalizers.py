@@ -0,0 +1,69 @@
+"""
+Streaming fit of the normalizers against the statistics of the whole tensor.
+
+Run from the repository root with `python -m pytest tests`.
+"""
+
+import pytest
+import torch
+
+from data.transforms import (
+    NormalizeByRegion,
+    NormalizeByTime,
+    NormalizeGlobal,
+    _chunk_moments,
+    _merge_moments,
+)
+
+
+@pytest.fixture
+def scans():
+    torch.manual_seed(0)
+    # Offset and scale per voxel, as in raw BOLD data, so catastrophic cancellation would show
+    return 1000 + 50 * torch.rand(5, 4, 3, 2, 1) * torch.randn(5, 4, 3, 2, 30)
+
+
+def chunks(tensor, sizes):
+    start = 0
+    for size in sizes:
+        yield tensor[start : start + size]
+        start += size
+
+
+@pytest.mark.parametrize("normalizer", [NormalizeByRegion, NormalizeGlobal, NormalizeByTime])
+@pytest.mark.parametrize("sizes", [(5,), (2, 3), (1, 1, 1, 1, 1), (4, 1)])
+def test_fit_stream_matches_full_tensor(scans, normalizer, sizes):
+    full = normalizer(scans)
+    streamed = normalizer.fit_stream(chunks(scans, sizes), num_threads=2)
+
+    torch.testing.assert_close(streamed.mean, full.mean, rtol=1e-6, atol=1e-4)
+    torch.testing.assert_close(streamed.std, full.std, rtol=1e-5, atol=1e-5)
+    torch.testing.assert_close(streamed(scans[0]), full(scans[0]), rtol=1e-4, atol=1e-4)
+
+
+def test_from_moments_of_cached_scans_matches_fit_stream(scans):
+    dims = NormalizeByRegion._reduce_dims(scans.dim())
+    total = None
+    for scan in scans:
+        total = _merge_moments(total, _chunk_moments(scan[None], dims))
+
+    cached = NormalizeByRegion.from_moments(total)
+    streamed = NormalizeByRegion.fit_stream(chunks(scans, (2, 3)))
+    torch.testing.assert_close(cached.mean, streamed.mean, rtol=1e-6, atol=1e-6)
+    torch.testing.assert_close(cached.std, streamed.std, rtol=1e-6, atol=1e-6)
+
+
+def test_save_and_load(tmp_path, scans):
+    fitted = NormalizeByRegion.fit_stream(chunks(scans, (5,)))
+    fitted.save(tmp_path / "region.pt")
+
+    loaded = NormalizeByRegion.load(tmp_path / "region.pt")
+    torch.testing.assert_close(loaded.mean, fitted.mean)
+    torch.testing.assert_close(loaded.std, fitted.std)
+    with pytest.raises(ValueError, match="NormalizeByRegion statistics"):
+        NormalizeGlobal.load(tmp_path / "region.pt")
+
+
+def test_fit_stream_needs_chunks():
+    with pytest.raises(ValueError, match="no chunks"):
+        NormalizeGlobal.fit_stream(iter(()))
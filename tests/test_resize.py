@@ -0,0 +1,62 @@
+"""
+Separable resize engine and fused normalize + resize against `F.interpolate`
+and the unfused transforms.
+
+Run from the repository root with `python -m pytest tests`.
+"""
+
+import pytest
+import torch
+import torch.nn.functional as F
+
+from data.crop import BrainCrop
+from data.transforms import NormalizeByRegion, NormalizeResize3D, Resize3D, SeparableResize3D
+
+
+def interpolate(tensor, size, align_corners):
+    # [N, H, W, D, T] through the channels-first layout F.interpolate takes
+    out = F.interpolate(tensor.permute(0, 4, 1, 2, 3), size=size, mode="trilinear", align_corners=align_corners)
+    return out.permute(0, 2, 3, 4, 1)
+
+
+@pytest.fixture
+def scans():
+    torch.manual_seed(0)
+    return torch.randn(3, 9, 7, 5, 4, dtype=torch.float64)
+
+
+@pytest.mark.parametrize("out_size", [(6, 4, 3), (12, 9, 5), (1, 7, 2)])
+@pytest.mark.parametrize("align_corners", [False, True])
+def test_separable_matches_interpolate(scans, out_size, align_corners):
+    engine = SeparableResize3D(scans.shape[1:4], out_size, align_corners)
+    expected = interpolate(scans, out_size, align_corners)
+
+    torch.testing.assert_close(engine(scans), expected, rtol=1e-10, atol=1e-10)
+    # Time-first layout, as F.interpolate takes it
+    torch.testing.assert_close(
+        engine(scans.permute(0, 4, 1, 2, 3), time_last=False), expected.permute(0, 4, 1, 2, 3)
+    )
+
+
+@pytest.mark.parametrize("size", [{"scale_factor": 0.7}, {"target_size": (4, 4, 4)}])
+def test_resize_engines_agree(scans, size):
+    separable = Resize3D(**size, separable=True)(scans.float())
+    expected = Resize3D(**size, separable=False)(scans.float())
+    torch.testing.assert_close(separable, expected, rtol=1e-5, atol=1e-5)
+
+
+@pytest.mark.parametrize("separable", [False, True])
+def test_normalize_resize_matches_normalize_then_resize(scans, separable):
+    scans = 100 + 10 * scans.float()
+    normalizer = NormalizeByRegion(scans)
+    resize = Resize3D(scale_factor=0.7, separable=separable)
+    fused = NormalizeResize3D(normalizer, resize)
+
+    expected = resize(torch.stack([normalizer(scan) for scan in scans]))
+    out = fused(scans)
+    assert out.shape == fused.output_shape(scans.shape)
+    torch.testing.assert_close(out, expected, rtol=1e-4, atol=1e-4)
+
+    crop = BrainCrop(expected.shape[1:4], (1, 0, 1), (5, 3, 3))
+    fused = NormalizeResize3D(normalizer, resize, crop=crop)
+    torch.testing.assert_close(fused(scans), crop(expected), rtol=1e-4, atol=1e-4)
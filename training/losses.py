@@ -1,7 +1,8 @@
-import numpy as np
 import torch
 import torch.nn as nn
 
+from ..data.label_table import LabelTable
+
 
 def choose_labels(labels_dict, chosen_labels):
     """Filters the labels dictionary to include only the chosen labels."""
@@ -9,27 +10,26 @@ def choose_labels(labels_dict, chosen_labels):
 
 
 def calculate_balanced_weights(imageID_to_labels, tasks_types, device):
-    """Calculates class weights for handling imbalanced datasets."""
-    task_class_counts = {
-        task: {} for task, t_type in tasks_types.items() if t_type != "regression"
-    }
-
-    for labels in imageID_to_labels.values():
-        for task in task_class_counts.keys():
-            if task in labels and not np.isnan(labels[task]):
-                label = int(labels[task])
-                task_class_counts[task][label] = (
-                    task_class_counts[task].get(label, 0) + 1
-                )
+    """
+    Calculates class weights for handling imbalanced datasets.
+
+    `imageID_to_labels` is a labels dict (one count per image_id) or a `LabelTable`.
+    """
+    table = imageID_to_labels
+    if not isinstance(table, LabelTable):
+        table = LabelTable.from_dict(imageID_to_labels, list(imageID_to_labels))
 
     task_weights = {}
-    for task, counts in task_class_counts.items():
-        if not counts:
+    for task, t_type in tasks_types.items():
+        if t_type == "regression":
+            continue
+        counts = table.class_counts(task)
+        if not counts.any():
             continue
 
         if tasks_types[task] == "binary":
-            neg = counts.get(0, 0)
-            pos = counts.get(1, 0)
+            neg = int(counts[0])
+            pos = int(counts[1]) if len(counts) > 1 else 0
             # Handle case where a class is not present
             if pos == 0:
                 weight = torch.tensor(1.0, device=device)
@@ -37,14 +37,10 @@ def calculate_balanced_weights(imageID_to_labels, tasks_types, device):
                 weight = torch.tensor(neg / pos, device=device)
             task_weights[task] = weight
         elif tasks_types[task] == "categorical":
-            num_classes = len(counts)
-            total_samples = sum(counts.values())
-
-            class_weights = []
-            for i in sorted(counts.keys()):
-                weight = total_samples / (num_classes * counts[i] + 1e-6)
-                class_weights.append(weight)
-            task_weights[task] = torch.tensor(class_weights, device=device)
+            # Only the classes that occur, as before
+            present = counts[counts > 0]
+            class_weights = present.sum() / (len(present) * present + 1e-6)
+            task_weights[task] = torch.tensor(class_weights.tolist(), device=device)
 
     return task_weights
 
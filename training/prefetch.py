@@ -0,0 +1,119 @@
+import queue
+import threading
+
+import torch
+
+
+def to_device(batch, device, non_blocking=False):
+    """Move the tensors of a (nested) batch to `device`; other values are left as they are."""
+    if isinstance(batch, torch.Tensor):
+        return batch.to(device, non_blocking=non_blocking)
+    if isinstance(batch, dict):
+        return {k: to_device(v, device, non_blocking) for k, v in batch.items()}
+    if isinstance(batch, (list, tuple)):
+        return type(batch)(to_device(v, device, non_blocking) for v in batch)
+    return batch
+
+
+def _pin(batch):
+    if isinstance(batch, torch.Tensor):
+        return batch if batch.is_pinned() else batch.pin_memory()
+    if isinstance(batch, dict):
+        return {k: _pin(v) for k, v in batch.items()}
+    if isinstance(batch, (list, tuple)):
+        return type(batch)(_pin(v) for v in batch)
+    return batch
+
+
+def _record_stream(batch, stream):
+    if isinstance(batch, torch.Tensor):
+        batch.record_stream(stream)
+    elif isinstance(batch, dict):
+        for v in batch.values():
+            _record_stream(v, stream)
+    elif isinstance(batch, (list, tuple)):
+        for v in batch:
+            _record_stream(v, stream)
+
+
+class DevicePrefetcher:
+    """
+    Iterate a DataLoader with batch N+1 already being moved to `device`
+    while batch N is in use.
+
+    On CUDA the next batch is pinned (unless the loader already pins) and
+    copied with non_blocking=True on a side stream; the compute stream waits
+    for that copy only when the batch is handed out. Otherwise a background
+    thread fetches and moves up to `depth` batches ahead. Batches come out
+    with every tensor on `device`, so `.to(device)` on them is a no-op.
+    """
+
+    def __init__(self, loader, device, depth=2):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.depth = max(depth, 1)
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        if self.device.type == "cuda" and torch.cuda.is_available():
+            return self._cuda_iter()
+        return self._thread_iter()
+
+    def _cuda_iter(self):
+        stream = torch.cuda.Stream(self.device)
+
+        def stage(batch):
+            with torch.cuda.stream(stream):
+                return to_device(_pin(batch), self.device, non_blocking=True)
+
+        batches = iter(self.loader)
+        staged = next(batches, None)
+        staged = stage(staged) if staged is not None else None
+        while staged is not None:
+            current = torch.cuda.current_stream(self.device)
+            current.wait_stream(stream)
+            batch = staged
+            # The copies were allocated on the side stream but are used on this one
+            _record_stream(batch, current)
+            staged = next(batches, None)
+            staged = stage(staged) if staged is not None else None
+            yield batch
+
+    def _thread_iter(self):
+        batches = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+        end = object()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def work():
+            try:
+                for batch in self.loader:
+                    if not put(to_device(batch, self.device)):
+                        return
+            except Exception as e:  # re-raised in the consuming thread
+                put(e)
+                return
+            put(end)
+
+        worker = threading.Thread(target=work, daemon=True)
+        worker.start()
+        try:
+            while True:
+                item = batches.get()
+                if item is end:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stop.set()
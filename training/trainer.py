@@ -9,6 +9,7 @@ from tqdm.auto import tqdm
 from ..utils.metrics import print_metrics
 from ..utils.plotting import plot_grid_recon
 from .losses import calculate_task_losses, choose_labels, handle_null_and_dtypes
+from .prefetch import DevicePrefetcher
 
 
 class BaseTrainer:
@@ -112,6 +113,11 @@ class BaseTrainer:
         self.max_norm = self._get_param_with_default(hyperparams, "max_norm", None)
         self.track_grad = self._get_param_with_default(hyperparams, "track_grad", False)
         self.verbose = self._get_param_with_default(hyperparams, "verbose", 1)
+        # Copy the next batch to the device while the current one is processed
+        # (scripts passing vars(config) only carry the config's PREFETCH_TO_DEVICE)
+        self.prefetch_to_device = self._get_param_with_default(
+            hyperparams, "prefetch_to_device", hyperparams.get("PREFETCH_TO_DEVICE", True)
+        )
         self.best_metric_name = self._get_param_with_default(
             hyperparams, "best_metric_name", None
         )
@@ -203,15 +209,19 @@ class BaseTrainer:
             if self.verbose >= 1
             else range(self.current_epoch, self.num_epochs + 1)
         )
+        train_batches, test_batches = self.train_dataloader, self.test_dataloader
+        if self.prefetch_to_device:
+            train_batches = DevicePrefetcher(train_batches, self.device)
+            test_batches = DevicePrefetcher(test_batches, self.device)
         self.train_loop = (
-            tqdm(self.train_dataloader, colour="#1167b1", desc="train dataloader loop")
+            tqdm(train_batches, colour="#1167b1", desc="train dataloader loop")
             if self.verbose == 2
-            else self.train_dataloader
+            else train_batches
         )
         self.test_loop = (
-            tqdm(self.test_dataloader, colour="red", desc="test dataloader loop")
+            tqdm(test_batches, colour="red", desc="test dataloader loop")
             if self.verbose == 2
-            else self.test_dataloader
+            else test_batches
         )
         return None
 
@@ -468,6 +478,7 @@ class MultiTaskTrainer(BaseTrainer):
         tracker_description=None,
         run_id=None,
         baselines=None,
+        batch_transform=None,
     ):
         super().__init__(
             model=model,
@@ -480,6 +491,8 @@ class MultiTaskTrainer(BaseTrainer):
             tracker_description=tracker_description,
             run_id=run_id,
         )
+        # Deterministic transform applied to each batch once it is on the device
+        self.batch_transform = batch_transform
         self.metrics_tracker_tr = metrics_tracker_tr
         self.metrics_tracker_test = metrics_tracker_test
         self.chosen_labels = hyperparams["chosen_labels"]
@@ -492,6 +505,8 @@ class MultiTaskTrainer(BaseTrainer):
         self, data, labels_dict, custom_recon, metrics_tracker, is_training=True
     ):
         data = data.to(self.device)
+        if self.batch_transform is not None:
+            data = self.batch_transform(data)
         custom_recon = (
             custom_recon.to(self.device) if custom_recon is not None else None
         )
@@ -636,6 +651,10 @@ class MultiTaskTrainer(BaseTrainer):
                 )
 
             self.model.train()
+            # Streamed datasets reshuffle their shard order per epoch
+            dataset = getattr(self.train_dataloader, "dataset", None)
+            if hasattr(dataset, "set_epoch"):
+                dataset.set_epoch(epoch)
             self._train_epoch(self.train_loop, epoch)
             torch.cuda.empty_cache()
 
@@ -687,12 +706,15 @@ class FineTuner(MultiTaskTrainer):
         tracker_description=None,
         run_id=None,
         baselines=None,
+        batch_transform=None,
     ):
         """
         Args:
             model (torch.nn.Module): The pre-trained self-supervised model (e.g., TransformerAutoEncoder).
             prediction_head (torch.nn.Module): The new prediction head to be trained.
             freeze_model (bool): If True, freezes all parameters of the `model`.
+            batch_transform (callable, optional): Applied to each batch on the device
+                (the "device" DET_TRANSFORM_MODE).
         """
         super().__init__(
             model=model,
@@ -708,6 +730,7 @@ class FineTuner(MultiTaskTrainer):
             tracker_description=tracker_description,
             run_id=run_id,
             baselines=baselines,
+            batch_transform=batch_transform,
         )
         self.self_supervised_model = self.model
         self.model = prediction_head  # The trainable part is now the prediction head
@@ -726,6 +749,8 @@ class FineTuner(MultiTaskTrainer):
         self, data, labels_dict, custom_recon, metrics_tracker, is_training=True
     ):
         data = data.to(self.device)
+        if self.batch_transform is not None:
+            data = self.batch_transform(data)
         target = choose_labels(labels_dict, self.chosen_labels)
         target = {
             k: v.to(self.device)